@@ -1,303 +1,672 @@
-from dash import Dash, dcc, html, Input, Output # type: ignore
-from flask import send_from_directory
-import plotly.express as px # type: ignore
-import plotly.graph_objects as go # type: ignore
-from plotly.subplots import make_subplots # type: ignore
-import pandas as pd # type: ignore
-
-transport_nsw_df = pd.read_csv('transport_nsw.csv')
-
-# Ensure numeric lat/lon and drop rows with missing coordinates
-transport_nsw_df['latitude'] = pd.to_numeric(transport_nsw_df['latitude'], errors='coerce')
-transport_nsw_df['longitude'] = pd.to_numeric(transport_nsw_df['longitude'], errors='coerce')
-transport_nsw_df['no_total_injured'] = transport_nsw_df['no_seriously_injured'] + transport_nsw_df['no_moderately_injured'] + transport_nsw_df['no_minor_other_injured']
-transport_nsw_df = transport_nsw_df.dropna(subset=['latitude', 'longitude'])
-
-app = Dash(__name__, title='NSW Road Crash Dashboard')
-app._favicon = 'favicon.ico'
-
-# Build selector options
-weather_values = sorted([str(w) for w in transport_nsw_df['weather'].dropna().unique()])
-weather_options = [{'label': 'All', 'value': 'All'}] + [{'label': w, 'value': w} for w in weather_values]
-surface_condition_values = sorted([str(r) for r in transport_nsw_df['surface_condition'].dropna().unique()])
-surface_condition_options = [{'label': 'All', 'value': 'All'}] + [{'label': r, 'value': r} for r in surface_condition_values]
-lga_values = sorted([str(l) for l in transport_nsw_df['lga'].dropna().unique()])
-lga_options = [{'label': 'All', 'value': 'All'}] + [{'label': l, 'value': l} for l in lga_values]
-
-app.layout = html.Div([
-    # Top banner: logo on the left, title on the right
-    html.Div([
-        html.A(
-            html.Img(
-                src='/assets/nsw.svg',
-                style={'height': '70px', 'display': 'block','marginRight': '20px'}
+import hashlib
+import hmac
+import os
+import threading
+import uuid
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from urllib.parse import parse_qs, urlencode
+
+from dash import ClientsideFunction, Dash, callback, clientside_callback, dcc, html, ctx, Input, Output, State # type: ignore
+from dash.exceptions import PreventUpdate # type: ignore
+from flask import Blueprint, Response, abort, jsonify, request, send_from_directory
+from plotly.io.json import to_json_plotly # type: ignore
+from werkzeug.middleware.proxy_fix import ProxyFix
+import numpy as np
+
+from nswcrash.cache import result_cache_from_env
+from nswcrash.compression import compress_responses
+from nswcrash.crossfilter import CrossFilter, chart_mask
+from nswcrash.cube import SUM_COLUMNS, RowSlice
+from nswcrash.export import EXPORT_MIMETYPES, export_columns, export_formats, row_chunks, stream_export
+from nswcrash.figures import FigureTemplate
+from nswcrash.index import CHART_FILTER_COLUMNS, FILTER_COLUMNS, base_key, filter_key, key_area, key_charts, key_filters
+from nswcrash.tiles import LAYER as TILE_LAYER, valid_tile
+from nswcrash.metrics import (dataset_bytes, dataset_evictions, dataset_load_seconds, dataset_reloads, dataset_rows,
+                              instrument_callbacks, registry, rows_selected, stage, timed, track_result_cache)
+from nswcrash.pool import RenderQueue, Superseded
+from nswcrash.registry import registry_from_env
+from nswcrash.spatial import bbox_area, polygon_area, radius_area
+
+map_initial_view = {'center': {'lat': -33.871, 'lon': 151.195}, 'zoom': 12}
+
+# Rendered callback results, keyed by output, dataset version and normalised
+# filter state. The namespace is a hash of this module and of the nswcrash
+# package's sources, which hold the selections, aggregates and figure
+# templates renders are built from, so a shared on-disk cache does not serve
+# renders of a deploy that changed any of them. Other files (assets, the
+# installed Dash and Plotly) are not hashed: clear the cache when they change.
+def source_hash():
+    digest = hashlib.sha1()
+    package = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nswcrash')
+    paths = [__file__] + sorted(os.path.join(package, name) for name in os.listdir(package) if name.endswith('.py'))
+    for path in paths:
+        with open(path, 'rb') as source:
+            digest.update(os.path.basename(path).encode() + b'\0' + source.read())
+    return digest.hexdigest()[:12]
+
+
+cache_namespace = source_hash()
+result_cache = result_cache_from_env(cache_namespace)
+track_result_cache(result_cache)
+
+# The crash datasets by name (CRASH_DATASETS, see nswcrash.registry), each the
+# typed columnar snapshot of its CSV (built on first use and whenever the CSV
+# changes), with its own indexes and namespace in the result cache.
+# Coordinates are already numeric and rows with missing coordinates were
+# dropped at ingest. create_app() loads the default dataset; the others load
+# when a page first shows them and are unloaded again when idle under
+# CRASH_DATASET_MAX_BYTES. A dataset's data is replaced whole when a new
+# extract is picked up, so each callback reads it once.
+datasets = registry_from_env(result_cache)
+
+# CRASH_RENDER_PROCESSES sets how many processes per worker build the chart
+# figures; 0 (the default) builds them in the request thread. Handing a build
+# to a process costs more than most builds, so use them only where slow
+# builds are seen to hold up other requests. CRASH_RENDER_TIMEOUT is how
+# long (in seconds) a request waits for a process before building itself.
+def warm_render_process():
+    # Build each chart once, so a new process has Plotly's validators loaded
+    # before its first real request.
+    data = datasets.loaded()
+    try:
+        if data is not None:
+            key = statewide_key(data)
+            for render in chart_renders:
+                render(data, key, True)
+    finally:
+        # Neither the metrics copied from the worker by the fork nor the
+        # warm-up are to be sent back to it.
+        registry.take()
+
+
+render_queue = RenderQueue(int(os.environ.get('CRASH_RENDER_PROCESSES', 0)), initializer=warm_render_process,
+                           timeout=float(os.environ.get('CRASH_RENDER_TIMEOUT', 10)))
+
+# The Flask routes besides Dash's own, registered by create_app()
+routes = Blueprint('crash', __name__)
+
+def serve_layout():
+    # Built per page load, laid out for the default dataset; ?dataset=name in
+    # the URL or the dataset selector switch it (see select_dataset).
+    return html.Div([
+        # The page URL, whose ?dataset=name picks the dataset shown
+        dcc.Location(id='url', refresh=False),
+        # Identifies this page load, so its superseded chart builds can be dropped
+        dcc.Store(id='session-id', data=uuid.uuid4().hex),
+
+        # Top banner: logo on the left, title on the right
+        html.Div([
+            html.A(
+                html.Img(
+                    src='/assets/nsw.svg',
+                    style={'height': '70px', 'display': 'block','marginRight': '20px'}
+                ),
+                href='https://opendata.transport.nsw.gov.au/data/dataset/nsw-crash-data',
+                target='_blank',
+                style={'textDecoration': 'none'}
             ),
-            href='https://opendata.transport.nsw.gov.au/data/dataset/nsw-crash-data',
-            target='_blank',
-            style={'textDecoration': 'none'}
-        ),
-        html.H1(
-            'Road Crash Statistics',
-            style={'margin': '0', 'fontSize': '28px', 'fontWeight': '600', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
+            html.H1(
+                'Road Crash Statistics',
+                style={'margin': '0', 'fontSize': '28px', 'fontWeight': '600', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
+            ),
+            # Dataset selector, shown when more than one dataset is configured
+            html.Div(
+                dcc.Dropdown(
+                    options=[{'label': name, 'value': name} for name in datasets.names],
+                    value=datasets.default,
+                    clearable=False,
+                    id='dataset-selector',
+                ),
+                style={'marginLeft': 'auto', 'width': '220px', 'fontFamily': 'Trebuchet MS, sans-serif',
+                       'display': 'block' if len(datasets.names) > 1 else 'none'}
+            ),
+        ],
+            style={'display': 'flex', 'alignItems': 'center', 'padding': '12px 20px', 'borderBottom': '1px solid #ddd', 'backgroundColor': "#e0eaf4", 'marginBottom': '20px'}
         ),
-    ],
-        style={'display': 'flex', 'alignItems': 'center', 'padding': '12px 20px', 'borderBottom': '1px solid #ddd', 'backgroundColor': "#e0eaf4", 'marginBottom': '20px'}
-    ),
 
-    # Top row: RangeSlider on the left, Weather selector on the right
-    # Use class names so responsive CSS in assets/style.css can switch layout
-    html.Div([
-        html.Div([
-            html.Div("Select Year of Crash:", style={'marginBottom': '8px'}),
-            dcc.RangeSlider(
-                min=int(transport_nsw_df['year_of_crash'].min()),
-                max=int(transport_nsw_df['year_of_crash'].max()),
-                step=1,
-                value=[
-                    int(transport_nsw_df['year_of_crash'].min()),
-                    int(transport_nsw_df['year_of_crash'].max())
-                ],
-                marks={str(year): str(year) for year in sorted(transport_nsw_df['year_of_crash'].unique())},
-                id='year-slider'
-            )
-        ], style={'flex': '1'}, className='filter-control range'),
+        # Filters, indicators and charts of the dataset shown
+        html.Div(dashboard_layout(datasets.default), id='dashboard'),
 
+        # Data Source and License Card
         html.Div([
-            html.Div("Select Weather Conditions:", style={'marginBottom': '8px'}),
-            dcc.Dropdown(
-                options=weather_options,
-                value=['All'],
-                multi=True,
-                id='weather-selector',
-                clearable=False,
-            )
-        ], className='filter-control'),
+            html.Div([
+                html.Span('Data Source: ', className='label'),
+                html.A(
+                    'TfNSW Open Data Hub',
+                    href='https://opendata.transport.nsw.gov.au/data/dataset/nsw-crash-data',
+                    target='_blank',
+                    className='separator'
+                ),
+                html.Br(),
+                html.Span('License: ', className='label'),
+                html.A(
+                    'Creative Commons Attribution',
+                    href='https://opendefinition.org/licenses/cc-by/',
+                    target='_blank'
+                ),
+            ], className='data-source-card', style={'marginTop': '15px'})
+        ], className='data-source-container')
+    ])
 
-        html.Div([
-            html.Div("Select Surface Condition:", style={'marginBottom': '8px'}),
-            dcc.Dropdown(
-                options=surface_condition_options,
-                value=['All'],
-                multi=True,
-                id='surface-condition-selector',
-                clearable=False,
-            )
-        ], className='filter-control'),
 
+def dashboard_layout(name):
+    # Selector options and the year range follow the dataset's data. They
+    # come from its snapshot manifest, so the page is served while the
+    # indexes are still being built.
+    metadata = datasets.metadata(name)
+    years = metadata['years']
+
+    # Build selector options
+    weather_values = metadata['categories']['weather']
+    weather_options = [{'label': 'All', 'value': 'All'}] + [{'label': w, 'value': w} for w in weather_values]
+    surface_condition_values = metadata['categories']['surface_condition']
+    surface_condition_options = [{'label': 'All', 'value': 'All'}] + [{'label': r, 'value': r} for r in surface_condition_values]
+    lga_values = metadata['categories']['lga']
+    lga_options = [{'label': 'All', 'value': 'All'}] + [{'label': l, 'value': l} for l in lga_values]
+
+    return [
+        # The dataset every callback of the dashboard reads
+        dcc.Store(id='dataset', data=name),
+        # Filter state the server-side KPI, trend and degree callbacks follow,
+        # and the crash cells the browser filters those outputs from while the
+        # selection stays within them (assets/clientside.js)
+        dcc.Store(id='server-filters', data=[[int(years[0]), int(years[-1])], ['All'], ['All'], ['All'], None, None]),
+        dcc.Store(id='client-cells'),
+        # Categories clicked on the charts, by column (see toggle_chart_filter)
+        dcc.Store(id='chart-filters', data={}),
+
+        # Top row: RangeSlider on the left, Weather selector on the right
+        # Use class names so responsive CSS in assets/style.css can switch layout
         html.Div([
-            html.Div("Select Local Government Area:", style={'marginBottom': '8px'}),
-            dcc.Dropdown(
-                options=lga_options,
-                value=['All'],
-                multi=True,
-                id='lga-selector',
-                clearable=False,
-            )
-        ], className='filter-control'),
-
-    ], className='filters-row', style={'fontFamily': 'Trebuchet MS, sans-serif'}),
-
-    # Key Indicators Row
-    html.Div([
+            html.Div([
+                html.Div("Select Year of Crash:", style={'marginBottom': '8px'}),
+                dcc.RangeSlider(
+                    min=int(years[0]),
+                    max=int(years[-1]),
+                    step=1,
+                    value=[
+                        int(years[0]),
+                        int(years[-1])
+                    ],
+                    marks={str(year): str(year) for year in years},
+                    # Server callbacks run once a drag ends; drag_value only
+                    # drives the outputs filtered in the browser.
+                    updatemode='mouseup',
+                    id='year-slider'
+                )
+            ], style={'flex': '1'}, className='filter-control range'),
+
+            html.Div([
+                html.Div("Select Weather Conditions:", style={'marginBottom': '8px'}),
+                dcc.Dropdown(
+                    options=weather_options,
+                    value=['All'],
+                    multi=True,
+                    id='weather-selector',
+                    clearable=False,
+                )
+            ], className='filter-control'),
+
+            html.Div([
+                html.Div("Select Surface Condition:", style={'marginBottom': '8px'}),
+                dcc.Dropdown(
+                    options=surface_condition_options,
+                    value=['All'],
+                    multi=True,
+                    id='surface-condition-selector',
+                    clearable=False,
+                )
+            ], className='filter-control'),
+
+            html.Div([
+                html.Div("Select Local Government Area:", style={'marginBottom': '8px'}),
+                dcc.Dropdown(
+                    options=lga_options,
+                    value=['All'],
+                    multi=True,
+                    id='lga-selector',
+                    clearable=False,
+                )
+            ], className='filter-control'),
+
+        ], className='filters-row', style={'fontFamily': 'Trebuchet MS, sans-serif'}),
+
+        # Key Indicators Row
         html.Div([
-            html.Div("Total Accidents", style={'fontSize': '12px', 'color': '#666', 'marginBottom': '8px'}),
-            html.Div(id='total-accidents', style={'fontSize': '36px', 'fontWeight': 'bold', 'color': '#333'})
-        ], className='indicator-card'),
+            html.Div([
+                html.Div("Total Accidents", style={'fontSize': '12px', 'color': '#666', 'marginBottom': '8px'}),
+                html.Div(id='total-accidents', style={'fontSize': '36px', 'fontWeight': 'bold', 'color': '#333'})
+            ], className='indicator-card'),
         
-        html.Div([
-            html.Div("Passengers Involved", style={'fontSize': '12px', 'color': '#666', 'marginBottom': '8px'}),
-            html.Div(id='passengers-involved', style={'fontSize': '36px', 'fontWeight': 'bold', 'color': '#333'})
-        ], className='indicator-card'),
+            html.Div([
+                html.Div("Passengers Involved", style={'fontSize': '12px', 'color': '#666', 'marginBottom': '8px'}),
+                html.Div(id='passengers-involved', style={'fontSize': '36px', 'fontWeight': 'bold', 'color': '#333'})
+            ], className='indicator-card'),
         
-        html.Div([
-            html.Div("Moderately Injured", style={'fontSize': '12px', 'color': '#666', 'marginBottom': '8px'}),
-            html.Div(id='moderately-injured', style={'fontSize': '36px', 'fontWeight': 'bold', 'color': '#FF9800'})
-        ], className='indicator-card'),
+            html.Div([
+                html.Div("Moderately Injured", style={'fontSize': '12px', 'color': '#666', 'marginBottom': '8px'}),
+                html.Div(id='moderately-injured', style={'fontSize': '36px', 'fontWeight': 'bold', 'color': '#FF9800'})
+            ], className='indicator-card'),
         
-        html.Div([
-            html.Div("Seriously Injured", style={'fontSize': '12px', 'color': '#666', 'marginBottom': '8px'}),
-            html.Div(id='seriously-injured', style={'fontSize': '36px', 'fontWeight': 'bold', 'color': '#FF5722'})
-        ], className='indicator-card'),
+            html.Div([
+                html.Div("Seriously Injured", style={'fontSize': '12px', 'color': '#666', 'marginBottom': '8px'}),
+                html.Div(id='seriously-injured', style={'fontSize': '36px', 'fontWeight': 'bold', 'color': '#FF5722'})
+            ], className='indicator-card'),
         
-        html.Div([
-            html.Div("Killed", style={'fontSize': '12px', 'color': '#666', 'marginBottom': '8px'}),
-            html.Div(id='killed', style={'fontSize': '36px', 'fontWeight': 'bold', 'color': '#ce0e25'})
-        ], className='indicator-card'),
-    ], className='indicators-row', style={'fontFamily': 'Trebuchet MS, sans-serif', 'marginBottom': '20px'}),
+            html.Div([
+                html.Div("Killed", style={'fontSize': '12px', 'color': '#666', 'marginBottom': '8px'}),
+                html.Div(id='killed', style={'fontSize': '36px', 'fontWeight': 'bold', 'color': '#ce0e25'})
+            ], className='indicator-card'),
+        ], className='indicators-row', style={'fontFamily': 'Trebuchet MS, sans-serif', 'marginBottom': '20px'}),
 
-    # Second row: Three charts (Trend, Location Types, Injury Distribution)
-    html.Div([
+        # Chart filters in effect, shown once a slice or bar is clicked
         html.Div([
-            html.H1(
-                'Accidents & Fatalities Trend',
-                style={'margin': '0', 'fontSize': '18px', 'fontWeight': '300', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
-            ),
-            dcc.Graph(id='trend-chart', className='trend-chart', style={'height': '350px'}),
-        ], className='chart-card'),
-        html.Div([
-            html.H1(
-                'Top 5 Location Types',
-                style={'margin': '0', 'fontSize': '18px', 'fontWeight': '300', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
-            ),
-            dcc.Graph(id='location-bar-chart', className='location-bar-chart', style={'height': '350px'}),
-        ], className='chart-card'),
-        html.Div([
-            html.H1(
-                'Injury Distribution',
-                style={'margin': '0', 'fontSize': '18px', 'fontWeight': '300', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
-            ),
-            dcc.Graph(id='degree-pie-chart', className='degree-pie-chart', style={'height': '350px'}),
-        ], className='chart-card'),
-    ], className='graphs-row', style={'fontFamily': 'Trebuchet MS, sans-serif', 'marginBottom': '20px'}),
+            html.Span(id='chart-filters-summary'),
+            html.Button('Clear', id='clear-chart-filters', className='clear-chart-filters'),
+        ], id='chart-filters-row', className='chart-filters-row', style={'display': 'none'}),
 
-    # Third row: Speed Limit vs Accidents, Region Distribution, and Map
-    html.Div([
-        html.Div([
-            html.H1(
-                'Speed Limit vs Accidents',
-                style={'margin': '0', 'fontSize': '18px', 'fontWeight': '300', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
-            ),
-            dcc.Graph(id='speed-limit-chart', className='speed-limit-chart', style={'height': '350px'}),
-        ], className='chart-card'),
+        # Second row: Three charts (Trend, Location Types, Injury Distribution)
         html.Div([
-            html.H1(
-                'Region Distribution',
-                style={'margin': '0', 'fontSize': '18px', 'fontWeight': '300', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
-            ),
-            dcc.Graph(id='conurbation-donut-chart', className='conurbation-donut-chart', style={'height': '350px'}),
-        ], className='chart-card'),
-        html.Div([
-            dcc.Graph(id='map-chart', className='map-chart', style={'height': '350px'}),
-        ], className='chart-card'),
-    ], className='graphs-row', style={'fontFamily': 'Trebuchet MS, sans-serif'}),
+            html.Div([
+                html.Div([
+                    html.H1(
+                        'Accidents & Fatalities Trend',
+                        style={'margin': '0', 'fontSize': '18px', 'fontWeight': '300', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
+                    ),
+                    # By year, or by month, weekday or time of day over the selected years
+                    dcc.RadioItems(
+                        options=[{'label': label, 'value': value} for value, label in trend_granularities.items()],
+                        value='year',
+                        inline=True,
+                        id='trend-granularity',
+                        className='trend-granularity'
+                    ),
+                ], className='chart-card-header'),
+                dcc.Graph(id='trend-chart', className='trend-chart', style={'height': '350px'}),
+            ], className='chart-card'),
+            html.Div([
+                html.H1(
+                    'Top 5 Location Types',
+                    style={'margin': '0', 'fontSize': '18px', 'fontWeight': '300', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
+                ),
+                dcc.Graph(id='location-bar-chart', className='location-bar-chart', style={'height': '350px'}),
+            ], className='chart-card'),
+            html.Div([
+                html.H1(
+                    'Injury Distribution',
+                    style={'margin': '0', 'fontSize': '18px', 'fontWeight': '300', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
+                ),
+                dcc.Graph(id='degree-pie-chart', className='degree-pie-chart', style={'height': '350px'}),
+            ], className='chart-card'),
+        ], className='graphs-row', style={'fontFamily': 'Trebuchet MS, sans-serif', 'marginBottom': '20px'}),
 
-    # Data Source and License Card
-    html.Div([
+        # Third row: Speed Limit vs Accidents, Region Distribution, and Map
         html.Div([
-            html.Span('Data Source: ', className='label'),
-            html.A(
-                'TfNSW Open Data Hub',
-                href='https://opendata.transport.nsw.gov.au/data/dataset/nsw-crash-data',
-                target='_blank',
-                className='separator'
-            ),
-            html.Br(),
-            html.Span('License: ', className='label'),
-            html.A(
-                'Creative Commons Attribution',
-                href='https://opendefinition.org/licenses/cc-by/',
-                target='_blank'
-            ),
-        ], className='data-source-card', style={'marginTop': '15px'})
-    ], className='data-source-container')
-])
-
-
-@app.callback(
-    Output('map-chart', 'figure'),
-    Output('degree-pie-chart', 'figure'),
-    Output('trend-chart', 'figure'),
-    Output('speed-limit-chart', 'figure'),
-    Output('location-bar-chart', 'figure'),
-    Output('conurbation-donut-chart', 'figure'),
-    Output('total-accidents', 'children'),
-    Output('passengers-involved', 'children'),
-    Output('moderately-injured', 'children'),
-    Output('seriously-injured', 'children'),
-    Output('killed', 'children'),
+            html.Div([
+                html.H1(
+                    'Speed Limit vs Accidents',
+                    style={'margin': '0', 'fontSize': '18px', 'fontWeight': '300', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
+                ),
+                dcc.Graph(id='speed-limit-chart', className='speed-limit-chart', style={'height': '350px'}),
+            ], className='chart-card'),
+            html.Div([
+                html.H1(
+                    'Region Distribution',
+                    style={'margin': '0', 'fontSize': '18px', 'fontWeight': '300', 'fontFamily': 'Trebuchet MS, sans-serif', 'textAlign': 'left'}
+                ),
+                dcc.Graph(id='conurbation-donut-chart', className='conurbation-donut-chart', style={'height': '350px'}),
+            ], className='chart-card'),
+            html.Div([
+                dcc.Graph(id='map-chart', className='map-chart', style={'height': '350px'}),
+            ], className='chart-card'),
+        ], className='graphs-row', style={'fontFamily': 'Trebuchet MS, sans-serif'}),
+    ]
+
+
+filter_inputs = [
     Input('year-slider', 'value'),
     Input('weather-selector', 'value'),
     Input('surface-condition-selector', 'value'),
-    Input('lga-selector', 'value')
+    Input('lga-selector', 'value'),
+]
+
+# A box or lasso selection on the map narrows the KPI cards and charts (but
+# not the map itself) to the crashes inside it.
+area_input = Input('map-chart', 'selectedData')
+
+# Slices and bars clicked on the degree, region, speed limit and location
+# charts filter the other charts, and the map, to their categories.
+chart_filters_input = Input('chart-filters', 'data')
+
+# The same filters as State, for callbacks another input triggers
+filter_states = [State(dependency.component_id, dependency.component_property)
+                 for dependency in filter_inputs + [area_input, chart_filters_input]]
+
+# Every server callback reads the dataset the dashboard was laid out for.
+dataset_state = State('dataset', 'data')
+
+
+def page_dataset(name):
+    # The dataset a callback's page shows, the default if the page does not
+    # say. A name no longer configured (a page open across a redeploy)
+    # leaves the outputs as they are.
+    if name is not None and name not in datasets:
+        raise PreventUpdate
+    return name or datasets.default
+
+
+def url_dataset(search):
+    # ?dataset=name in the page URL, else the default dataset.
+    names = parse_qs((search or '').lstrip('?')).get('dataset')
+    return names[0] if names and names[0] in datasets else datasets.default
+
+
+# The URL and the dataset selector pick the dataset, each kept in step with
+# the other. A new dataset lays the dashboard out afresh from its manifest;
+# its controls and charts then run their callbacks as on a page load.
+@callback(
+    Output('dashboard', 'children'),
+    Output('url', 'search'),
+    Output('dataset-selector', 'value'),
+    Input('url', 'search'),
+    Input('dataset-selector', 'value'),
+    dataset_state,
 )
 
-def update_figure(selected_range, selected_weather, selected_surface_condition, selected_lga):
-    start_year, end_year = selected_range
-    filtered_df = transport_nsw_df[
-        (transport_nsw_df['year_of_crash'] >= start_year) &
-        (transport_nsw_df['year_of_crash'] <= end_year)
-    ].copy()
+def select_dataset(search, selected, shown):
+    name = selected if ctx.triggered_id == 'dataset-selector' else url_dataset(search)
+    if name not in datasets or name == page_dataset(shown):
+        raise PreventUpdate
+    search = '' if name == datasets.default else '?' + urlencode({'dataset': name})
+    return dashboard_layout(name), search, name
+
 
-    # Apply filters
+def selection_area(selected_data):
+    # Plotly reports a box as its two corners and a lasso as its path, both
+    # as [lon, lat] pairs under the map subplot's name.
+    if not selected_data:
+        return None
+    for name, area in (('range', bbox_area), ('lassoPoints', polygon_area)):
+        points = next(iter((selected_data.get(name) or {}).values()), None)
+        if points:
+            try:
+                return area(*points[0], *points[1]) if name == 'range' else area(points)
+            except (TypeError, ValueError, IndexError):
+                return None
+    return None
+
+
+def current_filter_key(selected_range, selected_weather, selected_surface_condition, selected_lga, selected_area=None,
+                       selected_charts=None):
     # The dropdown returns a list; 'All' indicates no filtering.
-    if selected_weather and 'All' not in selected_weather:
-        filtered_df = filtered_df[filtered_df['weather'].astype(str).isin(selected_weather)]
-    if selected_surface_condition and 'All' not in selected_surface_condition:
-        filtered_df = filtered_df[filtered_df['surface_condition'].astype(str).isin(selected_surface_condition)]
-    if selected_lga and 'All' not in selected_lga:
-        filtered_df = filtered_df[filtered_df['lga'].astype(str).isin(selected_lga)]
-
-    # Color mapping used for charts below.
-    injury_donut_color_map = {
-        'Non-casualty (towaway)': "#15a539",
-        'Minor/Other Injury':     "#dcac2a",
-        'Moderate Injury':        "#5BB3BC",
-        'Serious Injury':         "#45134E",
-        'Fatal':                  "#ce0e25",
-    }
+    return filter_key(selected_range, {
+        'weather': selected_weather,
+        'surface_condition': selected_surface_condition,
+        'lga': selected_lga,
+    }, selection_area(selected_area), selected_charts)
 
-    map_color_map = {
-        'Non-casualty (towaway)': "#2ca02c",
-        'Injury':                 "#9467bd",
-        'Fatal':                  "#ce0e25",
-    }
 
-    map_fig = px.scatter_map(
-        filtered_df,
-        lat='latitude',
-        lon='longitude',
-        hover_name='degree_of_crash_detailed',
-        # color markers by the degree_of_crash column
-        #color='degree_of_crash',
-        #color_discrete_map=map_color_map,
-        zoom=12,
-        center={'lat': -33.871, 'lon': 151.195},
-        custom_data=['year_of_crash', 'weather', 'no_killed', 'no_total_injured'],
-        opacity=0.3,
-    )
+# Every chart callback for one filter state shares a single selection.
+def selected_cells(data, key):
+    if key_area(key) is None:
+        return filter_cells(data, key)
+    return area_cells(data, key)
 
-    # Define a hovertemplate with human-readable labels. Use <extra></extra> to remove the trace name box.
-    map_hover_template = (
-         "<b>%{hovertext}</b><br><br>"
-         "Year of crash: <b><span style='font-size:16px'>%{customdata[0]}</span></b><br>"
-         "Weather: <b><span style='font-size:16px'>%{customdata[1]}</span></b><br>"
-         "<b><span style='font-size:16px'>%{customdata[2]}</span></b> killed<br>"
-         "<b><span style='font-size:16px'>%{customdata[3]}</span></b> injured<br>"
-         "<extra></extra>"
-    )
 
-    # Apply hovertemplate to all traces
-    for trace in map_fig.data:
-        trace.hovertemplate = map_hover_template
+@lru_cache(maxsize=128)
+@timed('filter')
+def filter_cells(data, key):
+    charts = key_charts(key)
+    if charts is not None:
+        # Chart filters move the cross-filter of the state without them.
+        cells = crossfilter(data, base_key(key)).select(charts)
+        rows_selected.observe(cells.totals()['crashes'], kind='crossfilter')
+        return cells
+    cells = data.cube.select(*key_filters(key))
+    rows_selected.observe(cells.totals()['crashes'], kind='cube')
+    return cells
 
-    map_fig.update_layout(
-        mapbox_style='open-street-map', 
-        transition_duration=500, 
-        showlegend=False,
-        height=350,
-        autosize=True
+
+# A selection in a map area holds the rows of its crashes, up to every row of
+# the dataset for a statewide box, so only the last few are kept.
+@lru_cache(maxsize=4)
+@timed('filter')
+def area_cells(data, key):
+    charts = key_charts(key)
+    if charts is not None:
+        cells = crossfilter(data, base_key(key)).select(charts, rows=True)
+        rows_selected.observe(cells.totals()['crashes'], kind='crossfilter')
+        return cells
+    return area_selection(data, key)
+
+
+def area_selection(data, key):
+    # The crashes in the key's area that pass its dropdown and chart filters.
+    # Cube cells do not split by area: filter the crashes inside it instead.
+    rows = data.spatial.query(key_area(key))
+    rows = rows[matching(data, key, rows)]
+    rows_selected.observe(len(rows), kind='area')
+    return RowSlice(data.cube, data.store, rows)
+
+
+# One cross-filter per dataset version and filter state without chart
+# filters, shared by every page on that state: a click on a chart then only
+# adds or takes the crashes of the slice clicked (see nswcrash.crossfilter).
+@lru_cache(maxsize=4)
+@timed('filter')
+def crossfilter(data, key):
+    if key_area(key) is None:
+        rows = data.index.select(*key_filters(key))
+    else:
+        rows = selected_cells(data, key).rows
+    return CrossFilter(data.cube, data.store, rows)
+
+
+def is_initial_call():
+    # Dash fires each callback once on page load without a triggering input.
+    # That call sends the full figure; later calls only patch its data arrays.
+    return ctx.triggered_id is None
+
+
+def cached_output(render, key, initial=False, count=True, dataset=None, data=None, queued=False, client=None):
+    # Rendered results are cached per output, dataset, filter state and render
+    # mode, in the dataset's namespace of the cache. The key also holds the
+    # settings renders read from the environment, as workers sharing an
+    # on-disk cache may be configured differently.
+    dataset = page_dataset(dataset)
+    if data is None:
+        data = datasets.data(dataset)
+    cache = datasets.cache(dataset)
+    cache_key = [render.__name__, initial, data.version, key, trend_excluded_years, clientside_rows]
+    if not (queued and render_queue.running):
+        return cache.get_or_build(cache_key, lambda: render(data, key, initial), count)
+    # Queued builds run in a render process; each chart of a page keeps only
+    # its newest pending build.
+    slot = (client, render.__name__) if client else None
+    return cache.get_or_build(
+        cache_key,
+        lambda: queued_render(slot, render, dataset, data, key, initial),
+        count,
+        serialized=True,
     )
-    map_fig.update_layout(margin={'r':0,'t':0,'l':0,'b':0})
-
-    # Build Degree of Crash distribution and convert to percentage-based pie chart.
-    pie_desired_order = ['Non-casualty (towaway)', 'Minor/Other Injury', 'Moderate Injury', 'Serious Injury', 'Fatal']
-
-    # Mapping for concise labels
-    label_mapping = {
-        'Non-casualty (towaway)': 'Non-casualty',
-        'Minor/Other Injury': 'Minor',
-        'Moderate Injury': 'Moderate',
-        'Serious Injury': 'Serious',
-        'Fatal': 'Fatal',
-    }
 
+
+def queued_render(slot, render, dataset, data, key, initial):
+    try:
+        with stage('queue', render.__name__):
+            serialized, metrics = render_queue.run(slot, render_in_process, render, dataset, data.version, key, initial)
+        # Count the render process's stages and selections as this worker's.
+        registry.merge(metrics)
+    except (TimeoutError, BrokenProcessPool):
+        # The processes are stuck behind other builds, or gone.
+        serialized = None
+    if serialized is None:
+        # The render processes cannot read this version of the dataset.
+        serialized = to_json_plotly(render(data, key, initial))
+    return serialized
+
+
+def render_in_process(render, dataset, version, key, initial):
+    # Runs in a render process. Returns the figure's JSON (None if it cannot
+    # read that version of the dataset) and the metrics recorded building it,
+    # as only the worker's are scraped.
+    data = render_process_data(dataset, version)
+    serialized = None if data is None else to_json_plotly(render(data, key, initial))
+    return serialized, registry.take()
+
+
+def render_process_data(dataset, version):
+    # The render processes are forked once, so they load the datasets and
+    # extracts the worker moved on to since then from the snapshots
+    # themselves. They go through the reloaders, not the registry, whose
+    # listeners act on the worker's caches. Under CRASH_DATASET_MAX_BYTES a
+    # render process holds one dataset at a time.
+    reloader = datasets[dataset]
+    data = reloader.loaded_data()
+    if data is not None and data.version == version:
+        return data
+    manifest = reloader.snapshot_manifest()
+    if manifest is None or manifest['source']['sha1'][:12] != version:
+        # The snapshot on disk is not (or no longer) that version.
+        return None
+    if datasets.max_bytes:
+        for name in datasets.names:
+            datasets[name].unload()
+    reloader.unload()
+    reloader.load()
+    data = reloader.loaded_data()
+    return data if data.version == version else None
+
+
+# Chart callbacks also read the page's session id, which names their queue
+# slots, and its dataset.
+chart_inputs = filter_inputs + [area_input, chart_filters_input, State('session-id', 'data'), dataset_state]
+
+# The KPI cards, trend chart and degree pie follow the server-filters store
+# instead of the controls. The browser copies the filter state into the store
+# only when the crash cells it was sent do not cover that state; otherwise it
+# recomputes those outputs itself.
+server_filter_inputs = [Input('server-filters', 'data')]
+
+# CRASH_CLIENTSIDE_ROWS is the most crashes a selection may hold for its cells
+# to be sent to the browser; 0 keeps all filtering on the server.
+clientside_rows = int(os.environ.get('CRASH_CLIENTSIDE_ROWS', 20000))
+
+
+def chart_output(render, selected_range, selected_weather, selected_surface_condition, selected_lga, selected_area,
+                 selected_charts, session_id, dataset):
+    key = current_filter_key(selected_range, selected_weather, selected_surface_condition, selected_lga, selected_area,
+                             selected_charts)
+    try:
+        return cached_output(render, key, is_initial_call(), dataset=dataset, queued=True, client=session_id)
+    except Superseded:
+        # The filters changed again before this state was built.
+        raise PreventUpdate
+
+
+# Color mapping used for charts below.
+injury_donut_color_map = {
+    'Non-casualty (towaway)': "#15a539",
+    'Minor/Other Injury':     "#dcac2a",
+    'Moderate Injury':        "#5BB3BC",
+    'Serious Injury':         "#45134E",
+    'Fatal':                  "#ce0e25",
+}
+
+map_color_map = {
+    'Non-casualty (towaway)': "#2ca02c",
+    'Injury':                 "#9467bd",
+    'Fatal':                  "#ce0e25",
+}
+
+# Build Degree of Crash distribution and convert to percentage-based pie chart.
+pie_desired_order = ['Non-casualty (towaway)', 'Minor/Other Injury', 'Moderate Injury', 'Serious Injury', 'Fatal']
+
+# Mapping for concise labels
+label_mapping = {
+    'Non-casualty (towaway)': 'Non-casualty',
+    'Minor/Other Injury': 'Minor',
+    'Moderate Injury': 'Moderate',
+    'Serious Injury': 'Serious',
+    'Fatal': 'Fatal',
+}
+
+# Filter data to exclude Unknown and only include 40-110 km/h
+speed_limits_to_include = ['40 km/h', '50 km/h', '60 km/h', '70 km/h', '80 km/h', '90 km/h', '100 km/h', '110 km/h']
+
+# CRASH_TREND_EXCLUDED_YEARS lists years (comma-separated) whose data is not
+# comparable with the rest, e.g. a partial first year. The trend chart leaves
+# them out at every granularity; an empty list keeps every year.
+trend_excluded_years = [int(year) for year in os.environ.get('CRASH_TREND_EXCLUDED_YEARS', '2018').split(',') if year.strip()]
+
+# Trend chart granularities and their axis titles; the finer ones are the
+# time bins of nswcrash.store.TIME_COLUMNS.
+trend_granularities = {'year': 'Year', 'month': 'Month', 'weekday': 'Day of week', 'hour': 'Time of day'}
+
+# Mapping for region labels
+region_label_mapping = {
+    'Syd-Newc-Woll Gtr conurbation': 'Metropolitan',
+    'Rest of NSW - Rural': 'Rural',
+    'Rest of NSW - Urban': 'Urban'
+}
+
+
+@timed('aggregate')
+def indicators(data, key, initial):
+    # Calculate key indicators
+    totals = selected_cells(data, key).totals()
+    total_accidents = totals['crashes']
+    passengers_involved = totals['no_of_traffic_units_involved']
+    moderately_injured = totals['no_moderately_injured']
+    seriously_injured = totals['no_seriously_injured']
+    killed = totals['no_killed']
+
+    return f"{total_accidents:,}", f"{passengers_involved:,}", f"{moderately_injured:,}", f"{seriously_injured:,}", f"{killed:,}"
+
+
+@callback(
+    Output('total-accidents', 'children'),
+    Output('passengers-involved', 'children'),
+    Output('moderately-injured', 'children'),
+    Output('seriously-injured', 'children'),
+    Output('killed', 'children'),
+    *server_filter_inputs,
+    dataset_state
+)
+
+def update_indicators(server_filters, dataset):
+    return cached_output(indicators, current_filter_key(*server_filters), dataset=dataset)
+
+
+def chart_selection(key, name):
+    # The categories of name clicked on its chart, or None.
+    charts = key_charts(key)
+    return None if charts is None else charts[name]
+
+
+def selected_opacity(categories, selected):
+    # Bars of the categories clicked stay opaque, the others fade, while any are.
+    if not selected:
+        return np.ones(len(categories))
+    return np.where(np.isin(categories, selected), 1.0, 0.35)
+
+
+@timed('aggregate')
+def degree_chart_data(cells):
     # Compute counts and reindex to ensure all categories appear in the desired order
-    degree_of_crash_counts = filtered_df['degree_of_crash_detailed'].value_counts().reindex(pie_desired_order, fill_value=0)
+    degree_of_crash_counts = cells.counts('degree_of_crash_detailed').reindex(pie_desired_order, fill_value=0)
     crash_distribution = (degree_of_crash_counts.rename_axis('degree_of_crash_detailed').reset_index(name='count'))
-    
+
     # Map to concise labels
     crash_distribution['label'] = crash_distribution['degree_of_crash_detailed'].map(label_mapping)
+    return crash_distribution
+
 
+# The *_figure functions only run to build the chart templates (see
+# below), so Plotly's figure modules are imported there, not at start-up.
+def degree_chart_figure(crash_distribution):
+    import plotly.express as px # type: ignore
     injury_donut_fig = px.pie(
         crash_distribution,
         names='label',
@@ -319,33 +688,51 @@ def update_figure(selected_range, selected_weather, selected_surface_condition,
 
     # Slightly pull all slices to match prior behaviour
     injury_donut_fig.update_traces(
-        textinfo='percent+label', 
+        textinfo='percent+label',
         pull=[0.05] * len(pie_desired_order),
         hovertemplate=pie_hover_template
     )
     # Disable legend and keep existing donut hole/margins
     injury_donut_fig.update_layout(
-        showlegend=False, 
+        showlegend=False,
         margin={'r':0,'t':40,'l':0,'b':0},
         height=350,
         autosize=True
     )
+    return injury_donut_fig
 
-    # Calculate key indicators
-    total_accidents = len(filtered_df)
-    passengers_involved = int(filtered_df['no_of_traffic_units_involved'].sum())
-    moderately_injured = int(filtered_df['no_moderately_injured'].sum())
-    seriously_injured = int(filtered_df['no_seriously_injured'].sum())
-    killed = int(filtered_df['no_killed'].sum())
 
-    # Create trend chart (dual axis line chart)
-    # Group by year and calculate totals, excluding 2018
-    trend_data = filtered_df[filtered_df['year_of_crash'] != 2018].groupby('year_of_crash').agg({
-        'crash_id': 'count',
-        'no_killed': 'sum'
-    }).reset_index()
+def degree_chart(data, key, initial):
+    crash_distribution = degree_chart_data(selected_cells(data, key))
+    # Slices are always the same five degrees in the same order; those
+    # clicked are pulled further out.
+    selected = chart_selection(key, 'degree_of_crash_detailed')
+    return degree_chart_template.render(
+        initial,
+        values=crash_distribution['count'].to_numpy(),
+        pull=[0.15 if selected and degree in selected else 0.05 for degree in pie_desired_order],
+    )
+
+
+@callback(Output('degree-pie-chart', 'figure'), *server_filter_inputs, State('session-id', 'data'), dataset_state)
+
+def update_degree_chart(server_filters, session_id, dataset):
+    return chart_output(degree_chart, *server_filters, session_id, dataset)
+
+
+@timed('aggregate')
+def trend_chart_data(cells):
+    # Group by year and calculate totals, without the excluded years
+    trend_data = cells.by_year()
+    trend_data = trend_data[~trend_data['year_of_crash'].isin(trend_excluded_years)]
     trend_data.columns = ['Year', 'Total Accidents', 'People Killed']
+    return trend_data
+
 
+def trend_chart_figure(trend_data):
+    import plotly.graph_objects as go # type: ignore
+    from plotly.subplots import make_subplots # type: ignore
+    # Create trend chart (dual axis line chart)
     # Create figure with secondary y-axis
     trend_fig = make_subplots(specs=[[{"secondary_y": True}]])
 
@@ -378,7 +765,7 @@ def update_figure(selected_range, selected_weather, selected_surface_condition,
     )
 
     # Update axes
-    trend_fig.update_xaxes(title_text="Year", gridcolor='#e0e0e0')
+    trend_fig.update_xaxes(title_text="Year", type='linear', gridcolor='#e0e0e0')
     trend_fig.update_yaxes(title_text="Total Accidents", secondary_y=False, gridcolor='#e0e0e0')
     trend_fig.update_yaxes(title_text="People Killed", secondary_y=True, gridcolor='#e0e0e0')
 
@@ -396,28 +783,164 @@ def update_figure(selected_range, selected_weather, selected_surface_condition,
         hovermode='x unified',
         plot_bgcolor='white'
     )
+    return trend_fig
 
-    # Create speed limit vs accidents chart (dual axis)
-    # Filter data to exclude Unknown and only include 40-110 km/h
-    speed_limits_to_include = ['40 km/h', '50 km/h', '60 km/h', '70 km/h', '80 km/h', '90 km/h', '100 km/h', '110 km/h']
-    speed_filtered_df = filtered_df[filtered_df['speed_limit'].isin(speed_limits_to_include)].copy()
-    
-    # Group by speed limit and calculate total accidents and death rate
-    speed_limit_data = speed_filtered_df.groupby('speed_limit').agg({
-        'crash_id': 'count',
-        'no_killed': 'sum',
-        'no_of_traffic_units_involved': 'sum'
-    }).reset_index()
+
+def trend_chart(data, key, initial):
+    trend_data = trend_chart_data(selected_cells(data, key))
+    years = trend_data['Year'].to_numpy()
+    # The axis is set too, as a patch may follow a finer granularity.
+    return trend_chart_template.render(
+        initial,
+        x_title=trend_granularities['year'],
+        x_type='linear',
+        accidents_x=years,
+        accidents_y=trend_data['Total Accidents'].to_numpy(),
+        killed_x=years,
+        killed_y=trend_data['People Killed'].to_numpy(),
+    )
+
+
+@timed('aggregate')
+def time_trend_chart_data(cells, name):
+    # Totals per bin of a time column (month, weekday or two-hour interval)
+    # over the selected years, without the excluded years
+    trend_data = cells.by_time(name, trend_excluded_years)
+    trend_data.columns = ['Period', 'Total Accidents', 'People Killed']
+    return trend_data
+
+
+def time_trend_chart(name, data, key, initial):
+    trend_data = time_trend_chart_data(selected_cells(data, key), name)
+    periods = trend_data['Period'].to_numpy()
+    return trend_chart_template.render(
+        initial,
+        x_title=trend_granularities[name],
+        x_type='category',
+        accidents_x=periods,
+        accidents_y=trend_data['Total Accidents'].to_numpy(),
+        killed_x=periods,
+        killed_y=trend_data['People Killed'].to_numpy(),
+    )
+
+
+# One render per granularity, so each is cached (and queued) on its own.
+def month_trend_chart(data, key, initial):
+    return time_trend_chart('month', data, key, initial)
+
+
+def weekday_trend_chart(data, key, initial):
+    return time_trend_chart('weekday', data, key, initial)
+
+
+def hour_trend_chart(data, key, initial):
+    return time_trend_chart('hour', data, key, initial)
+
+
+trend_renders = {'year': trend_chart, 'month': month_trend_chart, 'weekday': weekday_trend_chart,
+                 'hour': hour_trend_chart}
+
+
+# Changing the granularity rebuilds the trend for the filter state shown, so
+# the filters are read from the controls; the server-filters store only
+# triggers the call (see the clientside callback below).
+@callback(Output('trend-chart', 'figure'), *server_filter_inputs, Input('trend-granularity', 'value'), *filter_states,
+          State('session-id', 'data'), dataset_state)
+
+def update_trend_chart(server_filters, granularity, *filters):
+    return chart_output(trend_renders.get(granularity, trend_chart), *filters)
+
+
+@timed('aggregate')
+def client_cells(data, key, initial):
+    # The selected cube cells as columns, for the browser to filter the KPI
+    # cards, trend chart and degree pie from while the selection stays
+    # within this filter state. None when the selection is too large, or
+    # narrowed by a map area or chart filters.
+    if key_area(key) is not None or key_charts(key) is not None:
+        return None
+    cells = selected_cells(data, key)
+    if cells.totals()['crashes'] > clientside_rows:
+        return None
+    degree_measure = ('degree_of_crash_detailed', 'crashes')
+    columns = cells.cells(('crashes',) + SUM_COLUMNS + (degree_measure,))
+    degree_labels = list(data.cube.group_labels['degree_of_crash_detailed'])
+    year_range, selections = key_filters(key)
+    return {
+        'years': year_range,
+        'selections': {name: None if values is None else list(values) for name, values in selections.items()},
+        'labels': {name: list(data.cube.labels[name]) for name in FILTER_COLUMNS},
+        'cells': {
+            'year': columns['year_of_crash'].tolist(),
+            **{name: columns[name].tolist() for name in FILTER_COLUMNS},
+            **{name: columns[name].tolist() for name in ('crashes',) + SUM_COLUMNS},
+        },
+        # Crashes per degree, in the pie's slice order
+        'degrees': [
+            columns[degree_measure][:, degree_labels.index(degree)].tolist() if degree in degree_labels
+            else [0] * len(columns['crashes'])
+            for degree in pie_desired_order
+        ],
+        'trend_excluded_years': trend_excluded_years,
+    }
+
+
+@callback(Output('client-cells', 'data'), *server_filter_inputs, dataset_state)
+
+def update_client_cells(server_filters, dataset):
+    return cached_output(client_cells, current_filter_key(*server_filters), dataset=dataset)
+
+
+# Filter changes go through assets/clientside.js first. It fills the KPI
+# cards, trend chart and degree pie from client-cells when those cells cover
+# the new state and were sent for the state the server last had, else hands
+# the new state to the server through server-filters (always while chart
+# filters are set).
+# While the year slider is dragged it only updates outputs it can fill itself.
+clientside_callback(
+    ClientsideFunction(namespace='crash', function_name='filterCells'),
+    Output('server-filters', 'data'),
+    Output('total-accidents', 'children', allow_duplicate=True),
+    Output('passengers-involved', 'children', allow_duplicate=True),
+    Output('moderately-injured', 'children', allow_duplicate=True),
+    Output('seriously-injured', 'children', allow_duplicate=True),
+    Output('killed', 'children', allow_duplicate=True),
+    Output('trend-chart', 'figure', allow_duplicate=True),
+    Output('degree-pie-chart', 'figure', allow_duplicate=True),
+    *filter_inputs,
+    area_input,
+    chart_filters_input,
+    Input('year-slider', 'drag_value'),
+    State('client-cells', 'data'),
+    State('server-filters', 'data'),
+    State('trend-chart', 'figure'),
+    State('degree-pie-chart', 'figure'),
+    State('trend-granularity', 'value'),
+    prevent_initial_call=True,
+)
+
+
+@timed('aggregate')
+def speed_limit_chart_data(cells):
+    import pandas as pd # type: ignore
+    # Total accidents, killed and passengers per speed limit from the cube
+    speed_limit_data = cells.group('speed_limit')
+    speed_limit_data = speed_limit_data[speed_limit_data.index.isin(speed_limits_to_include)].reset_index()
     speed_limit_data.columns = ['Speed Limit', 'Total Accidents', 'Killed', 'Passengers Involved']
-    
+
     # Calculate death rate (killed per passengers involved, as percentage)
     speed_limit_data['Death Rate'] = (speed_limit_data['Killed'] / speed_limit_data['Passengers Involved'] * 100).fillna(0)
-    
+
     # Sort by speed limit value for proper ordering
     speed_order = ['40 km/h', '50 km/h', '60 km/h', '70 km/h', '80 km/h', '90 km/h', '100 km/h', '110 km/h']
     speed_limit_data['Speed Limit'] = pd.Categorical(speed_limit_data['Speed Limit'], categories=speed_order, ordered=True)
-    speed_limit_data = speed_limit_data.sort_values('Speed Limit')
+    return speed_limit_data.sort_values('Speed Limit')
 
+
+def speed_limit_chart_figure(speed_limit_data):
+    import plotly.graph_objects as go # type: ignore
+    from plotly.subplots import make_subplots # type: ignore
+    # Create speed limit vs accidents chart (dual axis)
     # Create figure with secondary y-axis
     speed_limit_fig = make_subplots(specs=[[{"secondary_y": True}]])
 
@@ -428,6 +951,7 @@ def update_figure(selected_range, selected_weather, selected_surface_condition,
             y=speed_limit_data['Total Accidents'],
             name='Total Accidents',
             marker_color='#86a8da',
+            marker_opacity=1,
             hovertemplate='<br>Accidents: <b><span style="font-size:15px">%{y:,}</span></b><extra></extra>'
         ),
         secondary_y=False
@@ -466,16 +990,43 @@ def update_figure(selected_range, selected_weather, selected_surface_condition,
         hovermode='x unified',
         plot_bgcolor='white'
     )
+    return speed_limit_fig
 
+
+def speed_limit_chart(data, key, initial):
+    speed_limit_data = speed_limit_chart_data(selected_cells(data, key))
+    speed_limits = speed_limit_data['Speed Limit'].astype(str).to_numpy()
+    return speed_limit_chart_template.render(
+        initial,
+        accidents_x=speed_limits,
+        accidents_y=speed_limit_data['Total Accidents'].to_numpy(),
+        death_rate_x=speed_limits,
+        death_rate_y=speed_limit_data['Death Rate'].to_numpy(),
+        opacity=selected_opacity(speed_limits, chart_selection(key, 'speed_limit')),
+    )
+
+
+@callback(Output('speed-limit-chart', 'figure'), *chart_inputs)
+
+def update_speed_limit_chart(*filters):
+    return chart_output(speed_limit_chart, *filters)
+
+
+@timed('aggregate')
+def location_chart_data(cells):
     # Create location type bar chart (Top 5)
-    location_counts = filtered_df['type_of_location'].value_counts().head(5).reset_index()
+    location_counts = cells.counts('type_of_location').head(5).reset_index()
     location_counts.columns = ['Location Type', 'Count']
     location_counts = location_counts.sort_values('Count', ascending=True)  # Sort for better visualization
 
     # Calculate percentages
     total_location = location_counts['Count'].sum()
     location_counts['Percentage'] = (location_counts['Count'] / total_location * 100).round(1)
+    return location_counts
 
+
+def location_chart_figure(location_counts):
+    import plotly.express as px # type: ignore
     location_bar_fig = px.bar(
         location_counts,
         y='Location Type',
@@ -495,6 +1046,7 @@ def update_figure(selected_range, selected_weather, selected_surface_condition,
     location_bar_fig.update_traces(
         hovertemplate=location_hover_template,
         customdata=location_counts[['Percentage']].values,
+        marker_opacity=1,
     )
 
     location_bar_fig.update_layout(
@@ -506,24 +1058,45 @@ def update_figure(selected_range, selected_weather, selected_surface_condition,
         xaxis=dict(gridcolor='#e0e0e0', title='Number of Accidents'),
         yaxis=dict(title='')
     )
+    return location_bar_fig
+
+
+def location_chart(data, key, initial):
+    location_counts = location_chart_data(selected_cells(data, key))
+    location_types = location_counts['Location Type'].to_numpy()
+    return location_chart_template.render(
+        initial,
+        x=location_counts['Count'].to_numpy(),
+        y=location_types,
+        text=location_counts['Count'].to_numpy(),
+        customdata=location_counts[['Percentage']].values,
+        opacity=selected_opacity(location_types, chart_selection(key, 'type_of_location')),
+    )
+
+
+@callback(Output('location-bar-chart', 'figure'), *chart_inputs)
+
+def update_location_chart(*filters):
+    return chart_output(location_chart, *filters)
+
 
+@timed('aggregate')
+def conurbation_chart_data(cells):
     # Create conurbation donut chart
     # Filter out 'Rest of NSW - Unknown' and create mapping for labels
-    conurbation_df = filtered_df[filtered_df['conurbation_1'] != 'Rest of NSW - Unknown'].copy()
-    
-    # Mapping for region labels
-    region_label_mapping = {
-        'Syd-Newc-Woll Gtr conurbation': 'Metropolitan',
-        'Rest of NSW - Rural': 'Rural',
-        'Rest of NSW - Urban': 'Urban'
-    }
-    
-    conurbation_counts = conurbation_df['conurbation_1'].value_counts().reset_index()
+    conurbation_counts = cells.counts('conurbation_1')
+    conurbation_counts = conurbation_counts[conurbation_counts.index != 'Rest of NSW - Unknown']
+
+    conurbation_counts = conurbation_counts.reset_index()
     conurbation_counts.columns = ['Region', 'Count']
-    
+
     # Apply label mapping
     conurbation_counts['Label'] = conurbation_counts['Region'].map(region_label_mapping).fillna(conurbation_counts['Region'])
+    return conurbation_counts
+
 
+def conurbation_chart_figure(conurbation_counts):
+    import plotly.express as px # type: ignore
     conurbation_donut_fig = px.pie(
         conurbation_counts,
         names='Label',
@@ -552,12 +1125,540 @@ def update_figure(selected_range, selected_weather, selected_surface_condition,
         height=350,
         autosize=True
     )
+    return conurbation_donut_fig
+
+
+def conurbation_chart(data, key, initial):
+    conurbation_counts = conurbation_chart_data(selected_cells(data, key))
+    selected = chart_selection(key, 'conurbation_1')
+    return conurbation_chart_template.render(
+        initial,
+        labels=conurbation_counts['Label'].to_numpy(),
+        values=conurbation_counts['Count'].to_numpy(),
+        pull=[0.15 if selected and region in selected else 0.05 for region in conurbation_counts['Region']],
+    )
+
+
+@callback(Output('conurbation-donut-chart', 'figure'), *chart_inputs)
+
+def update_conurbation_chart(*filters):
+    return chart_output(conurbation_chart, *filters)
+
+
+# The chart each clicked graph filters by, its name in the summary, and the
+# category of a clicked point: pie slices carry their concise label, the
+# speed limit bars their x value and the location bars their y value.
+chart_filter_graphs = {
+    'degree-pie-chart': ('degree_of_crash_detailed', 'Injury',
+                         lambda point: {v: k for k, v in label_mapping.items()}.get(point.get('label'))),
+    'conurbation-donut-chart': ('conurbation_1', 'Region',
+                                lambda point: {v: k for k, v in region_label_mapping.items()}.get(
+                                    point.get('label'), point.get('label'))),
+    'speed-limit-chart': ('speed_limit', 'Speed limit', lambda point: point.get('x')),
+    'location-bar-chart': ('type_of_location', 'Location', lambda point: point.get('y')),
+}
+
+
+def chart_filters_summary(chart_filters):
+    # e.g. 'Injury: Fatal, Serious · Speed limit: 60 km/h'
+    titles = {name: title for name, title, _ in chart_filter_graphs.values()}
+    labels = {**label_mapping, **region_label_mapping}
+    return ' · '.join(
+        '{}: {}'.format(titles[name], ', '.join(labels.get(value, value) for value in chart_filters[name]))
+        for name in CHART_FILTER_COLUMNS if chart_filters.get(name)
+    )
+
+
+# A click on a slice or bar adds its category to that chart's filter, or
+# takes it out again; Clear drops them all. Each chart keeps showing all of
+# its own categories, with the clicked ones highlighted, while the others
+# narrow to them.
+@callback(
+    Output('chart-filters', 'data'),
+    Output('chart-filters-summary', 'children'),
+    Output('chart-filters-row', 'style'),
+    *[Input(graph, 'clickData') for graph in chart_filter_graphs],
+    Input('clear-chart-filters', 'n_clicks'),
+    State('chart-filters', 'data'),
+    prevent_initial_call=True,
+)
+
+def toggle_chart_filter(*args):
+    chart_filters = dict(args[-1] or {})
+    if ctx.triggered_id == 'clear-chart-filters':
+        chart_filters = {}
+    elif ctx.triggered_id in chart_filter_graphs:
+        name, _, category = chart_filter_graphs[ctx.triggered_id]
+        points = (ctx.triggered[0]['value'] or {}).get('points') or [{}]
+        value = category(points[0])
+        if value is None:
+            raise PreventUpdate
+        selected = set(chart_filters.get(name) or ()) ^ {value}
+        chart_filters.pop(name, None)
+        if selected:
+            chart_filters[name] = sorted(selected)
+    else:
+        raise PreventUpdate
+    return chart_filters, chart_filters_summary(chart_filters), {'display': 'flex' if chart_filters else 'none'}
+
+@callback(Output('map-chart', 'figure'), *filter_inputs, chart_filters_input, dataset_state)
+def update_map(selected_range, selected_weather, selected_surface_condition, selected_lga, selected_charts, dataset):
+    # The map draws crashes from the vector tiles served by /tiles, so a
+    # filter change only points the tile layer at a new URL; the browser
+    # then fetches just the tiles on screen.
+    dataset = page_dataset(dataset)
+    key = current_filter_key(selected_range, selected_weather, selected_surface_condition, selected_lga,
+                             selected_charts=selected_charts)
+    tile_url = (public_url or request.url_root) + 'tiles/{z}/{x}/{y}?' + tile_query(dataset, datasets.data(dataset), key)
+    return map_chart_template.render(is_initial_call(), source=[tile_url])
+
+
+def tile_query(dataset, data, key):
+    # Dataset and filter state as /tiles query parameters. The dataset
+    # version makes the URL change with the data, so tiles can be cached for
+    # long.
+    year_range, selections = key_filters(key)
+    params = [('dataset', dataset), ('years', '{}-{}'.format(*year_range)), ('v', data.version)]
+    for name, values in selections.items():
+        params.extend((name, value) for value in values or ())
+    for name, values in (key_charts(key) or {}).items():
+        params.extend((name, value) for value in values or ())
+    return urlencode(params)
 
-    return map_fig, injury_donut_fig, trend_fig, speed_limit_fig, location_bar_fig, conurbation_donut_fig, f"{total_accidents:,}", f"{passengers_involved:,}", f"{moderately_injured:,}", f"{seriously_injured:,}", f"{killed:,}"
 
-@app.server.route('/assets/nsw.svg')
+def map_chart_figure(tile_url):
+    import plotly.graph_objects as go # type: ignore
+    # The crashes are a circle layer over the base map; the empty trace only
+    # makes plotly draw the map itself.
+    map_fig = go.Figure(go.Scattermap(lat=[], lon=[], mode='markers', hoverinfo='skip'))
+    map_fig.update_layout(
+        map=dict(
+            center=map_initial_view['center'],
+            zoom=map_initial_view['zoom'],
+            layers=[dict(
+                sourcetype='vector',
+                source=[tile_url],
+                sourcelayer=TILE_LAYER,
+                type='circle',
+                color='#ce0e25',
+                opacity=0.3,
+                circle=dict(radius=3),
+            )],
+        ),
+        mapbox_style='open-street-map',
+        showlegend=False,
+        height=350,
+        autosize=True,
+        margin={'r':0,'t':0,'l':0,'b':0},
+        # The empty trace gives plotly no points to select, so it leaves the
+        # box and lasso tools off the map's modebar unless asked for; dragging
+        # still pans until one of them is picked
+        modebar_add=['select2d', 'lasso2d'],
+        # Keep the user's pan/zoom when the tile source changes
+        uirevision='map',
+    )
+    return map_fig
+
+
+@lru_cache(maxsize=1024)
+@timed('tile')
+def render_tile(data, key, z, x, y):
+    return data.tiles.render(z, x, y, match=lambda rows: matching(data, key, rows))
+
+
+def matching(data, key, rows):
+    # Which of rows pass the key's dropdown and chart filters (not its area).
+    matched = data.index.contains(rows, *key_filters(key))
+    charts = key_charts(key)
+    if charts is not None:
+        matched &= chart_mask(data.store, rows, charts)
+    return matched
+
+
+# Chart skeletons: the figure functions above run once, through Plotly's
+# validation, on the statewide selection. Requests only fill in their arrays.
+# They are built once the data is loaded (see data_loaded), not at import.
+def statewide_key(data):
+    return filter_key([data.index.years[0], data.index.years[-1]], {})
+
+
+def statewide_cells():
+    data = datasets.data()
+    return selected_cells(data, statewide_key(data))
+
+
+degree_chart_template = FigureTemplate(
+    degree_chart_figure, lambda: degree_chart_data(statewide_cells()),
+    values=('data', 0, 'values'), pull=('data', 0, 'pull'),
+)
+trend_chart_template = FigureTemplate(
+    trend_chart_figure, lambda: trend_chart_data(statewide_cells()),
+    x_title=('layout', 'xaxis', 'title', 'text'), x_type=('layout', 'xaxis', 'type'),
+    accidents_x=('data', 0, 'x'), accidents_y=('data', 0, 'y'),
+    killed_x=('data', 1, 'x'), killed_y=('data', 1, 'y'),
+)
+speed_limit_chart_template = FigureTemplate(
+    speed_limit_chart_figure, lambda: speed_limit_chart_data(statewide_cells()),
+    accidents_x=('data', 0, 'x'), accidents_y=('data', 0, 'y'),
+    death_rate_x=('data', 1, 'x'), death_rate_y=('data', 1, 'y'), opacity=('data', 0, 'marker', 'opacity'),
+)
+location_chart_template = FigureTemplate(
+    location_chart_figure, lambda: location_chart_data(statewide_cells()),
+    x=('data', 0, 'x'), y=('data', 0, 'y'), text=('data', 0, 'text'), customdata=('data', 0, 'customdata'),
+    opacity=('data', 0, 'marker', 'opacity'),
+)
+conurbation_chart_template = FigureTemplate(
+    conurbation_chart_figure, lambda: conurbation_chart_data(statewide_cells()),
+    labels=('data', 0, 'labels'), values=('data', 0, 'values'), pull=('data', 0, 'pull'),
+)
+map_chart_template = FigureTemplate(map_chart_figure, '', source=('layout', 'map', 'layers', 0, 'source'))
+chart_templates = (degree_chart_template, trend_chart_template, speed_limit_chart_template,
+                   location_chart_template, conurbation_chart_template, map_chart_template)
+
+chart_renders = (degree_chart, trend_chart, speed_limit_chart, location_chart, conurbation_chart)
+
+
+def prewarm_keys(data, n_lgas):
+    # The states users hit most: everything, the last five years, and each of
+    # the largest councils on its own.
+    first_year, last_year = int(data.index.years[0]), int(data.index.years[-1])
+    keys = [
+        filter_key([first_year, last_year], {}),
+        filter_key([max(first_year, last_year - 4), last_year], {}),
+    ]
+    lga_values = data.store.labels('lga')
+    lga_codes = data.store['lga']
+    lga_crashes = np.bincount(lga_codes[lga_codes >= 0], minlength=len(lga_values))
+    for code in np.argsort(-lga_crashes, kind='stable')[:n_lgas]:
+        keys.append(filter_key([first_year, last_year], {'lga': [lga_values[code]]}))
+    return keys
+
+
+def prewarm_result_cache(n_lgas, dataset=None):
+    # Render the common states of a dataset (by default the default one) into
+    # the cache without counting hits or misses.
+    data = datasets.data(dataset)
+    for key in prewarm_keys(data, n_lgas):
+        cached_output(indicators, key, count=False, dataset=dataset, data=data)
+        for initial in (True, False):
+            for render in chart_renders:
+                cached_output(render, key, initial, count=False, dataset=dataset, data=data)
+
+
+def start_prewarm(dataset=None):
+    if prewarm_lgas > 0:
+        threading.Thread(target=prewarm_result_cache, args=(prewarm_lgas, dataset), name='cache-prewarm',
+                         daemon=True).start()
+
+
+# CRASH_CACHE_PREWARM sets how many of the largest LGAs to pre-warm; 0 turns
+# pre-warming off. It runs in the background so start-up is not delayed.
+prewarm_lgas = int(os.environ.get('CRASH_CACHE_PREWARM', 10))
+
+
+def track_dataset(name, data):
+    dataset_load_seconds.set(datasets[name].load_seconds, dataset=name)
+    dataset_rows.set(len(data), dataset=name)
+    dataset_bytes.set(data.nbytes, dataset=name)
+
+
+@datasets.on_load
+def dataset_loaded(name, data):
+    track_dataset(name, data)
+    if app_ready.is_set():
+        # A dataset first shown after start-up: warm its common states.
+        start_prewarm(name)
+
+
+@datasets.on_swap
+def dataset_swapped(name, new, old):
+    # Drop selections and renders of the old extract, then warm the new one.
+    filter_cells.cache_clear()
+    area_cells.cache_clear()
+    crossfilter.cache_clear()
+    render_tile.cache_clear()
+    datasets.cache(name).clear()
+    track_dataset(name, new)
+    dataset_reloads.inc(dataset=name)
+    start_prewarm(name)
+
+
+@datasets.on_evict
+def dataset_evicted(name, old):
+    # Let go of an unloaded dataset: cached selections and tiles hold on to
+    # it. Its cached renders stay, for when it is next loaded.
+    filter_cells.cache_clear()
+    area_cells.cache_clear()
+    crossfilter.cache_clear()
+    render_tile.cache_clear()
+    dataset_rows.set(0, dataset=name)
+    dataset_bytes.set(0, dataset=name)
+    dataset_evictions.inc(dataset=name)
+
+
+# CRASH_TILE_MAX_AGE is how long (in seconds) browsers and proxies may reuse a
+# tile. Tile URLs carry the dataset version, so a reload never serves old ones.
+tile_max_age = int(os.environ.get('CRASH_TILE_MAX_AGE', 86400))
+
+# The map fetches tiles from absolute URLs, built from the address each
+# request came in at. Behind a load balancer or reverse proxy that is the
+# internal one: set CRASH_PUBLIC_URL to the address browsers use (e.g.
+# https://crashes.example.org/dashboard/), or CRASH_PROXY_HOPS to the number
+# of proxies in front whose X-Forwarded-* headers can be trusted.
+public_url = os.environ.get('CRASH_PUBLIC_URL', '').rstrip('/')
+public_url = public_url and public_url + '/'
+proxy_hops = int(os.environ.get('CRASH_PROXY_HOPS', 0))
+
+
+# CRASH_RELOAD_INTERVAL is how often (in seconds) to check the loaded
+# datasets' CSVs for new extracts and unload idle datasets over the memory
+# budget; 0 turns the watcher off (datasets are then only unloaded as others
+# load).
+reload_interval = float(os.environ.get('CRASH_RELOAD_INTERVAL', 60))
+
+
+def start_background_tasks(prewarm=True):
+    # Fork the render processes before any other thread is running (when the
+    # data loads in the background, create_app() forks them earlier still).
+    render_queue.start()
+    if prewarm:
+        start_prewarm()
+    if reload_interval > 0:
+        datasets.watch(reload_interval)
+
+
+# Set once the default dataset is loaded and the chart templates are built;
+# /ready reports it.
+app_ready = threading.Event()
+
+
+def data_loaded():
+    for template in chart_templates:
+        template.warm()
+
+
+@routes.route('/ready')
+def ready():
+    # Readiness probe: 503 until the default dataset is loaded and the chart
+    # templates are built (the page itself is served before that), then 200
+    # with the datasets loaded at the moment.
+    if not app_ready.is_set():
+        return jsonify(ready=False, loading=not datasets[None].loaded.is_set()), 503, {'Retry-After': '1'}
+    loaded = {}
+    for name in datasets.names:
+        data = datasets.loaded(name)
+        if data is not None:
+            loaded[name] = {'version': data.version, 'rows': len(data), 'bytes': data.nbytes,
+                            'load_seconds': datasets[name].load_seconds}
+    return jsonify(ready=True, default=datasets.default, datasets=loaded)
+
+@routes.route('/cache-stats')
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@routes.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    # Enabled by setting CRASH_ADMIN_TOKEN; send it as a bearer token. Only
+    # this worker reloads at once, the others follow on their next check.
+    token = os.environ.get('CRASH_ADMIN_TOKEN')
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        abort(403)
+    name = request_dataset()
+    datasets.data(name)
+    reloaded = datasets[name].reload()
+    data = datasets.data(name)
+    return jsonify(dataset=name, reloaded=reloaded, version=data.version, rows=len(data))
+
+@routes.route('/tiles/<int:z>/<int:x>/<int:y>')
+def serve_tile(z, x, y):
+    # Crash points of one map tile for the filter state in the query string.
+    if not valid_tile(z, x, y):
+        abort(404)
+    data = datasets.data(request_dataset())
+    key = request_filter_key(data)
+    etag = hashlib.sha1(repr((data.version, key, z, x, y)).encode()).hexdigest()
+    headers = {'ETag': '"{}"'.format(etag), 'Cache-Control': 'public, max-age={}'.format(tile_max_age)}
+    # Compressed tiles carry the weak form of the tag.
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    return Response(render_tile(data, key, z, x, y), mimetype='application/vnd.mapbox-vector-tile', headers=headers)
+
+def request_dataset():
+    # dataset=name picks the dataset (default: the first configured).
+    name = request.args.get('dataset') or datasets.default
+    if name not in datasets:
+        abort(404)
+    return name
+
+
+def request_filter_key(data, area=None):
+    # Filter state from the query string: years=start-end (default all),
+    # repeated weather, surface_condition and lga values, and repeated
+    # chart filter values (degree_of_crash_detailed, conurbation_1,
+    # speed_limit and type_of_location).
+    year_range = [data.index.years[0], data.index.years[-1]]
+    if 'years' in request.args:
+        try:
+            start_year, end_year = request.args['years'].split('-', 1)
+            year_range = [int(start_year), int(end_year)]
+        except ValueError:
+            abort(400)
+    return filter_key(year_range, {name: request.args.getlist(name) for name in FILTER_COLUMNS}, area,
+                      {name: request.args.getlist(name) for name in CHART_FILTER_COLUMNS})
+
+
+def request_area(required=True):
+    # One of bbox=west,south,east,north; lon, lat and radius (metres); or
+    # polygon=lon,lat,lon,lat,... In a POST the polygon may instead be the
+    # JSON body's "polygon": [[lon, lat], ...] or a GeoJSON Polygon.
+    args = request.args
+    body = request.get_json(silent=True) if request.method == 'POST' else None
+    try:
+        if 'bbox' in args:
+            return bbox_area(*[float(value) for value in args['bbox'].split(',')])
+        if 'radius' in args:
+            return radius_area(float(args['lon']), float(args['lat']), float(args['radius']))
+        if 'polygon' in args:
+            values = [float(value) for value in args['polygon'].split(',')]
+            return polygon_area(zip(values[::2], values[1::2]))
+        if isinstance(body, dict):
+            polygon = body.get('polygon') or body
+            if isinstance(polygon, dict) and polygon.get('type') == 'Polygon':
+                # The exterior ring; holes are not supported.
+                polygon = polygon['coordinates'][0]
+            return polygon_area([point[:2] for point in polygon])
+    except (KeyError, IndexError, TypeError, ValueError):
+        abort(400)
+    if required:
+        abort(400)
+    return None
+
+
+# Columns of each crash in /api/crashes responses.
+query_columns = ['crash_id', 'year_of_crash', 'latitude', 'longitude', 'degree_of_crash_detailed', 'lga', 'weather',
+                 'surface_condition', 'speed_limit', 'type_of_location', 'no_killed', 'no_total_injured']
+query_max_limit = 10000
+
+@routes.route('/api/crashes', methods=['GET', 'POST'])
+def query_crashes():
+    # Crashes inside an area under the /tiles filters: their KPI totals and
+    # up to limit (default 1000) of the crashes themselves, nearest first
+    # for a radius.
+    data = datasets.data(request_dataset())
+    area = request_area()
+    try:
+        limit = min(int(request.args.get('limit', 1000)), query_max_limit)
+    except ValueError:
+        abort(400)
+    key = request_filter_key(data, area)
+    # Any caller may send any area, so its selection is not cached.
+    with stage('filter', 'query_crashes'):
+        cells = area_selection(data, key)
+    rows = cells.rows
+    distances = None
+    if area[0] == 'radius':
+        distances = data.spatial.distances(rows, area[1], area[2])
+        order = np.argsort(distances, kind='stable')[:max(limit, 0)]
+        rows, distances = rows[order], distances[order]
+    else:
+        rows = rows[:max(limit, 0)]
+    crashes = data.store.take(rows, query_columns)
+    crashes[['latitude', 'longitude']] = crashes[['latitude', 'longitude']].astype(np.float64).round(6)
+    crashes = crashes.astype(object)
+    crashes = crashes.where(crashes.notna(), None)
+    if distances is not None:
+        crashes['distance_m'] = np.round(distances, 1)
+    return jsonify(
+        version=data.version,
+        count=len(cells.rows),
+        truncated=len(cells.rows) > len(rows),
+        totals=cells.totals(),
+        crashes=crashes.to_dict('records'),
+    )
+
+@routes.route('/export')
+def export_crashes():
+    # The crashes of a filter state (the /tiles filters, plus an optional
+    # /api/crashes area) as CSV or, with format=parquet, Parquet.
+    # columns=a,b,... picks the columns. The body is streamed a chunk of
+    # rows at a time, so memory does not grow with the selection.
+    dataset = request_dataset()
+    data = datasets.data(dataset)
+    export_format = request.args.get('format', 'csv')
+    if export_format not in export_formats():
+        abort(400)
+    try:
+        columns = export_columns(data.store, [name for name in request.args.get('columns', '').split(',') if name])
+    except ValueError:
+        abort(400)
+    key = request_filter_key(data, request_area(required=False))
+    area = key_area(key)
+    rows = None if area is None else data.spatial.query(area)
+    charts = key_charts(key)
+    match = None if charts is None else lambda rows: chart_mask(data.store, rows, charts)
+    chunks = row_chunks(data.index, *key_filters(key), rows=rows, match=match)
+    filename = '{}-crashes-{}.{}'.format(dataset, data.version, export_format)
+    return Response(
+        stream_export(data.store, chunks, columns, export_format),
+        mimetype=EXPORT_MIMETYPES[export_format],
+        headers={'Content-Disposition': 'attachment; filename="{}"'.format(filename)},
+    )
+
+@routes.route('/metrics')
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@routes.route('/assets/nsw.svg')
 def serve_nsw():
     return send_from_directory('.', 'assets/nsw.svg')
 
+
+def create_app(preload=None):
+    # Build the Dash app around the callbacks and routes above and start
+    # loading the data. By default the page is served at once, laid out from
+    # the snapshot manifest, while the data loads and the templates are built
+    # in a background thread; callbacks wait for them and /ready reports them.
+    # Threads do not survive a fork, so when gunicorn preloads this module in
+    # its master (CRASH_PRELOAD=1, see gunicorn.conf.py) the master loads in
+    # the foreground and each worker starts the background tasks instead. The
+    # master also pre-warms (always including the two statewide states): the
+    # forked workers then share the warmed cache and the plotly code paths the
+    # renders loaded rather than each building their own.
+    if preload is None:
+        preload = os.environ.get('CRASH_PRELOAD') == '1'
+    # Only the default dataset is loaded here; the others load when first
+    # shown.
+    if preload:
+        datasets.load()
+        data_loaded()
+        prewarm_result_cache(prewarm_lgas)
+        app_ready.set()
+    else:
+        def start():
+            data_loaded()
+            app_ready.set()
+            start_background_tasks()
+        render_queue.start()
+        datasets.load_in_background(then=start)
+
+    dash_app = Dash(__name__, title='NSW Road Crash Dashboard')
+    dash_app._favicon = 'favicon.ico'
+    # Dash lays the page out once here to check it: from the manifest if the
+    # snapshot is fresh, else after the load (which builds it).
+    dash_app.layout = serve_layout
+    dash_app.server.register_blueprint(routes)
+    if proxy_hops:
+        dash_app.server.wsgi_app = ProxyFix(dash_app.server.wsgi_app, x_for=proxy_hops, x_proto=proxy_hops,
+                                            x_host=proxy_hops, x_port=proxy_hops, x_prefix=proxy_hops)
+    instrument_callbacks(dash_app.server)
+    compress_responses(dash_app.server)
+    return dash_app
+
+
+app = create_app()
+server = app.server
+
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,174 @@
+/* Browser-side filtering of the KPI cards, trend chart and degree pie.
+
+   The server sends the crash cube cells of a small enough selection to the
+   client-cells store (see client_cells in app.py). Any narrower filter state
+   is then summed here from those cells; the server is only asked, through
+   the server-filters store, when the selection widens beyond them, an area
+   is selected on the map, a chart slice or bar is clicked (chart filters)
+   or the trend chart shows other than years.
+*/
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    crash: {
+        filterCells: function (yearRange, weather, surfaceCondition, lga, selectedData, chartFilters, dragRange, payload, serverFilters, trendFigure, degreeFigure, granularity) {
+            const noUpdate = window.dash_clientside.no_update;
+            const dragging = window.dash_clientside.callback_context.triggered.some(
+                (trigger) => trigger.prop_id === 'year-slider.drag_value'
+            );
+            const years = dragging && dragRange ? dragRange : yearRange;
+            const area = selectionArea(selectedData);
+            const charts = activeCharts(chartFilters);
+            const state = [yearRange, weather, surfaceCondition, lga, area, charts];
+            const selections = {weather: weather, surface_condition: surfaceCondition, lga: lga};
+
+            // Cells left from an earlier state would race the server's
+            // answer for the state it was last given.
+            // Map selections are filtered on the server, which holds the
+            // coordinates, as are chart filters, which the cells do not
+            // split by, and the cells only sum the trend by year.
+            if (area || charts || granularity !== 'year' || !isFor(payload, serverFilters) || !covers(payload, years, selections)) {
+                // A drag in progress waits for mouseup before asking the server.
+                return [dragging ? noUpdate : state].concat(Array(7).fill(noUpdate));
+            }
+
+            const cells = payload.cells;
+            const wanted = {};
+            for (const name in selections) {
+                const values = active(selections[name]);
+                if (values !== null) {
+                    const codes = values.map((value) => payload.labels[name].indexOf(value));
+                    wanted[name] = new Set(codes.filter((code) => code >= 0));
+                }
+            }
+
+            const totals = {crashes: 0, no_of_traffic_units_involved: 0, no_moderately_injured: 0,
+                            no_seriously_injured: 0, no_killed: 0};
+            const byYear = new Map();
+            const degrees = payload.degrees.map(() => 0);
+            for (let i = 0; i < cells.year.length; i++) {
+                const year = cells.year[i];
+                if (year < years[0] || year > years[1]) {
+                    continue;
+                }
+                let selected = true;
+                for (const name in wanted) {
+                    if (!wanted[name].has(cells[name][i])) {
+                        selected = false;
+                        break;
+                    }
+                }
+                if (!selected) {
+                    continue;
+                }
+                for (const measure in totals) {
+                    totals[measure] += cells[measure][i];
+                }
+                const perYear = byYear.get(year) || {crashes: 0, killed: 0};
+                perYear.crashes += cells.crashes[i];
+                perYear.killed += cells.no_killed[i];
+                byYear.set(year, perYear);
+                for (let d = 0; d < degrees.length; d++) {
+                    degrees[d] += payload.degrees[d][i];
+                }
+            }
+
+            // Years with at least one crash, as CubeSlice.by_year, less the excluded ones.
+            const trendYears = Array.from(byYear.keys())
+                .filter((year) => byYear.get(year).crashes > 0 && payload.trend_excluded_years.indexOf(year) < 0)
+                .sort((a, b) => a - b);
+            const trend = withData(trendFigure, [
+                {x: trendYears, y: trendYears.map((year) => byYear.get(year).crashes)},
+                {x: trendYears, y: trendYears.map((year) => byYear.get(year).killed)},
+            ]);
+            const degree = withData(degreeFigure, [{values: degrees}]);
+
+            return [
+                noUpdate,
+                format(totals.crashes),
+                format(totals.no_of_traffic_units_involved),
+                format(totals.no_moderately_injured),
+                format(totals.no_seriously_injured),
+                format(totals.no_killed),
+                trend,
+                degree,
+            ];
+        },
+    },
+});
+
+// The dropdowns return a list; an empty list or one containing 'All' means no filtering.
+function active(selected) {
+    if (!selected || selected.length === 0 || selected.indexOf('All') >= 0) {
+        return null;
+    }
+    return selected;
+}
+
+// The chart filters with any categories clicked, or null.
+function activeCharts(chartFilters) {
+    const names = Object.keys(chartFilters || {}).filter((name) => chartFilters[name] && chartFilters[name].length);
+    return names.length ? chartFilters : null;
+}
+
+// The box or lasso of a map selection, without its (empty) point list.
+function selectionArea(selectedData) {
+    if (selectedData && selectedData.range) {
+        return {range: selectedData.range};
+    }
+    if (selectedData && selectedData.lassoPoints) {
+        return {lassoPoints: selectedData.lassoPoints};
+    }
+    return null;
+}
+
+// Whether the payload was built for the server's filter state.
+function isFor(payload, serverFilters) {
+    if (!payload || !serverFilters || serverFilters[4] || serverFilters[5]) {
+        return false;
+    }
+    const names = ['weather', 'surface_condition', 'lga'];
+    return payload.years[0] === serverFilters[0][0] && payload.years[1] === serverFilters[0][1] &&
+        names.every((name, i) => {
+            const values = active(serverFilters[i + 1]);
+            const sent = payload.selections[name];
+            if (values === null || sent === null) {
+                return values === sent;
+            }
+            const unique = Array.from(new Set(values));
+            return unique.length === sent.length && unique.every((value) => sent.indexOf(value) >= 0);
+        });
+}
+
+// Whether the payload's cells hold every crash of the filter state.
+function covers(payload, years, selections) {
+    if (!payload || !years || years[0] < payload.years[0] || years[1] > payload.years[1]) {
+        return false;
+    }
+    for (const name in selections) {
+        const sent = payload.selections[name];
+        if (sent === null) {
+            continue;
+        }
+        const values = active(selections[name]);
+        if (values === null || !values.every((value) => sent.indexOf(value) >= 0)) {
+            return false;
+        }
+    }
+    return true;
+}
+
+// A copy of the figure with the given properties replaced, trace by trace.
+function withData(figure, traces) {
+    if (!figure) {
+        return window.dash_clientside.no_update;
+    }
+    const data = figure.data.slice();
+    traces.forEach((properties, i) => {
+        data[i] = Object.assign({}, data[i], properties);
+    });
+    return Object.assign({}, figure, {data: data});
+}
+
+// As Python's f"{n:,}".
+function format(value) {
+    return value.toLocaleString('en-US');
+}
@@ -0,0 +1,113 @@
+"""Export throughput and memory: streamed /export vs. one in-memory to_csv().
+
+Usage::
+
+    python -m benchmarks.bench_export [transport_nsw.csv] [--format csv]
+
+Each filter state is exported through the app's /export route, reading the
+streamed body chunk by chunk as a client would, while a thread samples the
+process's anonymous RSS. The rows/sec and the RSS growth over the start of the export
+are reported, then the same for building the "all" export with a single
+``to_csv()`` (run last, as it leaves the heap larger). The streamed CSV is
+checked to hash the same.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+from benchmarks.harness import REPO
+
+
+def _rss_bytes():
+    # Anonymous (heap) RSS: pages of the memory-mapped snapshot read by an
+    # export are page cache shared by every worker, not export memory.
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class _PeakRss:
+    # Samples RSS every few milliseconds while in use.
+
+    def __enter__(self):
+        self.start = self.peak = _rss_bytes()
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, _rss_bytes())
+            time.sleep(0.002)
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, _rss_bytes())
+
+    @property
+    def growth(self):
+        return self.peak - self.start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='transport_nsw.csv')
+    parser.add_argument('--format', default='csv', choices=('csv', 'parquet'))
+    args = parser.parse_args(argv)
+    if os.path.basename(args.csv) != 'transport_nsw.csv':
+        parser.error('app.py reads transport_nsw.csv; pass a path ending in that name')
+
+    os.chdir(os.path.dirname(os.path.abspath(args.csv)))
+    os.environ.update(CRASH_CACHE_PREWARM='0', CRASH_RELOAD_INTERVAL='0', CRASH_RENDER_PROCESSES='0')
+    sys.path.insert(0, REPO)
+    import app as dashboard
+
+    from benchmarks.bench_filters import filter_states
+    from nswcrash.export import export_columns
+
+    data = dashboard.datasets.data()
+    client = dashboard.app.server.test_client()
+    print('rows: {:,}'.format(len(data)))
+    print('{:<22}{:>12}{:>14}{:>12}{:>14}'.format('state', 'rows', 'MB', 'rows/s', 'RSS growth MB'))
+    streamed_sha1 = None
+    for name, (year_range, weather, surface, lga) in filter_states(data.store).items():
+        params = [('format', args.format), ('years', '{}-{}'.format(*year_range))]
+        for column, values in (('weather', weather), ('surface_condition', surface), ('lga', lga)):
+            params.extend((column, value) for value in values if value != 'All')
+        rows = len(data.index.select(year_range, {'weather': weather, 'surface_condition': surface, 'lga': lga}))
+        digest = hashlib.sha1()
+        with _PeakRss() as rss:
+            started = time.perf_counter()
+            response = client.get('/export?' + urlencode(params), buffered=False)
+            size = 0
+            for part in response.response:
+                size += len(part)
+                digest.update(part)
+            response.close()
+            seconds = time.perf_counter() - started
+        if name == 'all':
+            streamed_sha1 = digest.hexdigest()
+        print('{:<22}{:>12,}{:>14.1f}{:>12,.0f}{:>14.1f}'.format(
+            name, rows, size / 1e6, rows / seconds, rss.growth / 1e6))
+
+    if args.format == 'csv':
+        with _PeakRss() as rss:
+            started = time.perf_counter()
+            body = data.store.take(slice(None), export_columns(data.store)).to_csv(index=False).encode()
+            seconds = time.perf_counter() - started
+        print('{:<22}{:>12,}{:>14.1f}{:>12,.0f}{:>14.1f}'.format(
+            'all, to_csv()', len(data), len(body) / 1e6, len(data) / seconds, rss.growth / 1e6))
+        if hashlib.sha1(body).hexdigest() != streamed_sha1:
+            raise AssertionError('streamed CSV differs from to_csv()')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Per-chart figure build time: Plotly figure code vs. filled templates.
+
+Usage::
+
+    python -m benchmarks.bench_figures [transport_nsw.csv] [--repeat 50]
+
+For every chart and filter state this times the chart's Plotly Express /
+``make_subplots`` function, which requests used to run, against the render
+that fills the chart's template. Both include the aggregation over the
+(cached) filter selection and are timed with and without serialising to
+JSON. The serialised figures are checked to hold the same values (Plotly
+writes some arrays as base64 typed arrays where the templates write lists).
+"""
+
+import argparse
+import base64
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.harness import REPO
+
+
+def _decoded(value):
+    # Plain JSON values, with Plotly's typed arrays decoded into lists.
+    if isinstance(value, dict):
+        if set(value) >= {'dtype', 'bdata'}:
+            array = np.frombuffer(base64.b64decode(value['bdata']), dtype=value['dtype'])
+            if 'shape' in value:
+                array = array.reshape([int(size) for size in str(value['shape']).split(',')])
+            return array.tolist()
+        return {key: _decoded(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decoded(item) for item in value]
+    return value
+
+
+def _median_ms(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='transport_nsw.csv')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args(argv)
+    if os.path.basename(args.csv) != 'transport_nsw.csv':
+        parser.error('app.py reads transport_nsw.csv; pass a path ending in that name')
+
+    os.chdir(os.path.dirname(os.path.abspath(args.csv)))
+    os.environ.update(CRASH_CACHE_PREWARM='0', CRASH_RELOAD_INTERVAL='0', CRASH_RENDER_PROCESSES='0')
+    sys.path.insert(0, REPO)
+    import app as dashboard
+    from plotly.io.json import to_json_plotly # type: ignore
+
+    from benchmarks.bench_filters import filter_states
+
+    data = dashboard.datasets.data()
+    charts = [
+        (dashboard.degree_chart, dashboard.degree_chart_figure, dashboard.degree_chart_data),
+        (dashboard.trend_chart, dashboard.trend_chart_figure, dashboard.trend_chart_data),
+        (dashboard.speed_limit_chart, dashboard.speed_limit_chart_figure, dashboard.speed_limit_chart_data),
+        (dashboard.location_chart, dashboard.location_chart_figure, dashboard.location_chart_data),
+        (dashboard.conurbation_chart, dashboard.conurbation_chart_figure, dashboard.conurbation_chart_data),
+    ]
+    states = filter_states(data.store)
+
+    print('{:<20}{:>12}{:>12}{:>9}{:>14}{:>14}{:>9}'.format(
+        'chart', 'plotly ms', 'template ms', 'speedup', 'plotly+json', 'template+json', 'speedup'))
+    for render, build, chart_data in charts:
+        timings = {'plotly': [], 'template': [], 'plotly_json': [], 'template_json': []}
+        for state in states.values():
+            key = dashboard.current_filter_key(*state)
+            cells = dashboard.selected_cells(data, key)
+
+            def plotly():
+                return build(chart_data(cells))
+
+            def template():
+                return render(data, key, True)
+
+            if _decoded(json.loads(to_json_plotly(plotly()))) != _decoded(json.loads(to_json_plotly(template()))):
+                raise AssertionError('{} differs for {}'.format(render.__name__, state))
+            timings['plotly'].append(_median_ms(plotly, args.repeat))
+            timings['template'].append(_median_ms(template, args.repeat))
+            timings['plotly_json'].append(_median_ms(lambda: to_json_plotly(plotly()), args.repeat))
+            timings['template_json'].append(_median_ms(lambda: to_json_plotly(template()), args.repeat))
+
+        mean = {name: statistics.mean(values) for name, values in timings.items()}
+        print('{:<20}{:>12.2f}{:>12.2f}{:>8.1f}x{:>14.2f}{:>14.2f}{:>8.1f}x'.format(
+            render.__name__, mean['plotly'], mean['template'], mean['plotly'] / mean['template'],
+            mean['plotly_json'], mean['template_json'], mean['plotly_json'] / mean['template_json']))
+
+
+if __name__ == '__main__':
+    main()
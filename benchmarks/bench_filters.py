@@ -0,0 +1,91 @@
+"""Micro-benchmark of the update_figure filter step: boolean masks vs. FilterIndex.
+
+Usage::
+
+    python -m benchmarks.bench_filters [transport_nsw.csv] [--repeat 20]
+
+Both paths are checked to return the same set of crash_id values.
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.bench_startup import load_from_csv
+from nswcrash.index import FilterIndex
+from nswcrash.store import load_crashes
+
+
+def legacy_filter(df, selected_range, selected_weather, selected_surface_condition, selected_lga):
+    # The mask-based filter update_figure used before the index.
+    start_year, end_year = selected_range
+    filtered_df = df[(df['year_of_crash'] >= start_year) & (df['year_of_crash'] <= end_year)].copy()
+    if selected_weather and 'All' not in selected_weather:
+        filtered_df = filtered_df[filtered_df['weather'].astype(str).isin(selected_weather)]
+    if selected_surface_condition and 'All' not in selected_surface_condition:
+        filtered_df = filtered_df[filtered_df['surface_condition'].astype(str).isin(selected_surface_condition)]
+    if selected_lga and 'All' not in selected_lga:
+        filtered_df = filtered_df[filtered_df['lga'].astype(str).isin(selected_lga)]
+    return filtered_df
+
+
+def filter_states(store):
+    years = store['year_of_crash']
+    first, last = int(years[0]), int(years[-1])
+    weather = store.labels('weather')
+    surface = store.labels('surface_condition')
+    lga = store.labels('lga')
+    return {
+        'all': ([first, last], ['All'], ['All'], ['All']),
+        'last year': ([last, last], ['All'], ['All'], ['All']),
+        'one weather': ([first, last], weather[:1], ['All'], ['All']),
+        'weather + surface': ([first, last], weather[:2], surface[:1], ['All']),
+        'single lga': ([first, last], ['All'], ['All'], lga[:1]),
+        'five lgas, 2 years': ([last - 1, last], ['All'], ['All'], lga[:5]),
+        'all three filters': ([first, last], weather[:2], surface[:2], lga[:10]),
+    }
+
+
+def _median_ms(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='transport_nsw.csv')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    df = load_from_csv(args.csv)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = load_crashes(args.csv, tmp + '/snapshot')
+        started = time.perf_counter()
+        index = FilterIndex(store)
+        print('rows: {:,}  index build: {:.3f}s'.format(len(store), time.perf_counter() - started))
+        crash_ids = np.asarray(store['crash_id'])
+
+        print('{:<22}{:>10}{:>12}{:>12}{:>9}'.format('state', 'rows', 'mask ms', 'index ms', 'speedup'))
+        for name, state in filter_states(store).items():
+            selected_range, weather, surface, lga = state
+            selections = {'weather': weather, 'surface_condition': surface, 'lga': lga}
+            expected = legacy_filter(df, *state)
+            rows = index.select(selected_range, selections)
+            if set(expected['crash_id']) != set(crash_ids[rows].tolist()):
+                raise AssertionError('Row sets differ for state {!r}'.format(name))
+
+            mask_ms = _median_ms(lambda: legacy_filter(df, *state), args.repeat)
+            index_ms = _median_ms(lambda: index.select(selected_range, selections), args.repeat)
+            print('{:<22}{:>10,}{:>12.2f}{:>12.3f}{:>8.0f}x'.format(
+                name, len(rows), mask_ms, index_ms, mask_ms / max(index_ms, 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
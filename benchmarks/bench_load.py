@@ -0,0 +1,379 @@
+"""Load test of the Dash callback endpoint under several server configurations.
+
+Usage::
+
+    python -m benchmarks.bench_load --rows 100000 --servers flask sync:2 gthread:2x4 \\
+        --concurrency 1 4 16 --output load.json
+    python -m benchmarks.bench_load compare before.json after.json
+
+Runs offline against a synthetic extract (generated in ``--data-dir`` as by
+benchmarks.harness). Each server configuration is started in the extract's
+directory:
+
+- ``flask``: Flask's threaded development server
+- ``sync:W``: gunicorn with W sync workers
+- ``gthread:WxT``: gunicorn with W gthread workers of T threads
+
+The configuration then takes one load level after another. At each level,
+``--concurrency`` virtual users replay the ``_dash-update-component`` POSTs a
+browser sends, each user sending its next request as soon as the previous
+one is answered, so that many requests are always in flight. The filter
+changes run server-side, as when the browser cannot filter the cells it was
+sent (see benchmarks.harness). Every filter change fires all the callbacks
+that the single ``update_figure`` callback once served. Each user loops
+through:
+
+- a page load in the "All" state;
+- slider drags, each a release on a random year range;
+- a multi-select adding LGAs one at a time;
+- a reset to "All".
+
+Users draw their ranges and LGAs from their own seeded generator, and the
+options come from the served layout.
+
+Requests are counted over ``--duration`` seconds after ``--warmup`` seconds.
+For each level the report gives:
+
+- p50, p95 and p99 latency, overall and per interaction;
+- throughput;
+- error rate: statuses other than 200 and 204, or failed requests;
+- per worker, the CPU used over the window and the RSS and PSS at its end,
+  with the PSS of the worker's render processes.
+
+The load generator runs in this process. On a small machine it competes with
+the server for CPU, so its own CPU use is reported too. The JSON report
+(``--output``) holds the commit, package versions and machine, and
+``compare`` prints the ratio of every latency, throughput and error rate
+between two reports. Linux only (/proc).
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import numpy as np
+
+from benchmarks.bench_memory import _children, _free_port, _memory
+from benchmarks.harness import (REPO, SERVER_FILTERS, _environment, _flatten, _request, compare, server_callbacks,
+                                synthetic_extract)
+
+RESULT_SCHEMA = 1
+PERCENTILES = (50, 95, 99)
+# Flask's development server, threaded, for the flask configuration
+FLASK_SERVER = ('import sys, app; '
+                'app.server.run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True, use_reloader=False)')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def parse_server(spec):
+    """``{'name', 'kind', 'workers', 'threads'}`` from ``flask``, ``sync:W`` or ``gthread:WxT``."""
+    kind, _, size = spec.partition(':')
+    try:
+        if kind == 'flask' and not size:
+            return {'name': spec, 'kind': kind, 'workers': 1, 'threads': None}
+        if kind == 'sync':
+            return {'name': spec, 'kind': kind, 'workers': int(size), 'threads': 1}
+        if kind == 'gthread':
+            workers, _, threads = size.partition('x')
+            return {'name': spec, 'kind': kind, 'workers': int(workers), 'threads': int(threads)}
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError('expected flask, sync:W or gthread:WxT, got {!r}'.format(spec))
+
+
+def _start(server, data_dir, port, env):
+    if server['kind'] == 'flask':
+        command = [sys.executable, '-c', FLASK_SERVER, str(port)]
+    else:
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO, 'gunicorn.conf.py'),
+                   '--workers', str(server['workers']), '--worker-class', server['kind'],
+                   '--threads', str(server['threads']), '--bind', '127.0.0.1:{}'.format(port), 'app:server']
+    return subprocess.Popen(command, cwd=data_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _workers(process, server):
+    # The processes answering requests: gunicorn's workers, or the Flask server.
+    return [process.pid] if server['kind'] == 'flask' else _children(process.pid)
+
+
+def _wait_ready(url, process, server, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('{} exited with status {}'.format(server['name'], process.returncode))
+        try:
+            with urllib.request.urlopen(url + '/ready', timeout=5) as response:
+                response.read()
+            # Every worker must be up before requests are spread across them.
+            if len(_workers(process, server)) >= server['workers']:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError('{} was not ready within {}s'.format(server['name'], timeout))
+
+
+def _get_json(url):
+    with urllib.request.urlopen(url, timeout=60) as response:
+        return json.load(response)
+
+
+def _components(node):
+    # Every component of a /_dash-layout tree.
+    if isinstance(node, list):
+        for item in node:
+            yield from _components(item)
+    elif isinstance(node, dict) and 'props' in node:
+        yield node
+        yield from _components(node['props'].get('children'))
+
+
+def layout_options(url):
+    """The year range and LGA options of the dashboard as served."""
+    components = {component['props'].get('id'): component['props'] for component in _components(_get_json(url))}
+    slider = components['year-slider']
+    lgas = [option['value'] for option in components['lga-selector']['options'] if option['value'] != 'All']
+    return [slider['min'], slider['max']], lgas
+
+
+def user_steps(rng, years, lgas, drags=3, max_lgas=4):
+    """One round of a user's interactions: ``(interaction, state, changed props)`` tuples."""
+    everything = (list(years), ['All'], ['All'], ['All'])
+    steps = [('page load', everything, [])]
+    for _ in range(drags):
+        start, end = sorted(rng.randint(years[0], years[1]) for _ in range(2))
+        steps.append(('slider drag', ([start, end], ['All'], ['All'], ['All']), ['year-slider.value']))
+    selected = []
+    for lga in rng.sample(lgas, min(max_lgas, len(lgas))):
+        selected = selected + [lga]
+        steps.append(('lga select', (list(years), ['All'], ['All'], list(selected)), ['lga-selector.value']))
+    steps.append(('all default', everything, ['lga-selector.value']))
+    return steps
+
+
+def triggered(dependencies, changed):
+    """The server callbacks a browser calls for a change of ``changed`` (all of them on page load)."""
+    if not changed:
+        return [dependency for dependency in dependencies if not dependency.get('prevent_initial_call')]
+    # The filter state reaches the KPI, trend and degree callbacks through
+    # the server-filters store (see assets/clientside.js).
+    props = set(changed) | {SERVER_FILTERS}
+    return [dependency for dependency in dependencies
+            if any('{}.{}'.format(item['id'], item['property']) in props for item in dependency['inputs'])]
+
+
+def _post(url, body, timeout):
+    request = urllib.request.Request(url + '/_dash-update-component', json.dumps(body).encode(),
+                                     {'Content-Type': 'application/json', 'Accept-Encoding': 'br, gzip'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+    except OSError:
+        return None
+
+
+def run_user(url, dependencies, years, lgas, seed, stop, records, timeout):
+    # Replays rounds of interactions until ``stop`` is set, appending
+    # (finished, seconds, status, interaction) for every request.
+    rng = random.Random(seed)
+    session_id = uuid.UUID(int=rng.getrandbits(128)).hex
+    while not stop.is_set():
+        for interaction, state, changed in user_steps(rng, years, lgas):
+            for dependency in triggered(dependencies, changed):
+                body = _request(dependency, state, changed)
+                for item in body['state']:
+                    if item['id'] == 'session-id':
+                        item['value'] = session_id
+                started = time.perf_counter()
+                status = _post(url, body, timeout)
+                finished = time.perf_counter()
+                records.append((finished, finished - started, status, interaction))
+                if stop.is_set():
+                    return
+
+
+def _cpu_ticks(pid):
+    # User plus system clock ticks of a process, from /proc/<pid>/stat
+    # (the fields after the parenthesised command name).
+    try:
+        with open('/proc/{}/stat'.format(pid)) as fh:
+            fields = fh.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0
+    return int(fields[11]) + int(fields[12])
+
+
+def _process_cpu(pids):
+    # CPU ticks of each worker and of its render processes.
+    return {pid: (_cpu_ticks(pid), sum(_cpu_ticks(child) for child in _children(pid))) for pid in pids}
+
+
+def _latencies(records):
+    seconds = np.array([record[1] for record in records if record[2] in (200, 204)])
+    if not len(seconds):
+        return {}
+    summary = {'p{}'.format(q): float(value) * 1000 for q, value in zip(PERCENTILES, np.percentile(seconds, PERCENTILES))}
+    summary.update(mean=float(seconds.mean()) * 1000, max=float(seconds.max()) * 1000)
+    return summary
+
+
+def measure_level(url, dependencies, years, lgas, concurrency, workers, args):
+    """Run ``concurrency`` users for the warm-up and measured window; the level's results."""
+    records, stop = [], threading.Event()
+    users = [threading.Thread(target=run_user, daemon=True,
+                              args=(url, dependencies, years, lgas, args.seed * 1000003 + user, stop, records,
+                                    args.timeout))
+             for user in range(concurrency)]
+    for user in users:
+        user.start()
+    time.sleep(args.warmup)
+
+    window_start = time.perf_counter()
+    cpu_before = _process_cpu(workers)
+    client_before = resource.getrusage(resource.RUSAGE_SELF)
+    time.sleep(args.duration)
+    window_end = time.perf_counter()
+    cpu_after = _process_cpu(workers)
+    client_after = resource.getrusage(resource.RUSAGE_SELF)
+    worker_results = []
+    for pid in workers:
+        worker_ticks = cpu_after[pid][0] - cpu_before[pid][0]
+        render_ticks = max(cpu_after[pid][1] - cpu_before[pid][1], 0)
+        memory = _memory(pid)
+        worker_results.append({
+            'cpu_seconds': worker_ticks / CLOCK_TICKS,
+            'cpu_percent': worker_ticks / CLOCK_TICKS / args.duration * 100,
+            'render_cpu_seconds': render_ticks / CLOCK_TICKS,
+            'rss_bytes': memory['rss'],
+            'pss_bytes': memory['pss'],
+            'render_pss_bytes': sum(_memory(child)['pss'] for child in _children(pid)),
+        })
+    stop.set()
+    for user in users:
+        user.join(args.timeout)
+
+    window = [record for record in records if window_start <= record[0] < window_end]
+    errors = sum(1 for record in window if record[2] not in (200, 204))
+    client_cpu = (client_after.ru_utime + client_after.ru_stime) - (client_before.ru_utime + client_before.ru_stime)
+    return {
+        'concurrency': concurrency,
+        'requests': len(window),
+        'errors': errors,
+        'error_rate': errors / len(window) if window else 0.0,
+        'throughput_rps': (len(window) - errors) / args.duration,
+        'latency_ms': _latencies(window),
+        'interactions': {
+            interaction: _latencies([record for record in window if record[3] == interaction])
+            for interaction in sorted({record[3] for record in window})
+        },
+        'workers': worker_results,
+        'client_cpu_percent': client_cpu / args.duration * 100,
+    }
+
+
+def bench_server(server, data_dir, args):
+    port = _free_port()
+    url = 'http://127.0.0.1:{}'.format(port)
+    env = dict(os.environ, PYTHONPATH=REPO, CRASH_CACHE_PREWARM='0', CRASH_RELOAD_INTERVAL='0')
+    env.pop('CRASH_CACHE_PATH', None)
+    if not args.result_cache:
+        env['CRASH_CACHE_BYTES'] = '0'
+    if args.render_processes is not None:
+        env['CRASH_RENDER_PROCESSES'] = str(args.render_processes)
+    process = _start(server, data_dir, port, env)
+    try:
+        _wait_ready(url, process, server, args.startup_timeout)
+        dependencies = server_callbacks(_get_json(url + '/_dash-dependencies'))
+        years, lgas = layout_options(url + '/_dash-layout')
+        workers = _workers(process, server)
+        levels = []
+        for concurrency in args.concurrency:
+            level = measure_level(url, dependencies, years, lgas, concurrency, workers, args)
+            levels.append(level)
+            latency = level['latency_ms']
+            print('  {:<14}{:>6}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>9.1%}{:>10.0f}{:>9.0f}%'.format(
+                server['name'], concurrency, latency.get('p50', float('nan')), latency.get('p95', float('nan')),
+                latency.get('p99', float('nan')), level['throughput_rps'], level['error_rate'],
+                sum(worker['rss_bytes'] for worker in level['workers']) / 2 ** 20,
+                sum(worker['cpu_percent'] for worker in level['workers'])), file=sys.stderr)
+        return dict(server, levels=levels)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def bench(args):
+    data_dir = synthetic_extract(args.data_dir, args.rows, args.seed)
+    results = dict(schema=RESULT_SCHEMA, rows=args.rows, seed=args.seed, duration=args.duration,
+                   warmup=args.warmup, result_cache=args.result_cache, environment=_environment(), servers=[])
+    print('  {:<14}{:>6}{:>10}{:>10}{:>10}{:>10}{:>9}{:>10}{:>10}'.format(
+        'server', 'users', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'errors', 'rss MiB', 'cpu'), file=sys.stderr)
+    for server in args.servers:
+        results['servers'].append(bench_server(server, data_dir, args))
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(text + '\n')
+    else:
+        print(text)
+
+
+def _measurements(results):
+    measured = {}
+    for server in results['servers']:
+        for level in server['levels']:
+            values = {key: level[key] for key in ('latency_ms', 'interactions', 'throughput_rps', 'error_rate')}
+            for path, value in _flatten(values):
+                if path.endswith(('p50', 'p95', 'p99', 'throughput_rps', 'error_rate')):
+                    measured['{:<14}{:>5} users  {}'.format(server['name'], level['concurrency'], path)] = value
+    return measured
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='load-test the working tree (default)')
+    compare_parser = commands.add_parser('compare', help='compare two reports')
+
+    for sub in (parser, run_parser):
+        sub.add_argument('--rows', type=int, default=100000)
+        sub.add_argument('--seed', type=int, default=0)
+        sub.add_argument('--servers', type=parse_server, nargs='+',
+                         default=[parse_server(spec) for spec in ('flask', 'sync:1', 'sync:2', 'gthread:2x4')])
+        sub.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+        sub.add_argument('--duration', type=float, default=10.0, help='seconds measured per level')
+        sub.add_argument('--warmup', type=float, default=2.0, help='seconds run before each level is measured')
+        sub.add_argument('--timeout', type=float, default=60.0, help='seconds before a request counts as failed')
+        sub.add_argument('--startup-timeout', type=float, default=300.0)
+        sub.add_argument('--no-result-cache', dest='result_cache', action='store_false',
+                         help='run with CRASH_CACHE_BYTES=0, so every request renders')
+        sub.add_argument('--render-processes', type=int, help='CRASH_RENDER_PROCESSES of the server')
+        sub.add_argument('--data-dir', default='.bench-data')
+        sub.add_argument('--output', help='write the JSON report here instead of stdout')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=0.0,
+                                help='hide measurements that changed by less than this fraction')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        compare(args, _measurements, width=70)
+    else:
+        bench(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Per-worker memory of the dashboard under gunicorn, with and without preload.
+
+Usage::
+
+    python -m benchmarks.bench_memory [transport_nsw.csv] [--workers 4] [--requests 40]
+
+Starts gunicorn with gunicorn.conf.py in the CSV's directory, once with
+``CRASH_PRELOAD=0`` (every worker loads the data itself) and once with
+``CRASH_PRELOAD=1`` (the master loads it once and forks). A few rounds of
+dashboard callbacks are sent so every worker has served requests, then each
+worker's RSS and PSS are read from /proc, along with the PSS of the worker's
+render processes. PSS splits shared pages between the processes mapping them,
+so the PSS total is the real footprint. Linux only.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+from benchmarks.harness import REPO, _request, server_callbacks
+
+STATE = ([2000, 2100], ['All'], ['All'], ['All'])
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _children(pid):
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid)) as fh:
+            return [int(child) for child in fh.read().split()]
+    except OSError:
+        return []
+
+
+def _memory(pid):
+    # Kilobyte fields of smaps_rollup, in bytes.
+    memory = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as fh:
+        for line in fh:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                memory[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    return {'rss': memory['Rss'], 'pss': memory['Pss'], 'anonymous': memory['Anonymous']}
+
+
+def _wait_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url + '/_dash-dependencies', timeout=5) as response:
+                return server_callbacks(json.load(response))
+        except OSError:
+            time.sleep(0.5)
+    raise TimeoutError('gunicorn did not start within {}s'.format(timeout))
+
+
+def measure(data_dir, workers, requests, preload, timeout=300):
+    port = _free_port()
+    url = 'http://127.0.0.1:{}'.format(port)
+    env = dict(os.environ, PYTHONPATH=REPO, CRASH_PRELOAD='1' if preload else '0',
+               CRASH_CACHE_PREWARM='0', CRASH_RELOAD_INTERVAL='0')
+    master = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO, 'gunicorn.conf.py'),
+         '--workers', str(workers), '--bind', '127.0.0.1:{}'.format(port), 'app:server'],
+        cwd=data_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        dependencies = _wait_ready(url, timeout)
+        # Every worker must be up before requests are spread across them.
+        while len(_children(master.pid)) < workers:
+            time.sleep(0.2)
+        for _ in range(requests):
+            for dependency in dependencies:
+                body = json.dumps(_request(dependency, STATE, [])).encode()
+                request = urllib.request.Request(url + '/_dash-update-component', body,
+                                                 {'Content-Type': 'application/json'})
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    response.read()
+        worker_memory = []
+        for pid in _children(master.pid):
+            memory = _memory(pid)
+            memory['render_pss'] = sum(_memory(child)['pss'] for child in _children(pid))
+            worker_memory.append(memory)
+        return {'master': _memory(master.pid), 'workers': worker_memory}
+    finally:
+        master.terminate()
+        master.wait(timeout=30)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='transport_nsw.csv')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=40, help='rounds of callbacks to send')
+    parser.add_argument('--preload', choices=('both', 'off', 'on'), default='both')
+    args = parser.parse_args(argv)
+
+    data_dir = os.path.dirname(os.path.abspath(args.csv))
+    if os.path.basename(args.csv) != 'transport_nsw.csv':
+        parser.error('app.py reads transport_nsw.csv; pass a path ending in that name')
+
+    mib = 2 ** 20
+    print('{:<10}{:>8}{:>12}{:>12}{:>12}{:>16}'.format('preload', 'worker', 'rss MiB', 'pss MiB', 'anon MiB',
+                                                     'render pss MiB'))
+    for preload in {'both': (False, True), 'off': (False,), 'on': (True,)}[args.preload]:
+        result = measure(data_dir, args.workers, args.requests, preload)
+        for number, memory in enumerate(result['workers']):
+            print('{:<10}{:>8}{:>12.1f}{:>12.1f}{:>12.1f}{:>16.1f}'.format(
+                str(preload), number, memory['rss'] / mib, memory['pss'] / mib, memory['anonymous'] / mib,
+                memory['render_pss'] / mib))
+        total = sum(memory['pss'] + memory['render_pss'] for memory in result['workers']) + result['master']['pss']
+        print('{:<10}{:>8}{:>12.1f}{:>12.1f}  (total pss incl. master)'.format(
+            str(preload), 'master', result['master']['rss'] / mib, total / mib))
+
+
+if __name__ == '__main__':
+    main()
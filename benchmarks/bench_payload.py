@@ -0,0 +1,78 @@
+"""Callback payload size on the wire and serialisation time for the "All" state.
+
+Usage::
+
+    python -m benchmarks.bench_payload [transport_nsw.csv] [--repeat 200]
+
+Every Dash callback is posted as on page load with no filters set, once per
+``Accept-Encoding`` (identity, gzip and, if installed, brotli), and the
+response body sizes are reported. Each callback's return value is then
+serialised with Plotly's ``json`` and ``orjson`` engines and timed.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+from benchmarks.harness import REPO, _request, server_callbacks
+
+
+def _median_ms(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='transport_nsw.csv')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args(argv)
+    if os.path.basename(args.csv) != 'transport_nsw.csv':
+        parser.error('app.py reads transport_nsw.csv; pass a path ending in that name')
+
+    os.chdir(os.path.dirname(os.path.abspath(args.csv)))
+    os.environ.update(CRASH_CACHE_PREWARM='0', CRASH_RELOAD_INTERVAL='0', CRASH_RENDER_PROCESSES='0')
+    sys.path.insert(0, REPO)
+    import app as dashboard
+    from plotly.io.json import to_json_plotly # type: ignore
+
+    from nswcrash.compression import brotli
+
+    data = dashboard.datasets.data()
+    years = [int(data.index.years[0]), int(data.index.years[-1])]
+    state = (years, ['All'], ['All'], ['All'])
+    key = dashboard.current_filter_key(*state)
+    encodings = ['identity', 'gzip'] + (['br'] if brotli is not None else [])
+
+    client = dashboard.app.server.test_client()
+    print('{:<48}'.format('callback') + ''.join('{:>12}'.format(name + ' B') for name in encodings))
+    totals = dict.fromkeys(encodings, 0)
+    for dependency in server_callbacks(client.get('/_dash-dependencies').get_json()):
+        sizes = []
+        for encoding in encodings:
+            response = client.post('/_dash-update-component', json=_request(dependency, state, []),
+                                   headers={'Accept-Encoding': encoding})
+            sizes.append(len(response.get_data()))
+            totals[encoding] += sizes[-1]
+        print('{:<48}'.format(dependency['output'][:47]) + ''.join('{:>12,}'.format(size) for size in sizes))
+    print('{:<48}'.format('total') + ''.join('{:>12,}'.format(totals[name]) for name in encodings))
+
+    outputs = [(render.__name__, render(data, key, True)) for render in dashboard.chart_renders]
+    outputs.append(('indicators', dashboard.indicators(data, key, True)))
+    print()
+    print('{:<24}{:>10}{:>12}{:>12}'.format('output', 'bytes', 'json ms', 'orjson ms'))
+    for name, value in outputs:
+        size = len(to_json_plotly(value, engine='orjson'))
+        json_ms = _median_ms(lambda: to_json_plotly(value, engine='json'), args.repeat)
+        orjson_ms = _median_ms(lambda: to_json_plotly(value, engine='orjson'), args.repeat)
+        print('{:<24}{:>10,}{:>12.3f}{:>12.3f}'.format(name, size, json_ms, orjson_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Area query latency: SpatialIndex vs. a scan of every crash's coordinates.
+
+Usage::
+
+    python -m benchmarks.bench_spatial [transport_nsw.csv] [--repeat 50]
+
+Radius, box and polygon queries of growing size around Sydney are checked
+to return the same rows as the scan, then timed.
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from nswcrash.spatial import SpatialIndex, _inside_polygon
+from nswcrash.store import load_crashes
+from nswcrash.tiles import TileIndex
+
+CENTRE = (151.2070, -33.8675)
+
+
+def queries():
+    lon, lat = CENTRE
+    result = {}
+    for metres in (500, 2000, 10000, 50000):
+        result['radius {} m'.format(metres)] = ('radius', lon, lat, metres)
+    for degrees in (0.01, 0.1, 0.5, 2.0):
+        result['box {}°'.format(degrees)] = ('bbox', lon - degrees, lat - degrees, lon + degrees, lat + degrees)
+    # A 64-point lasso around the centre
+    angles = np.linspace(0, 2 * np.pi, 64, endpoint=False)
+    radii = 0.15 * (1 + 0.3 * np.sin(5 * angles))
+    result['lasso 64 points'] = ('polygon', tuple(zip(lon + radii * np.cos(angles), lat + radii * np.sin(angles))))
+    return result
+
+
+def scan(spatial, area):
+    rows = np.arange(len(spatial.latitude))
+    lon, lat = np.asarray(spatial.longitude, dtype=np.float64), np.asarray(spatial.latitude, dtype=np.float64)
+    if area[0] == 'radius':
+        return rows[spatial.distances(rows, area[1], area[2]) <= area[3]]
+    if area[0] == 'bbox':
+        _, west, south, east, north = area
+        return rows[(lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)]
+    return rows[_inside_polygon(lon, lat, area[1])]
+
+
+def _median_ms(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='transport_nsw.csv')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = load_crashes(args.csv, tmp + '/snapshot')
+        started = time.perf_counter()
+        spatial = SpatialIndex(TileIndex(store), store)
+        print('rows: {:,}  index build: {:.3f}s'.format(len(store), time.perf_counter() - started))
+
+        print('{:<20}{:>10}{:>12}{:>12}{:>9}'.format('query', 'rows', 'scan ms', 'index ms', 'speedup'))
+        for name, area in queries().items():
+            rows = spatial.query(area)
+            if not np.array_equal(np.sort(rows), scan(spatial, area)):
+                raise AssertionError('Row sets differ for {}'.format(name))
+            scan_ms = _median_ms(lambda: scan(spatial, area), max(args.repeat // 10, 1))
+            index_ms = _median_ms(lambda: spatial.query(area), args.repeat)
+            print('{:<20}{:>10,}{:>12.2f}{:>12.3f}{:>8.0f}x'.format(
+                name, len(rows), scan_ms, index_ms, scan_ms / max(index_ms, 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Compare dashboard start-up: data loading, imports and time to first response.
+
+Usage::
+
+    python -m benchmarks.bench_startup [transport_nsw.csv] [--repeat 3] [--no-serve]
+
+First the data paths are timed: parsing the CSV vs. loading the snapshot.
+Then app.py is started as a server in a fresh process, once without a
+snapshot (cold) and once with it (warm), loading in the background (the
+default) and in the foreground (``CRASH_PRELOAD=1``), and the seconds until
+it answers ``/`` and until ``/ready`` reports the data loaded are printed.
+Last, the slowest imports of ``import app`` are listed from
+``python -X importtime``.
+
+The snapshot is built in a temporary directory so an existing
+``transport_nsw.snapshot`` next to the CSV is left untouched.
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import pandas as pd # type: ignore
+
+from benchmarks.harness import REPO
+from nswcrash.store import CrashStore, build_snapshot, load_crashes
+
+CSV_NAME = 'transport_nsw.csv'
+
+
+def load_from_csv(csv_path):
+    # The pre-snapshot start-up path of app.py.
+    df = pd.read_csv(csv_path)
+    df['latitude'] = pd.to_numeric(df['latitude'], errors='coerce')
+    df['longitude'] = pd.to_numeric(df['longitude'], errors='coerce')
+    df['no_total_injured'] = df['no_seriously_injured'] + df['no_moderately_injured'] + df['no_minor_other_injured']
+    return df.dropna(subset=['latitude', 'longitude'])
+
+
+def _time(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _app_env(**overrides):
+    env = dict(os.environ, PYTHONPATH=REPO, CRASH_CACHE_PREWARM='0', CRASH_RELOAD_INTERVAL='0')
+    env.update(overrides)
+    return env
+
+
+def _get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+    except OSError:
+        return None
+
+
+def time_server(data_dir, preload, timeout=600):
+    """Seconds from starting app.py as a server until ``/`` and ``/ready`` answer 200."""
+    port = _free_port()
+    base = 'http://127.0.0.1:{}'.format(port)
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-c', 'import app; app.app.run(port={})'.format(port)],
+        cwd=data_dir, env=_app_env(CRASH_PRELOAD='1' if preload else '0'),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        first_response = ready = None
+        while ready is None and time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError('app.py exited with status {}'.format(process.returncode))
+            if first_response is None and _get(base + '/') == 200:
+                first_response = time.perf_counter() - started
+            if first_response is not None and _get(base + '/ready') == 200:
+                ready = time.perf_counter() - started
+            time.sleep(0.01)
+        return first_response, ready
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def slowest_imports(data_dir, top=10):
+    """(module, seconds) of the slowest modules ``import app`` imports itself."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=data_dir, env=_app_env(), capture_output=True, text=True, check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # Nesting is shown as two spaces a level, after the column's own one.
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() == 'app':
+            imports.append(('app (total)', int(cumulative) / 1e6))
+        elif depth == 1:
+            # Imported by app.py, or first by it
+            imports.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(imports, key=lambda item: -item[1])[:top + 1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='transport_nsw.csv')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-serve', dest='serve', action='store_false',
+                        help='skip the server and import timings')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out_dir = tmp + '/snapshot'
+        csv_seconds, df = _time(lambda: load_from_csv(args.csv), args.repeat)
+        build_seconds, _ = _time(lambda: build_snapshot(args.csv, out_dir), 1)
+        warm_seconds, store = _time(lambda: load_crashes(args.csv, out_dir), args.repeat)
+        frame_seconds, _ = _time(lambda: CrashStore.open(out_dir).to_frame(), args.repeat)
+
+        print('rows: {:,}'.format(len(store)))
+        print('{:<34}{:>10}'.format('path', 'seconds'))
+        print('{:<34}{:>10.3f}'.format('read_csv + preprocessing', csv_seconds))
+        print('{:<34}{:>10.3f}'.format('snapshot build (cold, once)', build_seconds))
+        print('{:<34}{:>10.3f}'.format('snapshot load (mmap, warm)', warm_seconds))
+        print('{:<34}{:>10.3f}'.format('snapshot load + to_frame', frame_seconds))
+        print('speed-up (warm, with frame): {:.1f}x'.format(csv_seconds / max(frame_seconds, 1e-9)))
+        print('in-memory bytes: csv frame {:,} / snapshot frame {:,}'.format(
+            int(df.memory_usage(deep=True).sum()),
+            int(store.to_frame().memory_usage(deep=True).sum()),
+        ))
+
+        if not args.serve:
+            return
+        # app.py reads transport_nsw.csv from its working directory.
+        data_dir = os.path.join(tmp, 'serve')
+        os.makedirs(data_dir)
+        os.symlink(os.path.abspath(args.csv), os.path.join(data_dir, CSV_NAME))
+        print()
+        print('{:<34}{:>16}{:>10}'.format('app.py server start', 'first response', 'ready'))
+        # The first start builds the snapshot.
+        for name, preload in (('background load, cold', False), ('background load, warm', False),
+                              ('foreground load (CRASH_PRELOAD=1)', True)):
+            first_response, ready = time_server(data_dir, preload)
+            print('{:<34}{:>16.2f}{:>10.2f}'.format(name, first_response, ready))
+
+        print()
+        print('{:<34}{:>10}'.format('import app (python -X importtime)', 'seconds'))
+        for module, seconds in slowest_imports(data_dir):
+            print('{:<34}{:>10.3f}'.format(module, seconds))
+
+
+if __name__ == '__main__':
+    main()
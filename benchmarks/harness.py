@@ -0,0 +1,318 @@
+"""End-to-end dashboard benchmark on synthetic extracts of several sizes.
+
+Usage::
+
+    python -m benchmarks.harness --rows 100000 1000000 10000000 --output results.json
+    python -m benchmarks.harness compare before.json after.json
+
+For each row count a synthetic ``transport_nsw.csv`` is generated (and kept in
+``--data-dir`` for later runs), then app.py is started in a fresh process,
+once without a snapshot (cold) and once with it (warm). The warm process
+replays every Dash callback over a matrix of filter states through the Flask
+test client, so the timings include serialisation. The run records:
+
+- start-up time
+- per-callback latency and response bytes
+- resident memory after start-up and at its peak
+
+Result caches are emptied before every call unless ``--cached`` is given.
+Results are written as JSON together with the commit, package versions and
+machine, and ``compare`` prints the ratio of every timing and size between
+two result files.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.synthetic import write_csv
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CSV_NAME = 'transport_nsw.csv'
+FILTER_IDS = {
+    'year-slider.value': 0,
+    'weather-selector.value': 1,
+    'surface-condition-selector.value': 2,
+    'lga-selector.value': 3,
+}
+SERVER_FILTERS = 'server-filters.data'
+RESULT_SCHEMA = 1
+
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _output_spec(output):
+    # '..a.figure...b.data..' for multi-output callbacks, 'a.figure' otherwise.
+    def spec(part):
+        component, prop = part.rsplit('.', 1)
+        return {'id': component, 'property': prop}
+    if output.startswith('..'):
+        return [spec(part) for part in output[2:-2].split('...')]
+    return spec(output)
+
+
+def server_callbacks(dependencies):
+    """The dependencies the server runs; clientside callbacks run in the browser."""
+    return [dependency for dependency in dependencies if not dependency.get('clientside_function')]
+
+
+def _request(dependency, state, changed):
+    # Filter controls take the state's values; any other input starts out
+    # empty as on page load. The server-filters store holds the whole state,
+    # its last two slots (the map area and the chart filters) empty, and
+    # changes with the controls, as when the browser cannot filter
+    # (assets/clientside.js).
+    def value(key):
+        if key == SERVER_FILTERS:
+            return [list(item) if isinstance(item, (list, tuple)) else item for item in state] + [None, None]
+        return state[FILTER_IDS[key]] if key in FILTER_IDS else None
+
+    def values(props):
+        return [dict(prop, value=value('{}.{}'.format(prop['id'], prop['property']))) for prop in props]
+    if changed and any(key in FILTER_IDS for key in changed):
+        changed = list(changed) + [SERVER_FILTERS]
+    return {
+        'output': dependency['output'],
+        'outputs': _output_spec(dependency['output']),
+        'inputs': values(dependency['inputs']),
+        'state': values(dependency['state']),
+        'changedPropIds': changed,
+    }
+
+
+def _reset_caches(module):
+    for value in list(vars(module).values()):
+        try:
+            cache_clear = getattr(value, 'cache_clear', None)
+        except RuntimeError:
+            # Flask's request proxies cannot be inspected outside a request.
+            continue
+        if callable(cache_clear):
+            cache_clear()
+    result_cache = getattr(module, 'result_cache', None)
+    if result_cache is not None:
+        result_cache.clear()
+
+
+def worker(args):
+    """Start the app in this process and print a JSON result to stdout."""
+    sys.path.insert(0, REPO)
+    started = time.perf_counter()
+    import app as dashboard
+    # The data loads in the background; start-up ends when it is all in.
+    dashboard.app_ready.wait()
+    result = {'startup_seconds': time.perf_counter() - started, 'startup_rss_bytes': _rss_bytes()}
+    if args.startup_only:
+        result['peak_rss_bytes'] = _peak_rss_bytes()
+        print(json.dumps(result))
+        return
+
+    from benchmarks.bench_filters import filter_states
+    from nswcrash.store import load_crashes
+
+    client = dashboard.app.server.test_client()
+    dependencies = server_callbacks(client.get('/_dash-dependencies').get_json())
+    states = filter_states(load_crashes(CSV_NAME))
+
+    def run(state, changed):
+        outputs = {}
+        for dependency in dependencies:
+            body = _request(dependency, state, changed)
+            timings = []
+            for _ in range(args.repeat):
+                if not args.cached:
+                    _reset_caches(dashboard)
+                call_started = time.perf_counter()
+                response = client.post('/_dash-update-component', json=body)
+                timings.append(time.perf_counter() - call_started)
+            outputs[dependency['output']] = {
+                'status': response.status_code,
+                'bytes': len(response.get_data()),
+                'median_ms': statistics.median(timings) * 1000,
+                'min_ms': min(timings) * 1000,
+                'max_ms': max(timings) * 1000,
+            }
+        return {
+            'total_ms': sum(output['median_ms'] for output in outputs.values()),
+            'bytes': sum(output['bytes'] for output in outputs.values()),
+            'outputs': outputs,
+        }
+
+    # Page load renders full figures; later interactions may send patches.
+    result['initial'] = run(states['all'], [])
+    result['states'] = {name: run(state, ['year-slider.value']) for name, state in states.items()}
+    result['peak_rss_bytes'] = _peak_rss_bytes()
+    print(json.dumps(result))
+
+
+def _run_worker(data_dir, extra=()):
+    env = dict(os.environ, PYTHONPATH=REPO, CRASH_CACHE_PREWARM='0')
+    env.pop('CRASH_CACHE_PATH', None)
+    completed = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.harness', 'worker', *extra],
+        cwd=data_dir, env=env, check=True, stdout=subprocess.PIPE, text=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _git(*args):
+    try:
+        return subprocess.run(['git', '-C', REPO, *args], check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _environment():
+    import numpy
+    import pandas
+    import plotly
+    import dash
+    return {
+        'commit': _git('rev-parse', 'HEAD'),
+        'dirty': bool(_git('status', '--porcelain', '--untracked-files=no')),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'packages': {module.__name__: module.__version__ for module in (dash, numpy, pandas, plotly)},
+    }
+
+
+def synthetic_extract(data_root, rows, seed):
+    """The directory of the synthetic extract of ``rows`` and ``seed``, generated on first use."""
+    data_dir = os.path.abspath(os.path.join(data_root, 'rows-{}-seed-{}'.format(rows, seed)))
+    csv_path = os.path.join(data_dir, CSV_NAME)
+    if not os.path.exists(csv_path):
+        os.makedirs(data_dir, exist_ok=True)
+        print('generating {:,} rows in {}'.format(rows, data_dir), file=sys.stderr)
+        write_csv(csv_path + '.tmp', rows, seed)
+        os.replace(csv_path + '.tmp', csv_path)
+    return data_dir
+
+
+def bench(args):
+    results = dict(schema=RESULT_SCHEMA, seed=args.seed, repeat=args.repeat, cached=args.cached,
+                   environment=_environment(), runs=[])
+    for rows in args.rows:
+        data_dir = synthetic_extract(args.data_dir, rows, args.seed)
+        csv_path = os.path.join(data_dir, CSV_NAME)
+        shutil.rmtree(os.path.join(data_dir, 'transport_nsw.snapshot'), ignore_errors=True)
+
+        print('benchmarking {:,} rows'.format(rows), file=sys.stderr)
+        cold = _run_worker(data_dir, ['--startup-only'])
+        extra = ['--repeat', str(args.repeat)] + (['--cached'] if args.cached else [])
+        warm = _run_worker(data_dir, extra)
+        run = {
+            'rows': rows,
+            'csv_bytes': os.path.getsize(csv_path),
+            'startup': {'cold_seconds': cold['startup_seconds'], 'warm_seconds': warm['startup_seconds']},
+            'rss': {'startup_bytes': warm['startup_rss_bytes'], 'peak_bytes': warm['peak_rss_bytes'],
+                    'cold_peak_bytes': cold['peak_rss_bytes']},
+            'initial': warm['initial'],
+            'states': warm['states'],
+        }
+        results['runs'].append(run)
+        print('  startup cold {:.2f}s warm {:.2f}s, peak rss {:.0f} MiB'.format(
+            run['startup']['cold_seconds'], run['startup']['warm_seconds'], run['rss']['peak_bytes'] / 2 ** 20),
+            file=sys.stderr)
+        for name, state in [('initial load', run['initial'])] + list(run['states'].items()):
+            print('  {:<22}{:>10.1f} ms{:>12,} bytes'.format(name, state['total_ms'], state['bytes']), file=sys.stderr)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(text + '\n')
+    else:
+        print(text)
+
+
+def _flatten(value, prefix=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(item, '{}/{}'.format(prefix, key) if prefix else str(key))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def _measurements(results):
+    measured = {}
+    for run in results['runs']:
+        for path, value in _flatten({key: run[key] for key in ('startup', 'rss', 'initial', 'states')}):
+            if path.endswith(('seconds', 'bytes', '_ms')) and not path.endswith(('min_ms', 'max_ms')):
+                measured['{:>9} rows  {}'.format(run['rows'], path)] = value
+    return measured
+
+
+def compare(args, measurements=_measurements, width=100):
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print('before: {} ({})'.format(before['environment']['commit'], before['environment']['created']))
+    print('after:  {} ({})'.format(after['environment']['commit'], after['environment']['created']))
+    old, new = measurements(before), measurements(after)
+    for key in sorted(old.keys() & new.keys()):
+        if old[key] == new[key] == 0:
+            # Measurements that stayed at zero, such as error rates
+            continue
+        ratio = new[key] / old[key] if old[key] else float('nan')
+        if args.threshold and abs(ratio - 1) < args.threshold:
+            continue
+        print('{:<{}}{:>14.3f}{:>14.3f}{:>8.2f}x'.format(key, width, old[key], new[key], ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='benchmark the working tree (default)')
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    worker_parser = commands.add_parser('worker', help=argparse.SUPPRESS)
+
+    for sub in (parser, run_parser):
+        sub.add_argument('--rows', type=int, nargs='+', default=[100000])
+        sub.add_argument('--seed', type=int, default=0)
+        sub.add_argument('--repeat', type=int, default=5)
+        sub.add_argument('--cached', action='store_true', help='keep result caches between calls')
+        sub.add_argument('--data-dir', default='.bench-data')
+        sub.add_argument('--output', help='write JSON results here instead of stdout')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=0.0,
+                                help='hide measurements that changed by less than this fraction')
+    worker_parser.add_argument('--repeat', type=int, default=5)
+    worker_parser.add_argument('--cached', action='store_true')
+    worker_parser.add_argument('--startup-only', action='store_true')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        compare(args)
+    elif args.command == 'worker':
+        worker(args)
+    else:
+        bench(args)
+
+
+if __name__ == '__main__':
+    main()
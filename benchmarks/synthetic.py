@@ -0,0 +1,208 @@
+"""Synthetic TfNSW crash extract with the columns and value sets app.py expects.
+
+Usage::
+
+    python -m benchmarks.synthetic 1000000 transport_nsw.csv [--seed 0]
+
+Crashes are placed around the centres of real NSW LGAs (most of them in the
+Sydney, Newcastle and Wollongong conurbation), and the casualty counts agree
+with ``degree_of_crash_detailed``, so filters, aggregates and map density
+behave like the real extract. Output is deterministic for a given row count
+and seed.
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd # type: ignore
+
+METRO = 'Syd-Newc-Woll Gtr conurbation'
+
+# (LGA, latitude, longitude, relative crash weight, in the metro conurbation)
+LGAS = (
+    ('Blacktown', -33.77, 150.91, 6.0, True),
+    ('Canterbury-Bankstown', -33.92, 151.03, 6.0, True),
+    ('Parramatta', -33.80, 151.02, 5.0, True),
+    ('Sydney', -33.88, 151.21, 5.0, True),
+    ('Central Coast', -33.35, 151.35, 5.0, True),
+    ('Cumberland', -33.84, 151.00, 4.0, True),
+    ('Liverpool', -33.93, 150.88, 4.0, True),
+    ('Penrith', -33.75, 150.70, 4.0, True),
+    ('Fairfield', -33.87, 150.93, 3.0, True),
+    ('Sutherland Shire', -34.03, 151.06, 3.0, True),
+    ('The Hills Shire', -33.70, 150.98, 3.0, True),
+    ('Northern Beaches', -33.70, 151.28, 3.0, True),
+    ('Campbelltown', -34.07, 150.82, 3.0, True),
+    ('Inner West', -33.89, 151.15, 3.0, True),
+    ('Newcastle', -32.93, 151.75, 3.0, True),
+    ('Lake Macquarie', -33.05, 151.60, 3.0, True),
+    ('Wollongong', -34.43, 150.88, 3.0, True),
+    ('Bayside', -33.95, 151.17, 2.5, True),
+    ('Hornsby', -33.62, 151.08, 2.5, True),
+    ('Georges River', -33.97, 151.09, 2.0, True),
+    ('Randwick', -33.93, 151.24, 2.0, True),
+    ('Ryde', -33.80, 151.11, 2.0, True),
+    ('Camden', -34.05, 150.70, 1.5, True),
+    ('Maitland', -32.73, 151.56, 1.5, True),
+    ('Shellharbour', -34.58, 150.85, 1.0, True),
+    ('Shoalhaven', -35.00, 150.50, 2.0, False),
+    ('Port Macquarie-Hastings', -31.43, 152.90, 1.5, False),
+    ('Tweed', -28.35, 153.45, 1.5, False),
+    ('Coffs Harbour', -30.30, 153.10, 1.2, False),
+    ('Mid-Coast', -32.00, 152.30, 1.2, False),
+    ('Wagga Wagga', -35.12, 147.37, 1.2, False),
+    ('Tamworth Regional', -31.10, 150.93, 1.0, False),
+    ('Dubbo Regional', -32.25, 148.60, 1.0, False),
+    ('Orange', -33.28, 149.10, 0.8, False),
+    ('Bathurst Regional', -33.42, 149.58, 0.8, False),
+    ('Albury', -36.08, 146.92, 0.8, False),
+    ('Queanbeyan-Palerang Regional', -35.35, 149.30, 0.8, False),
+    ('Clarence Valley', -29.70, 152.90, 0.8, False),
+    ('Bega Valley', -36.70, 149.80, 0.6, False),
+    ('Lismore', -28.81, 153.28, 0.6, False),
+    ('Griffith', -34.29, 146.05, 0.5, False),
+    ('Broken Hill', -31.95, 141.45, 0.2, False),
+)
+
+WEATHER = (
+    ('Fine', 0.775), ('Raining', 0.13), ('Overcast', 0.075), ('Fog or mist', 0.01),
+    ('Snowing', 0.001), ('Other', 0.004), ('Unknown', 0.005),
+)
+DEGREES = (
+    ('Non-casualty (towaway)', 0.36), ('Minor/Other Injury', 0.2), ('Moderate Injury', 0.25),
+    ('Serious Injury', 0.17), ('Fatal', 0.02),
+)
+LOCATIONS = (
+    ('2-way undivided', 0.38), ('T-junction', 0.2), ('Divided road', 0.16), ('X-intersection', 0.1),
+    ('Roundabout', 0.06), ('One-way street', 0.03), ('Y-junction', 0.02), ('Other', 0.05),
+)
+# Speed zones for urban and rural roads.
+METRO_SPEEDS = (
+    ('40 km/h', 0.06), ('50 km/h', 0.3), ('60 km/h', 0.38), ('70 km/h', 0.1), ('80 km/h', 0.09),
+    ('90 km/h', 0.02), ('100 km/h', 0.03), ('110 km/h', 0.01), ('10 km/h', 0.005), ('Unknown', 0.005),
+)
+RURAL_SPEEDS = (
+    ('40 km/h', 0.02), ('50 km/h', 0.18), ('60 km/h', 0.14), ('70 km/h', 0.06), ('80 km/h', 0.12),
+    ('90 km/h', 0.04), ('100 km/h', 0.3), ('110 km/h', 0.13), ('Unknown', 0.01),
+)
+WEEKDAYS = (
+    ('Monday', 0.135), ('Tuesday', 0.14), ('Wednesday', 0.145), ('Thursday', 0.15), ('Friday', 0.17),
+    ('Saturday', 0.14), ('Sunday', 0.12),
+)
+# Crashes per two-hour interval, peaking in the afternoon commute.
+TWO_HOUR_INTERVALS = (
+    ('00:00 - 01:59', 0.02), ('02:00 - 03:59', 0.015), ('04:00 - 05:59', 0.025), ('06:00 - 07:59', 0.07),
+    ('08:00 - 09:59', 0.105), ('10:00 - 11:59', 0.1), ('12:00 - 13:59', 0.115), ('14:00 - 15:59', 0.14),
+    ('16:00 - 17:59', 0.155), ('18:00 - 19:59', 0.1), ('20:00 - 21:59', 0.06), ('22:00 - 23:59', 0.04),
+    ('Unknown', 0.005),
+)
+MONTHS = ('January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December')
+STREETS = ('PACIFIC HWY', 'GREAT WESTERN HWY', 'HUME HWY', 'PRINCES HWY', 'NEW ENGLAND HWY', 'M4', 'M1',
+           'PARRAMATTA RD', 'GEORGE ST', 'VICTORIA RD', 'KING GEORGES RD', 'CUMBERLAND HWY', 'MAIN ST')
+
+
+def _choice(rng, pairs, n):
+    values, weights = zip(*pairs)
+    weights = np.asarray(weights, dtype=np.float64)
+    return np.asarray(values, dtype=object)[rng.choice(len(values), n, p=weights / weights.sum())]
+
+
+def generate(rows, seed=0, years=(2018, 2023), first_crash_id=1000000):
+    """Return a DataFrame of ``rows`` synthetic crashes."""
+    rng = np.random.default_rng(seed)
+    names, lats, lons, weights, metro = (np.asarray(column) for column in zip(*LGAS))
+
+    # The first year is a partial year in the real extract.
+    year_values = np.arange(years[0], years[1] + 1)
+    year_weights = np.ones(len(year_values))
+    year_weights[0] = 0.3
+    year = np.sort(rng.choice(year_values, rows, p=year_weights / year_weights.sum()))
+
+    lga = rng.choice(len(names), rows, p=weights / weights.sum())
+    in_metro = metro[lga]
+    spread = np.where(in_metro, 0.05, 0.25)
+    latitude = np.round(lats[lga] + rng.normal(0, 1, rows) * spread, 6)
+    longitude = np.round(lons[lga] + rng.normal(0, 1, rows) * spread, 6)
+
+    conurbation = np.where(in_metro, METRO, np.where(rng.random(rows) < 0.6, 'Rest of NSW - Urban', 'Rest of NSW - Rural'))
+    conurbation = np.where(rng.random(rows) < 0.002, 'Rest of NSW - Unknown', conurbation).astype(object)
+
+    weather = _choice(rng, WEATHER, rows)
+    wet = (weather == 'Raining') & (rng.random(rows) < 0.85) | (weather != 'Raining') & (rng.random(rows) < 0.04)
+    surface = np.where(wet, 'Wet', 'Dry').astype(object)
+    surface[(weather == 'Snowing') | (rng.random(rows) < 0.001)] = 'Snow or ice'
+    surface[rng.random(rows) < 0.003] = 'Unknown'
+
+    speed = np.where(in_metro, _choice(rng, METRO_SPEEDS, rows), _choice(rng, RURAL_SPEEDS, rows))
+    degree = _choice(rng, DEGREES, rows)
+
+    # Casualty counts consistent with the crash degree: the worst injury
+    # named by the degree is present, lesser injuries occur at random.
+    casualty = degree != 'Non-casualty (towaway)'
+    killed = np.where(degree == 'Fatal', 1 + rng.poisson(0.15, rows), 0)
+    seriously = np.where(degree == 'Serious Injury', 1, 0) + np.where(np.isin(degree, ('Fatal', 'Serious Injury')), rng.poisson(0.3, rows), 0)
+    moderately = np.where(degree == 'Moderate Injury', 1, 0) + np.where(np.isin(degree, ('Fatal', 'Serious Injury', 'Moderate Injury')), rng.poisson(0.25, rows), 0)
+    minor = np.where(degree == 'Minor/Other Injury', 1, 0) + np.where(casualty, rng.poisson(0.3, rows), 0)
+    traffic_units = 1 + rng.binomial(3, np.where(in_metro, 0.4, 0.25))
+
+    # The partial first year only has crashes from July.
+    first_month = np.where(year == years[0], 6, 0)
+    month = np.asarray(MONTHS, dtype=object)[first_month + (rng.random(rows) * (12 - first_month)).astype(int)]
+    weekday = _choice(rng, WEEKDAYS, rows)
+    two_hours = _choice(rng, TWO_HOUR_INTERVALS, rows)
+
+    frame = pd.DataFrame({
+        'crash_id': np.arange(first_crash_id, first_crash_id + rows),
+        'year_of_crash': year,
+        'month_of_crash': month,
+        'day_of_week_of_crash': weekday,
+        'two_hour_intervals': two_hours,
+        'latitude': latitude,
+        'longitude': longitude,
+        'lga': names[lga].astype(object),
+        'street_of_crash': np.asarray(STREETS, dtype=object)[rng.integers(0, len(STREETS), rows)],
+        'type_of_location': _choice(rng, LOCATIONS, rows),
+        'conurbation_1': conurbation,
+        'speed_limit': speed,
+        'weather': weather,
+        'surface_condition': surface,
+        'degree_of_crash_detailed': degree,
+        'no_of_traffic_units_involved': traffic_units,
+        'no_killed': killed,
+        'no_seriously_injured': seriously,
+        'no_moderately_injured': moderately,
+        'no_minor_other_injured': minor,
+    })
+
+    # The extract has a few crashes without coordinates or weather.
+    frame.loc[rng.random(rows) < 0.005, ['latitude', 'longitude']] = np.nan
+    frame.loc[rng.random(rows) < 0.002, 'weather'] = np.nan
+    return frame
+
+
+def write_csv(path, rows, seed=0, chunk_rows=1000000):
+    """Write ``rows`` synthetic crashes to ``path`` in chunks of ``chunk_rows``."""
+    written = 0
+    chunk = 0
+    while written < rows or chunk == 0:
+        n = min(chunk_rows, rows - written)
+        frame = generate(n, seed=[seed, chunk], first_crash_id=1000000 + written)
+        frame.to_csv(path, index=False, mode='w' if chunk == 0 else 'a', header=chunk == 0)
+        written += n
+        chunk += 1
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('rows', type=int)
+    parser.add_argument('csv', nargs='?', default='transport_nsw.csv')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    write_csv(args.csv, args.rows, args.seed)
+    print('wrote {:,} rows to {}'.format(args.rows, args.csv))
+
+
+if __name__ == '__main__':
+    main()
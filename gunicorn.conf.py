@@ -0,0 +1,33 @@
+"""gunicorn settings for the dashboard: ``gunicorn -c gunicorn.conf.py app:server``.
+
+By default the master imports app.py, loading the crash data once, and then
+forks the workers. The workers share the loaded arrays copy-on-write and the
+memory-mapped snapshot through the page cache, so resident memory grows far
+less than linearly with the worker count. Only the default dataset is
+preloaded: the others named in ``CRASH_DATASETS`` load in each worker when
+first shown, and ``CRASH_DATASET_MAX_BYTES`` budgets each worker's datasets.
+Set ``CRASH_PRELOAD=0`` to have each worker load the data itself instead:
+the workers then answer at once and load in the background, and ``/ready``
+returns 200 once a worker's data is in.
+"""
+
+import gc
+import os
+
+preload_app = os.environ.get('CRASH_PRELOAD', '1') == '1'
+# app.py loads in the foreground and holds back its background threads
+# until the workers are forked.
+os.environ['CRASH_PRELOAD'] = '1' if preload_app else '0'
+
+
+def pre_fork(server, worker):
+    # Exclude everything loaded so far from garbage collection, so collections
+    # in the workers do not write to those objects and un-share their pages.
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    if preload_app:
+        import app
+        # The cache was pre-warmed in the master before forking.
+        app.start_background_tasks(prewarm=False)
@@ -0,0 +1,10 @@
+"""Data layer for the NSW Road Crash Dashboard."""
+
+from nswcrash.crossfilter import CrossFilter
+from nswcrash.cube import CrashCube
+from nswcrash.dataset import CrashData, DatasetReloader
+from nswcrash.index import FilterIndex
+from nswcrash.registry import DatasetRegistry
+from nswcrash.store import CrashStore, load_crashes
+
+__all__ = ['CrashCube', 'CrashData', 'CrossFilter', 'DatasetRegistry', 'DatasetReloader', 'CrashStore', 'FilterIndex', 'load_crashes']
@@ -0,0 +1,239 @@
+"""Bounded LRU cache of rendered callback results.
+
+Results are stored as Plotly JSON under a byte budget, with least recently
+used entries evicted first. ``MemoryBackend`` keeps them in the worker;
+``SQLiteBackend`` keeps them in a local SQLite file, so every gunicorn worker
+on the host shares one cache and one pre-warm. Keys are prefixed with the
+cache's namespace, and ``ResultCache.namespaced`` carves out a sub-namespace
+(e.g. per dataset) that is cleared on its own but shares the byte budget.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from plotly.io.json import to_json_plotly # type: ignore
+
+from nswcrash.metrics import output_bytes, stage
+
+
+class MemoryBackend:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store ``value`` and return the number of entries evicted."""
+        evicted = 0
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            if len(value) > self.max_bytes:
+                return evicted
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, dropped = self.entries.popitem(last=False)
+                self.size -= len(dropped)
+                evicted += 1
+        return evicted
+
+    def usage(self):
+        with self.lock:
+            return len(self.entries), self.size
+
+    def clear(self, prefix=''):
+        """Drop the entries whose key starts with ``prefix`` (all by default)."""
+        with self.lock:
+            if not prefix:
+                self.entries.clear()
+                self.size = 0
+                return
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                self.size -= len(self.entries.pop(key))
+
+
+# How stale (in seconds) a SQLite entry's last use may get before a hit
+# records it. A hit otherwise only reads, so workers do not queue for the
+# write lock to serve cached results; eviction order is as coarse.
+TOUCH_INTERVAL = 60.0
+
+
+class SQLiteBackend:
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        with self.connect() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            # Running totals of the entries, kept by triggers so that neither
+            # a set nor a scrape sums the whole table.
+            db.execute('CREATE TABLE IF NOT EXISTS usage ('
+                       'id INTEGER PRIMARY KEY CHECK (id = 0), entries INTEGER NOT NULL, bytes INTEGER NOT NULL)')
+            db.execute('INSERT OR IGNORE INTO usage SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM results')
+            db.execute('CREATE TRIGGER IF NOT EXISTS results_added AFTER INSERT ON results BEGIN '
+                       'UPDATE usage SET entries = entries + 1, bytes = bytes + NEW.size; END')
+            db.execute('CREATE TRIGGER IF NOT EXISTS results_dropped AFTER DELETE ON results BEGIN '
+                       'UPDATE usage SET entries = entries - 1, bytes = bytes - OLD.size; END')
+
+    def connect(self):
+        # One connection per thread and process; connections must not cross a fork.
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db, self.local.pid = db, os.getpid()
+        return db
+
+    def get(self, key):
+        db = self.connect()
+        row = db.execute('SELECT value, accessed FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > TOUCH_INTERVAL:
+            db.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+        return row[0].decode()
+
+    def set(self, key, value):
+        """Store ``value`` and return the number of entries evicted."""
+        data = value.encode()
+        if len(data) > self.max_bytes:
+            return 0
+        db = self.connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Not INSERT OR REPLACE: its deletes do not fire the triggers.
+            db.execute('DELETE FROM results WHERE key = ?', (key,))
+            db.execute('INSERT INTO results (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+                       (key, data, len(data), time.time()))
+            evicted = 0
+            excess = db.execute('SELECT bytes FROM usage').fetchone()[0] - self.max_bytes
+            if excess > 0:
+                # Count the least recently used entries that free enough
+                # space, reading no further along the index than that.
+                count = 0
+                cursor = db.execute('SELECT size FROM results ORDER BY accessed')
+                for (size,) in cursor:
+                    count += 1
+                    excess -= size
+                    if excess <= 0:
+                        break
+                cursor.close()
+                evicted = db.execute(
+                    'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed LIMIT ?)', (count,)
+                ).rowcount
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return evicted
+
+    def usage(self):
+        return tuple(self.connect().execute('SELECT entries, bytes FROM usage').fetchone())
+
+    def clear(self, prefix=''):
+        """Drop the entries whose key starts with ``prefix`` (all by default)."""
+        self.connect().execute('DELETE FROM results WHERE substr(key, 1, ?) = ?', (len(prefix), prefix))
+
+
+class ResultCache:
+    """Memoise callback results by key, counting hits, misses and evictions."""
+
+    def __init__(self, backend, namespace=''):
+        self.backend = backend
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def namespaced(self, name):
+        """A cache under the sub-namespace ``name`` of this one.
+
+        It shares the backend (so the byte budget) and the counters, but
+        ``clear()`` on it drops only its own entries.
+        """
+        cache = ResultCache(self.backend, '{}:{}'.format(self.namespace, name))
+        cache.lock, cache.counters = self.lock, self.counters
+        return cache
+
+    def full_key(self, key):
+        return '{}:{}'.format(self.namespace, json.dumps(key, separators=(',', ':')))
+
+    def get_or_build(self, key, build, count=True, serialized=False):
+        """Return the cached result for ``key``, calling ``build()`` on a miss.
+
+        Hits come back as decoded JSON (plain dicts and lists), which Dash
+        serialises exactly as it would the original figures and patches.
+        Pass ``count=False`` for lookups that should not show in the hit
+        rate, such as pre-warming, and ``serialized=True`` when ``build()``
+        already returns the Plotly JSON.
+        """
+        output = key[0]
+        full_key = self.full_key(key)
+        cached = self.backend.get(full_key)
+        if cached is not None:
+            if count:
+                self._count('hits')
+                output_bytes.observe(len(cached), output=output)
+            return json.loads(cached)
+        if count:
+            self._count('misses')
+        value = build()
+        if serialized:
+            serialized, value = value, json.loads(value)
+        else:
+            with stage('serialize', output):
+                serialized = to_json_plotly(value)
+        if count:
+            output_bytes.observe(len(serialized), output=output)
+        self._count('evictions', self.backend.set(full_key, serialized))
+        return value
+
+    def stats(self):
+        entries, size = self.backend.usage()
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats['hits'] + stats['misses']
+        stats.update(entries=entries, bytes=size, max_bytes=self.backend.max_bytes,
+                     hit_rate=stats['hits'] / lookups if lookups else 0.0)
+        return stats
+
+    def clear(self):
+        """Drop the entries of this namespace and its sub-namespaces."""
+        self.backend.clear(self.namespace + ':' if self.namespace else '')
+
+
+def result_cache_from_env(namespace=''):
+    """Build the cache from ``CRASH_CACHE_BYTES`` and ``CRASH_CACHE_PATH``.
+
+    With ``CRASH_CACHE_PATH`` set, results live in that SQLite file and are
+    shared by every worker on the host; otherwise each worker keeps its own.
+    """
+    max_bytes = int(os.environ.get('CRASH_CACHE_BYTES', 64 * 1024 * 1024))
+    path = os.environ.get('CRASH_CACHE_PATH')
+    backend = SQLiteBackend(path, max_bytes) if path else MemoryBackend(max_bytes)
+    return ResultCache(backend, namespace)
@@ -0,0 +1,97 @@
+"""Compression of the dashboard's responses.
+
+Callback payloads and the layout are JSON that repeats the same figure
+theme for every chart, and vector tiles are protobuf with many small
+integers; both shrink several times under gzip or brotli. Responses at or
+above a size threshold are compressed with the encoding the client rates
+highest in Accept-Encoding: brotli (when the ``brotli`` package is
+installed) or gzip, preferring brotli on a tie.
+Smaller responses would gain little over the header overhead. Responses with
+a strong ETag (Dash's script bundles, tiles) are compressed once per tag.
+"""
+
+import gzip
+import os
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+from nswcrash.metrics import registry, stage, BYTES_BUCKETS
+
+try:
+    import brotli # type: ignore
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'application/vnd.mapbox-vector-tile',
+                      'text/html', 'text/css', 'text/plain')
+
+response_bytes = registry.histogram(
+    'crash_response_bytes', 'Response body bytes sent, by content encoding.', ('encoding',), BYTES_BUCKETS)
+
+
+def _encoding(accept_encodings):
+    # The encoding of highest quality among those the client accepts (q > 0),
+    # brotli on a tie; ``accept_encodings`` is werkzeug's parsed header.
+    return accept_encodings.best_match(('br', 'gzip') if brotli is not None else ('gzip',))
+
+
+def compress(body, encoding, gzip_level=6, brotli_quality=5):
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=gzip_level, mtime=0)
+
+
+def compress_responses(server):
+    """Compress ``server``'s responses according to the environment.
+
+    ``CRASH_COMPRESS_MIN_BYTES`` (default 1024) is the smallest body that
+    gets compressed; 0 turns compression off. ``CRASH_GZIP_LEVEL`` (default
+    6) and ``CRASH_BROTLI_QUALITY`` (default 5) trade CPU for size.
+    """
+    min_bytes = int(os.environ.get('CRASH_COMPRESS_MIN_BYTES', 1024))
+    gzip_level = int(os.environ.get('CRASH_GZIP_LEVEL', 6))
+    brotli_quality = int(os.environ.get('CRASH_BROTLI_QUALITY', 5))
+    if min_bytes <= 0:
+        return
+    by_etag = OrderedDict()
+    lock = threading.Lock()
+
+    def compressed(body, encoding, etag):
+        if not etag:
+            return compress(body, encoding, gzip_level, brotli_quality)
+        with lock:
+            cached = by_etag.get((etag, encoding))
+            if cached is not None:
+                by_etag.move_to_end((etag, encoding))
+                return cached
+        cached = compress(body, encoding, gzip_level, brotli_quality)
+        with lock:
+            by_etag[etag, encoding] = cached
+            while len(by_etag) > 256:
+                by_etag.popitem(last=False)
+        return cached
+
+    @server.after_request
+    def compress_response(response):
+        # Streamed bodies (exports) are sent as they are made, not buffered here.
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+            return response
+        response.vary.add('Accept-Encoding')
+        body = response.get_data()
+        encoding = _encoding(request.accept_encodings)
+        if encoding is None or len(body) < min_bytes:
+            response_bytes.observe(len(body), encoding='identity')
+            return response
+        etag, weak = response.get_etag()
+        with stage('compress', encoding):
+            body = compressed(body, encoding, None if weak else etag)
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        if etag and not weak:
+            # The strong ETag named the uncompressed bytes.
+            response.set_etag(etag, weak=True)
+        response_bytes.observe(len(body), encoding=encoding)
+        return response
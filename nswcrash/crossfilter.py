@@ -0,0 +1,215 @@
+"""Cross-filtering between the charts, updated as slices are toggled.
+
+Clicking a slice of the degree pie or region donut, or a bar of the speed
+limit or location chart, filters the other charts to that category. As in
+crossfilter, each chart ignores the filter on its own column, so its other
+categories stay visible to be added to the selection.
+
+A ``CrossFilter`` keeps the totals of every chart over the crashes of one
+dropdown and map state (its base rows) under the chart filters it was last
+given. Each chart column has an index of the base rows sorted by category,
+so a category's rows are one slice of it, and each row keeps one bit per
+chart filter it fails. Changing a column's filter only visits the rows of
+the categories entering or leaving it: a row failing no other filter is
+added to or taken from every chart but that column's own, and a row failing
+exactly one other filter only that filter's chart. Toggling a slice costs
+time in proportion to its crashes rather than to the selection.
+"""
+
+import functools
+import threading
+
+import numpy as np
+
+from nswcrash.cube import GROUP_MEASURES, SUM_COLUMNS, TIME_MEASURES, CubeSlice, _by_time, _by_year
+from nswcrash.index import CHART_FILTER_COLUMNS
+from nswcrash.store import SOURCE_ROW, TIME_COLUMNS
+
+# Totals besides the charts' own groups: the KPI cards over all filters, and
+# the trend per year and per year and time bin.
+ALL = 'all'
+YEAR = 'year'
+GROUPS = CHART_FILTER_COLUMNS + (ALL, YEAR) + tuple(TIME_COLUMNS)
+
+
+def _filter_codes(labels, values):
+    # Categories of ``values`` as shifted codes (code + 1, so a missing
+    # category is 0), or None when the column is not filtered. Values not
+    # in the data match nothing.
+    if values is None:
+        return None
+    codes = {label: code for code, label in enumerate(labels)}
+    return frozenset(codes[value] + 1 for value in values if value in codes)
+
+
+def chart_mask(store, rows, charts):
+    """Which of ``rows`` pass every chart filter of ``charts`` (as ``key_charts``)."""
+    mask = np.ones(len(rows), dtype=bool)
+    for name, values in (charts or {}).items():
+        codes = _filter_codes(store.labels(name), values)
+        if codes is not None:
+            mask &= np.isin(np.asarray(store[name])[rows], [code - 1 for code in codes])
+    return mask
+
+
+class CrossFilter:
+    """Chart totals over base ``rows`` that follow the chart filters incrementally.
+
+    ``select`` may be called from several threads; each call moves the
+    filters to its own state under a lock.
+    """
+
+    def __init__(self, cube, store, rows):
+        self.cube = cube
+        self.store = store
+        self.rows = rows
+        self.lock = threading.Lock()
+        self.filters = dict.fromkeys(CHART_FILTER_COLUMNS)
+        self.bits = {name: np.uint8(1 << bit) for bit, name in enumerate(CHART_FILTER_COLUMNS)}
+        # Bits of the chart filters each base row fails
+        self.excluded = np.zeros(len(rows), dtype=np.uint8)
+        self._indexes = {}
+        self.groups = {group: self._reduce(group, rows) for group in GROUPS}
+
+    def _reduce(self, group, rows):
+        # The measures of ``group`` summed over ``rows`` per bin, as a
+        # (bins, measures) matrix.
+        cube = self.cube
+        if group in GROUP_MEASURES:
+            keys = np.asarray(self.store[group])[rows].astype(np.int64) + 1
+            n_bins = len(cube.group_labels[group]) + 1
+            measures = GROUP_MEASURES[group]
+        elif group == ALL:
+            keys, n_bins, measures = None, 1, ('crashes',) + SUM_COLUMNS
+        else:
+            keys = np.searchsorted(cube.years, np.asarray(self.store['year_of_crash'])[rows])
+            n_bins = len(cube.years)
+            measures = TIME_MEASURES
+            if group != YEAR:
+                n_time = len(cube.time_labels[group]) + 1
+                keys = keys * n_time + np.asarray(self.store[group])[rows].astype(np.int64) + 1
+                n_bins *= n_time
+        sums = np.empty((n_bins, len(measures)), dtype=np.int64)
+        for column, measure in enumerate(measures):
+            weights = None if measure == 'crashes' else np.asarray(self.store[measure])[rows]
+            if keys is None:
+                sums[0, column] = len(rows) if weights is None else weights.sum(dtype=np.int64)
+            else:
+                sums[:, column] = np.bincount(keys, weights=weights, minlength=n_bins)
+        return sums
+
+    def _index(self, name):
+        # Base row positions sorted by their category of ``name``, then by
+        # their order in the extract, and the offsets where each shifted code
+        # starts; built on first use.
+        index = self._indexes.get(name)
+        if index is None:
+            codes = np.asarray(self.store[name])[self.rows].astype(np.int64) + 1
+            order = np.lexsort((np.asarray(self.store[SOURCE_ROW])[self.rows], codes)).astype(np.int32)
+            bounds = np.searchsorted(codes[order], np.arange(len(self.cube.group_labels[name]) + 2))
+            index = self._indexes[name] = (order, bounds)
+        return index
+
+    def _move(self, name, positions, sign):
+        # Add (sign 1) or take (sign -1) the base rows at ``positions``, which
+        # enter or leave the filter on ``name``, to or from the totals.
+        bit = self.bits[name]
+        others = self.excluded[positions] & ~bit
+        counted = positions[others == 0]
+        if len(counted):
+            rows = self.rows[counted]
+            for group in GROUPS:
+                if group != name:
+                    self.groups[group] += sign * self._reduce(group, rows)
+        for other in CHART_FILTER_COLUMNS:
+            if other != name:
+                only = positions[others == self.bits[other]]
+                if len(only):
+                    self.groups[other] += sign * self._reduce(other, self.rows[only])
+
+    def _set_filter(self, name, codes):
+        old = self.filters[name]
+        if codes == old:
+            return
+        all_codes = np.arange(len(self.cube.group_labels[name]) + 1)
+        passed = np.ones(len(all_codes), dtype=bool) if old is None else np.isin(all_codes, list(old))
+        passes = np.ones(len(all_codes), dtype=bool) if codes is None else np.isin(all_codes, list(codes))
+        order, bounds = self._index(name)
+
+        def positions(changed):
+            return np.concatenate([order[bounds[code]:bounds[code + 1]] for code in np.flatnonzero(changed)]
+                                  + [np.empty(0, dtype=order.dtype)])
+
+        leaving, entering = positions(passed & ~passes), positions(passes & ~passed)
+        self._move(name, leaving, -1)
+        self.excluded[leaving] |= self.bits[name]
+        self.excluded[entering] &= ~self.bits[name]
+        self._move(name, entering, 1)
+        self.filters[name] = codes
+
+    def _first_rows(self, excluded, name, codes):
+        # Where each category of ``codes`` first occurs in the extract among
+        # the rows the chart of ``name`` counts, those failing no filter but
+        # its own (as bits in ``excluded``): the first such row of the
+        # category's part of the index.
+        order, bounds = self._index(name)
+        others = ~self.bits[name]
+        source_rows = np.asarray(self.store[SOURCE_ROW])
+        first = np.empty(len(codes), dtype=np.int64)
+        for number, code in enumerate(codes):
+            positions = order[bounds[code + 1]:bounds[code + 2]]
+            first[number] = source_rows[self.rows[positions[(excluded[positions] & others) == 0][0]]]
+        return first
+
+    def select(self, charts, rows=False):
+        """The ``CrossSlice`` of the chart filters ``charts`` (as ``key_charts``).
+
+        With ``rows``, the slice also holds the base rows passing every filter.
+        """
+        charts = charts or {}
+        with self.lock:
+            for name in CHART_FILTER_COLUMNS:
+                self._set_filter(name, _filter_codes(self.cube.group_labels[name], charts.get(name)))
+            selected = self.rows[self.excluded == 0] if rows else None
+            first_rows = functools.partial(self._first_rows, self.excluded.copy())
+            return CrossSlice(self.cube, {group: sums.copy() for group, sums in self.groups.items()}, selected,
+                              first_rows)
+
+
+class CrossSlice(CubeSlice):
+    """``CubeSlice`` aggregates of a ``CrossFilter`` state.
+
+    Each chart column's categories are counted without that column's own
+    filter; every other total passes all the filters.
+    """
+
+    def __init__(self, cube, groups, rows=None, first_rows=None):
+        self.cube = cube
+        self.groups = groups
+        self.rows = rows
+        self.first_rows = first_rows
+        sums = np.zeros(cube.measures.shape[1], dtype=np.int64)
+        for column, measure in enumerate(('crashes',) + SUM_COLUMNS):
+            sums[cube.columns[measure]] = groups[ALL][0, column]
+        for name, measures in GROUP_MEASURES.items():
+            n_categories = len(cube.group_labels[name])
+            for column, measure in enumerate(measures):
+                start = cube.columns[(name, measure)]
+                # Bin 0 holds the crashes missing the category.
+                sums[start:start + n_categories] = groups[name][1:, column]
+        self.sums = sums
+
+    def by_year(self):
+        sums = self.groups[YEAR]
+        return _by_year(self.cube.years, self.cube.years, sums[:, TIME_MEASURES.index('crashes')],
+                        sums[:, TIME_MEASURES.index('no_killed')])
+
+    def by_time(self, name, excluded_years=()):
+        cube = self.cube
+        labels = cube.time_labels[name]
+        sums = self.groups[name].reshape(len(cube.years), len(labels) + 1, len(TIME_MEASURES))
+        sums = sums[~np.isin(cube.years, excluded_years), 1:].sum(axis=0)
+        return _by_time(name, labels, {measure: sums[:, column] for column, measure in enumerate(TIME_MEASURES)})
+
+    def cells(self, measures):
+        raise TypeError('a cross-filtered selection has no cube cells')
@@ -0,0 +1,285 @@
+"""Pre-aggregated crash cube keyed by (year, weather, surface condition, LGA).
+
+Every KPI card and chart except the map is an aggregate over the filtered
+rows. The cube sums those measures once per cell at load, so a callback only
+selects the matching cells (a few thousand at most, however many crashes the
+extract holds) and adds up their rows of the measure matrix. The trend
+chart's month, weekday and time-of-day series are added up the same way from
+per-cell counts of the time bins the snapshot codes at ingest.
+"""
+
+import numpy as np
+
+from nswcrash.index import FILTER_COLUMNS, active_values
+from nswcrash.store import SOURCE_ROW, TIME_COLUMNS
+
+SUM_COLUMNS = (
+    'no_of_traffic_units_involved',
+    'no_moderately_injured',
+    'no_seriously_injured',
+    'no_killed',
+)
+# Per-category breakdowns: column -> measures summed for each category.
+GROUP_MEASURES = {
+    'speed_limit': ('crashes', 'no_killed', 'no_of_traffic_units_involved'),
+    'type_of_location': ('crashes',),
+    'conurbation_1': ('crashes',),
+    'degree_of_crash_detailed': ('crashes',),
+}
+# Measures of the trend chart, summed per bin of each time column
+TIME_MEASURES = ('crashes', 'no_killed')
+
+
+def _group_sums(cell, n_cells, codes, n_categories, weights=None):
+    # Sum per (cell, category); rows with a missing category (-1) are dropped,
+    # as value_counts and groupby do.
+    valid = codes >= 0
+    flat = cell[valid] * n_categories + codes[valid]
+    weights = None if weights is None else weights[valid]
+    sums = np.bincount(flat, weights=weights, minlength=n_cells * n_categories)
+    return sums.reshape(n_cells, n_categories).astype(np.int64)
+
+
+def _first_rows(codes, n_categories, source_rows, cell=None, n_cells=1):
+    # The smallest source row per (cell, category), or per category without
+    # ``cell``; the dtype's largest value where there is none.
+    valid = codes >= 0
+    flat = codes[valid] if cell is None else cell[valid] * n_categories + codes[valid]
+    first = np.full(n_cells * n_categories, np.iinfo(source_rows.dtype).max, dtype=source_rows.dtype)
+    np.minimum.at(first, flat, source_rows[valid])
+    return first.reshape(n_cells, n_categories)
+
+
+class CrashCube:
+
+    def __init__(self, store, dimensions=FILTER_COLUMNS):
+        self.dimensions = dimensions
+        self.labels = {name: store.labels(name) for name in dimensions}
+        self.codes = {name: {label: code for code, label in enumerate(labels)} for name, labels in self.labels.items()}
+
+        # Pack (year, codes...) into one integer key; year is most significant,
+        # so cells come out sorted by year.
+        years = np.asarray(store['year_of_crash']).astype(np.int64)
+        key = years - (years.min() if len(years) else 0)
+        for name in dimensions:
+            key = key * (len(self.labels[name]) + 1) + (np.asarray(store[name]).astype(np.int64) + 1)
+        cell_keys, first_row, cell = np.unique(key, return_index=True, return_inverse=True)
+        n_cells = len(cell_keys)
+
+        self.cell_years = years[first_row]
+        self.cell_codes = {name: np.asarray(store[name])[first_row] for name in dimensions}
+
+        # Measure matrix: one row per cell, one column per measure.
+        blocks = []
+        self.columns = {}
+
+        def add(measure, block):
+            self.columns[measure] = sum(b.shape[1] for b in blocks)
+            blocks.append(block.reshape(n_cells, -1))
+
+        add('crashes', np.bincount(cell, minlength=n_cells))
+        for name in SUM_COLUMNS:
+            add(name, np.bincount(cell, weights=np.asarray(store[name]), minlength=n_cells))
+
+        self.group_labels = {}
+        # Where each category first occurs in each cell, in the extract's
+        # order, for counts() to break ties as value_counts does.
+        self.first_rows = {}
+        source_rows = np.asarray(store[SOURCE_ROW])
+        for name, measures in GROUP_MEASURES.items():
+            self.group_labels[name] = store.labels(name)
+            codes = np.asarray(store[name]).astype(np.int64)
+            for measure in measures:
+                weights = None if measure == 'crashes' else np.asarray(store[measure])
+                add((name, measure), _group_sums(cell, n_cells, codes, len(self.group_labels[name]), weights))
+            self.first_rows[name] = _first_rows(codes, len(self.group_labels[name]), source_rows, cell, n_cells)
+
+        self.measures = np.hstack(blocks).astype(np.int64)
+        self.years = np.unique(self.cell_years)
+
+        # Per-cell sums of each time bin, for the trend chart's finer
+        # granularities. They are kept out of the measure matrix, so the
+        # slices of the other charts do not sum them.
+        self.time_labels = {name: store.labels(name) for name in TIME_COLUMNS}
+        self.time_columns = {}
+        time_blocks = []
+        for name, labels in self.time_labels.items():
+            codes = np.asarray(store[name]).astype(np.int64)
+            for measure in TIME_MEASURES:
+                weights = None if measure == 'crashes' else np.asarray(store[measure])
+                self.time_columns[(name, measure)] = sum(block.shape[1] for block in time_blocks)
+                time_blocks.append(_group_sums(cell, n_cells, codes, len(labels), weights))
+        self.time_measures = np.hstack(time_blocks)
+
+    def __len__(self):
+        return len(self.cell_years)
+
+    def select(self, year_range, selections):
+        """Return the ``CubeSlice`` of cells matching the dashboard filter state."""
+        start_year, end_year = year_range
+        mask = (self.cell_years >= start_year) & (self.cell_years <= end_year)
+        for name, selected in selections.items():
+            values = active_values(selected)
+            if values is None:
+                continue
+            codes = [self.codes[name][value] for value in values if value in self.codes[name]]
+            mask &= np.isin(self.cell_codes[name], codes)
+        return CubeSlice(self, mask)
+
+
+def _by_year(years, cell_years, crashes, killed):
+    import pandas as pd # type: ignore
+    year_index = np.searchsorted(years, cell_years)
+    frame = pd.DataFrame({
+        'year_of_crash': years,
+        'crashes': np.bincount(year_index, weights=crashes, minlength=len(years)).astype(np.int64),
+        'no_killed': np.bincount(year_index, weights=killed, minlength=len(years)).astype(np.int64),
+    })
+    return frame[frame['crashes'] > 0].reset_index(drop=True)
+
+
+def _by_time(name, labels, sums):
+    import pandas as pd # type: ignore
+    return pd.DataFrame({name: labels, **sums})
+
+
+class CubeSlice:
+    """Aggregates over a selection of cube cells; the measure sums are taken once."""
+
+    def __init__(self, cube, mask):
+        self.cube = cube
+        self.mask = mask
+        self.sums = cube.measures[mask].sum(axis=0)
+
+    def totals(self):
+        """KPI sums over the selected cells, keyed by measure name."""
+        columns = self.cube.columns
+        return {name: int(self.sums[columns[name]]) for name in ('crashes',) + SUM_COLUMNS}
+
+    def by_year(self):
+        """Crashes and people killed per year with at least one crash."""
+        cube = self.cube
+        selected = cube.measures[self.mask]
+        return _by_year(cube.years, cube.cell_years[self.mask],
+                        selected[:, cube.columns['crashes']], selected[:, cube.columns['no_killed']])
+
+    def by_time(self, name, excluded_years=()):
+        """Crashes and people killed per bin of the time column ``name``, every bin in order.
+
+        Crashes of ``excluded_years`` are left out.
+        """
+        cube = self.cube
+        selected = cube.time_measures[self.mask & ~np.isin(cube.cell_years, excluded_years)]
+        n_bins = len(cube.time_labels[name])
+        sums = {}
+        for measure in TIME_MEASURES:
+            start = cube.time_columns[(name, measure)]
+            sums[measure] = selected[:, start:start + n_bins].sum(axis=0)
+        return _by_time(name, cube.time_labels[name], sums)
+
+    def group(self, name):
+        """Per-category measures of ``name`` for categories with at least one crash."""
+        import pandas as pd # type: ignore
+        labels = self.cube.group_labels[name]
+        frame = pd.DataFrame(
+            {
+                measure: self.sums[self.cube.columns[(name, measure)]:self.cube.columns[(name, measure)] + len(labels)]
+                for measure in GROUP_MEASURES[name]
+            },
+            index=pd.Index(labels, name=name),
+        )
+        return frame[frame['crashes'] > 0]
+
+    def cells(self, measures):
+        """Columns of the selected cells: year, filter codes and ``measures``.
+
+        A measure is a ``SUM_COLUMNS`` name, ``'crashes'`` or a
+        ``(group column, measure)`` pair, which gives one column per category.
+        """
+        cube = self.cube
+        columns = {'year_of_crash': cube.cell_years[self.mask]}
+        for name in cube.dimensions:
+            columns[name] = cube.cell_codes[name][self.mask]
+        selected = cube.measures[self.mask]
+        for measure in measures:
+            start = cube.columns[measure]
+            if isinstance(measure, tuple):
+                columns[measure] = selected[:, start:start + len(cube.group_labels[measure[0]])]
+            else:
+                columns[measure] = selected[:, start]
+        return columns
+
+    def first_rows(self, name, codes):
+        """The source row where each category of ``codes`` of ``name`` first occurs in the selection."""
+        if not len(codes):
+            return np.zeros(0, dtype=np.int64)
+        return self.cube.first_rows[name][self.mask][:, codes].min(axis=0)
+
+    def counts(self, name):
+        """Crash counts per category of ``name``, largest first, like value_counts.
+
+        As there, equal counts are in the order their categories first occur
+        among the selected crashes in the extract.
+        """
+        import pandas as pd # type: ignore
+        labels = self.cube.group_labels[name]
+        start = self.cube.columns[(name, 'crashes')]
+        crashes = self.sums[start:start + len(labels)]
+        codes = np.flatnonzero(crashes)
+        # Only tied categories need to know where they first occur.
+        values, repeats = np.unique(crashes[codes], return_counts=True)
+        tied = codes[np.isin(crashes[codes], values[repeats > 1])]
+        first = np.zeros(len(labels), dtype=np.int64)
+        first[tied] = self.first_rows(name, tied)
+        codes = codes[np.lexsort((first[codes], -crashes[codes]))]
+        return pd.Series(crashes[codes], index=pd.Index([labels[code] for code in codes], name=name), name='count')
+
+
+class RowSlice(CubeSlice):
+    """``CubeSlice`` aggregates over given crash rows, e.g. a map selection.
+
+    Cube cells do not split by area, so the measures are summed from the
+    rows' own columns into the cube's measure layout.
+    """
+
+    def __init__(self, cube, store, rows):
+        self.cube = cube
+        self.store = store
+        self.rows = rows
+        sums = np.zeros(cube.measures.shape[1], dtype=np.int64)
+        sums[cube.columns['crashes']] = len(rows)
+        for name in SUM_COLUMNS:
+            sums[cube.columns[name]] = np.asarray(store[name])[rows].sum(dtype=np.int64)
+        for name, measures in GROUP_MEASURES.items():
+            codes = np.asarray(store[name])[rows].astype(np.int64)
+            valid = codes >= 0
+            n_categories = len(cube.group_labels[name])
+            for measure in measures:
+                weights = None if measure == 'crashes' else np.asarray(store[measure])[rows][valid]
+                start = cube.columns[(name, measure)]
+                sums[start:start + n_categories] = np.bincount(codes[valid], weights=weights, minlength=n_categories)
+        self.sums = sums
+        self.years = np.asarray(store['year_of_crash'])[rows]
+        self.killed = np.asarray(store['no_killed'])[rows]
+
+    def first_rows(self, name, codes):
+        first = _first_rows(np.asarray(self.store[name])[self.rows].astype(np.int64), len(self.cube.group_labels[name]),
+                            np.asarray(self.store[SOURCE_ROW])[self.rows])
+        return first[0, codes]
+
+    def by_year(self):
+        return _by_year(self.cube.years, self.years, None, self.killed)
+
+    def by_time(self, name, excluded_years=()):
+        rows = self.rows[~np.isin(self.years, excluded_years)]
+        codes = np.asarray(self.store[name])[rows].astype(np.int64)
+        valid = codes >= 0
+        labels = self.cube.time_labels[name]
+        sums = {}
+        for measure in TIME_MEASURES:
+            weights = None if measure == 'crashes' else np.asarray(self.store[measure])[rows][valid]
+            sums[measure] = np.bincount(codes[valid], weights=weights, minlength=len(labels)).astype(np.int64)
+        return _by_time(name, labels, sums)
+
+    def cells(self, measures):
+        raise TypeError('a row selection has no cube cells')
@@ -0,0 +1,269 @@
+"""The loaded crash data and its background reloading.
+
+``CrashData`` bundles one snapshot with the index, cube, tile and spatial
+indexes built over it. ``DatasetReloader`` holds the current ``CrashData``
+and replaces it whole when the source CSV changes: the new bundle is fully
+built before a single reference assignment makes it current, so a callback
+that took the old bundle keeps working on it (its memory maps stay valid
+after the swap) and never sees a half-built one.
+
+The first load may run in a background thread (``load_in_background``), so a
+server can answer while the indexes are built: ``metadata()`` serves the
+years and category labels from the snapshot manifest meanwhile, and
+``current`` waits for the load to finish. ``unload()`` drops the data again
+until the next ``load()``; see ``nswcrash.registry``.
+
+Only the snapshot is updated incrementally: rows appended to the CSV are
+parsed and merged into it (``nswcrash.store.append_snapshot``), and any other
+change rebuilds it. The filter index, cube, tiles and spatial index are not
+patched: they are built afresh over the merged snapshot.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import threading
+import time
+from functools import cached_property
+
+import numpy as np
+
+from nswcrash.cube import CrashCube
+from nswcrash.index import FilterIndex
+from nswcrash.spatial import SpatialIndex
+from nswcrash.store import SNAPSHOT_VERSION, _fingerprint, _read_manifest, load_crashes, snapshot_dir
+from nswcrash.tiles import TileIndex
+
+logger = logging.getLogger(__name__)
+
+
+def _trim_heap():
+    # Building the index and cube frees large temporaries that glibc keeps on
+    # the heap; hand them back so they do not stay resident in every worker.
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        libc.malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _matches(manifest, csv_path):
+    # Whether the manifest was built from the CSV as it is now, judged by its
+    # size and mtime only (hashing it would cost as much as a load).
+    if not os.path.exists(csv_path):
+        return True
+    fingerprint = _fingerprint(csv_path)
+    source = manifest['source']
+    return fingerprint['size'] == source['size'] and fingerprint['mtime_ns'] == source['mtime_ns']
+
+
+def _array_bytes(*objects):
+    # Bytes of the arrays held by the objects' attributes, looking into dicts,
+    # lists and tuples. Views count as the array they view, once, so memory
+    # maps count their full length.
+    owners = {}
+
+    def visit(value):
+        if isinstance(value, np.ndarray):
+            while isinstance(value.base, np.ndarray):
+                value = value.base
+            owners[id(value)] = value.nbytes
+        elif isinstance(value, dict):
+            for item in value.values():
+                visit(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                visit(item)
+
+    for obj in objects:
+        visit(vars(obj))
+    return sum(owners.values())
+
+
+class CrashData:
+
+    def __init__(self, store):
+        self.store = store
+        self.version = store.manifest['source']['sha1'][:12]
+        self.index = FilterIndex(store)
+        # KPI cards and every chart but the map are served from the aggregate cube.
+        self.cube = CrashCube(store)
+        # The map draws vector tiles cut from the quadkey-sorted coordinates.
+        self.tiles = TileIndex(store)
+        # Area queries search the same quadkey order.
+        self.spatial = SpatialIndex(self.tiles, store)
+
+    def __len__(self):
+        return len(self.store)
+
+    @cached_property
+    def nbytes(self):
+        """Bytes of the snapshot columns and of the indexes built over them."""
+        return _array_bytes(self.store, self.index, self.cube, self.tiles, self.spatial)
+
+
+class DatasetReloader:
+    """Keep ``current`` in step with the CSV at ``csv_path``.
+
+    The data is loaded at once unless ``load=False``; then call ``load()`` or
+    ``load_in_background()``.
+    """
+
+    def __init__(self, csv_path, out_dir=None, load=True):
+        self.csv_path = csv_path
+        self.out_dir = out_dir or snapshot_dir(csv_path)
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.loaded = threading.Event()
+        self.load_seconds = None
+        self._current = None
+        if load:
+            self.load()
+
+    @property
+    def current(self):
+        """The current ``CrashData``, waiting for the first load if it is running."""
+        self.loaded.wait()
+        if self._current is None:
+            raise RuntimeError('Crash dataset {} failed to load'.format(self.csv_path))
+        return self._current
+
+    @property
+    def ready(self):
+        return self._current is not None
+
+    def loaded_data(self):
+        """The current ``CrashData``, or None while none is loaded; never waits."""
+        return self._current
+
+    def load(self):
+        """Open the snapshot, building it first if it is stale, and make it current.
+
+        Does nothing if the data is already loaded; returns True if this call
+        loaded it.
+        """
+        with self.lock:
+            if self._current is not None:
+                return False
+            try:
+                started = time.perf_counter()
+                self._current = CrashData(load_crashes(self.csv_path, self.out_dir))
+                self.load_seconds = time.perf_counter() - started
+            finally:
+                # Also on failure, so waiting callers raise rather than hang.
+                self.loaded.set()
+        _trim_heap()
+        return True
+
+    def unload(self):
+        """Drop the current data and return it; ``load()`` brings it back.
+
+        Callbacks that already took the data keep working on it, and its
+        memory is freed once the last of them lets go.
+        """
+        with self.lock:
+            old, self._current = self._current, None
+            self.loaded.clear()
+            self.load_seconds = None
+        return old
+
+    def load_in_background(self, then=None):
+        """Run ``load()`` and then ``then()`` in a daemon thread."""
+        def run():
+            try:
+                self.load()
+                if then is not None:
+                    then()
+            except Exception:
+                logger.exception('Loading crash dataset from %s failed', self.csv_path)
+
+        thread = threading.Thread(target=run, name='dataset-load', daemon=True)
+        thread.start()
+        return thread
+
+    def metadata(self):
+        """The snapshot manifest: years, category labels, row count and source.
+
+        Before the first load finishes it is read from disk if the snapshot
+        there matches the CSV; otherwise (e.g. the snapshot is still being
+        built) this waits for the load.
+        """
+        if not self.loaded.is_set():
+            manifest = self.snapshot_manifest()
+            if manifest is not None:
+                return manifest
+        return self.current.store.manifest
+
+    def snapshot_manifest(self):
+        """The on-disk snapshot's manifest if it matches the CSV, else None."""
+        manifest = _read_manifest(self.out_dir)
+        if manifest is not None and manifest.get('version') == SNAPSHOT_VERSION and _matches(manifest, self.csv_path):
+            return manifest
+        return None
+
+    def on_swap(self, fn):
+        """Register ``fn(new, old)`` to run after a new dataset becomes current."""
+        self.listeners.append(fn)
+        return fn
+
+    def stale(self):
+        """True when the CSV or the on-disk snapshot moved on from the loaded data."""
+        data = self._current
+        if data is None:
+            # Unloaded meanwhile; it is read afresh when next loaded.
+            return False
+        current = data.store.manifest
+        if not _matches(current, self.csv_path):
+            return True
+        # Another worker may already have rebuilt the snapshot.
+        manifest = _read_manifest(self.out_dir)
+        return manifest is not None and manifest['source']['sha1'] != current['source']['sha1']
+
+    def reload(self):
+        """Bring the snapshot up to date and swap it in; True if the data changed.
+
+        Data that is not loaded is left alone (False): ``load()`` reads the
+        snapshot afresh, bringing it up to date first.
+        """
+        with self.lock:
+            # Not self.current, which waits for a load that this lock holds off.
+            old = self._current
+            if old is None:
+                return False
+            started = time.perf_counter()
+            store = load_crashes(self.csv_path, self.out_dir)
+            if store.manifest['source']['sha1'] == old.store.manifest['source']['sha1']:
+                # Same bytes (e.g. only the mtime moved): nothing to swap.
+                old.store.manifest['source'].update(store.manifest['source'])
+                return False
+            new = CrashData(store)
+            self._current = new
+            self.load_seconds = time.perf_counter() - started
+        _trim_heap()
+        logger.info('Swapped in crash dataset %s (%d rows, was %s with %d) in %.2fs',
+                    new.version, len(new), old.version, len(old), self.load_seconds)
+        for listener in self.listeners:
+            listener(new, old)
+        return True
+
+    def reload_if_stale(self):
+        # Data that is not loaded is read afresh when it next is.
+        if not self.ready:
+            return False
+        try:
+            return self.stale() and self.reload()
+        except Exception:
+            logger.exception('Reloading crash dataset from %s failed', self.csv_path)
+            return False
+
+    def watch(self, interval):
+        """Poll for changes every ``interval`` seconds in a daemon thread."""
+        def poll():
+            while True:
+                time.sleep(interval)
+                self.reload_if_stale()
+
+        thread = threading.Thread(target=poll, name='dataset-watch', daemon=True)
+        thread.start()
+        return thread
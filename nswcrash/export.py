@@ -0,0 +1,168 @@
+"""Streaming export of the filtered crashes as CSV or Parquet.
+
+The matching rows are found and read from the store ``CHUNK_ROWS`` at a
+time: the year range is walked in row blocks checked against the filter
+bitmaps, each chunk's columns are taken from the memory-mapped snapshot and
+encoded, and the bytes are yielded before the next chunk is read. Memory
+stays at about one block whatever the selection holds, and a client that
+disconnects closes the generator, so no further rows are read.
+
+Parquet needs ``pyarrow``; without it only CSV is offered.
+"""
+
+import io
+
+import numpy as np
+
+from nswcrash.metrics import registry
+from nswcrash.store import DERIVED_COLUMNS, SOURCE_ROW
+
+try:
+    import pyarrow # type: ignore
+    import pyarrow.parquet # type: ignore
+except ImportError:
+    pyarrow = None
+
+CHUNK_ROWS = 16384
+# Rows checked against the filter bitmaps at once
+SCAN_ROWS = 16 * CHUNK_ROWS
+ROW_GROUP_ROWS = 4 * CHUNK_ROWS
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+exported_rows = registry.counter('crash_export_rows_total', 'Crash rows written by exports.', ('format',))
+exports = registry.counter(
+    'crash_exports_total', 'Exports by format and outcome (complete or disconnected).', ('format', 'outcome'))
+
+
+def export_formats():
+    """The export formats available in this environment."""
+    return ['csv', 'parquet'] if pyarrow is not None else ['csv']
+
+
+def export_columns(store, requested=None):
+    """The columns to export: ``requested``, checked, or all stored columns."""
+    if not requested:
+        return [name for name in store.columns if name != SOURCE_ROW]
+    unknown = [name for name in requested
+               if (name not in store.columns or name == SOURCE_ROW) and name not in DERIVED_COLUMNS]
+    if unknown:
+        raise ValueError('unknown columns: {}'.format(', '.join(unknown)))
+    return list(requested)
+
+
+def _matching_blocks(index, year_range, selections, rows):
+    # The matching rows, ascending, SCAN_ROWS candidates at a time.
+    if rows is None:
+        start, stop = index.year_rows(*year_range)
+        for block_start in range(start, stop, SCAN_ROWS):
+            yield index.select_rows(block_start, min(block_start + SCAN_ROWS, stop), selections)
+        return
+    rows = np.sort(rows)
+    for block_start in range(0, len(rows), SCAN_ROWS):
+        block = rows[block_start:block_start + SCAN_ROWS]
+        yield block[index.contains(block, year_range, selections)]
+
+
+def row_chunks(index, year_range, selections, rows=None, chunk_rows=CHUNK_ROWS, match=None):
+    """The matching rows, ascending, in chunks of ``chunk_rows`` (the last may be shorter).
+
+    Without ``rows`` the rows of the year range are selected block by block
+    from the bitmaps; given ``rows`` (e.g. those in a map area), they are
+    filtered block by block. ``match(rows)``, if given, flags which rows of
+    each block to keep besides (e.g. the chart filters). Sparse matches are
+    gathered into full chunks, so a narrow filter is not encoded in many
+    tiny pieces.
+    """
+    pending, n_pending = [], 0
+    for block in _matching_blocks(index, year_range, selections, rows):
+        if match is not None:
+            block = block[match(block)]
+        pending.append(block)
+        n_pending += len(block)
+        if n_pending >= chunk_rows:
+            merged = np.concatenate(pending)
+            full = len(merged) - len(merged) % chunk_rows
+            for chunk_start in range(0, full, chunk_rows):
+                yield merged[chunk_start:chunk_start + chunk_rows]
+            pending, n_pending = [merged[full:]], len(merged) - full
+    if n_pending:
+        yield np.concatenate(pending)
+
+
+def _csv(store, chunks, columns):
+    header = True
+    for rows in chunks:
+        yield len(rows), store.take(rows, columns).to_csv(index=False, header=header).encode()
+        header = False
+    if header:
+        yield 0, (','.join(columns) + '\n').encode()
+
+
+class _Sink(io.RawIOBase):
+    # Keeps what the Parquet writer has written until it is taken, and the
+    # byte position the writer records offsets against.
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def _frame(store, rows, columns):
+    frame = store.take(rows, columns)
+    # Derived columns take the smallest dtype of each chunk; fix one for the schema.
+    for name in DERIVED_COLUMNS:
+        if name in frame:
+            frame[name] = frame[name].astype(np.uint32)
+    return frame
+
+
+def _parquet(store, chunks, columns):
+    sink = _Sink()
+    schema = pyarrow.Schema.from_pandas(_frame(store, np.empty(0, dtype=np.int64), columns), preserve_index=False)
+    with pyarrow.parquet.ParquetWriter(sink, schema, compression='zstd') as writer:
+        # Chunks are gathered into row groups of about ROW_GROUP_ROWS, each
+        # sent as soon as it is written.
+        pending, pending_rows = [], 0
+        for rows in chunks:
+            pending.append(pyarrow.Table.from_pandas(_frame(store, rows, columns), schema=schema, preserve_index=False))
+            pending_rows += len(rows)
+            if pending_rows >= ROW_GROUP_ROWS:
+                writer.write_table(pyarrow.concat_tables(pending), row_group_size=pending_rows)
+                yield pending_rows, sink.take()
+                pending, pending_rows = [], 0
+        if pending:
+            writer.write_table(pyarrow.concat_tables(pending), row_group_size=pending_rows)
+    yield pending_rows, sink.take()
+
+
+def stream_export(store, chunks, columns, format='csv'):
+    """Yield the encoded export of the rows in ``chunks``."""
+    encoded = (_parquet if format == 'parquet' else _csv)(store, chunks, columns)
+    complete = False
+    try:
+        for n_rows, data in encoded:
+            exported_rows.inc(n_rows, format=format)
+            if data:
+                yield data
+        complete = True
+    finally:
+        # Also reached when the server closes the stream of a client that went away.
+        encoded.close()
+        exports.inc(format=format, outcome='complete' if complete else 'disconnected')
@@ -0,0 +1,122 @@
+"""Chart skeletons validated once, filled with each request's data as dicts.
+
+Plotly Express, ``make_subplots`` and ``update_layout`` run every property
+through Plotly's validators, although only a chart's data arrays change
+between requests. A ``FigureTemplate`` runs the chart's usual figure code
+once, on sample data, and keeps the resulting figure as plain dicts. Each
+request then copies only the containers on the paths of its data arrays and
+places the arrays there, so it pays for neither validation nor a deep copy
+of the layout and theme.
+
+Numeric NumPy arrays of ``TYPED_ARRAY_MIN`` or more values are written as
+Plotly.js typed arrays (base64 of the raw buffer), which are smaller and
+faster to encode and parse than lists of numbers; shorter arrays, where the
+dtype header would outweigh the saving, and other arrays become lists. The
+figure is then plain JSON types that orjson serialises without Plotly's
+per-value fallback encoder.
+
+Templates are built on first use rather than at import, so a server starts
+without running Plotly's figure code; ``FigureTemplate.warm`` builds one
+ahead of traffic.
+"""
+
+import json
+import threading
+
+import numpy as np
+
+from _plotly_utils.utils import to_typed_array_spec # type: ignore
+from dash import Patch # type: ignore
+from plotly.io.json import to_json_plotly # type: ignore
+
+from nswcrash.metrics import stage
+
+TYPED_ARRAY_MIN = 16
+
+
+def _copy(container):
+    return list(container) if isinstance(container, list) else dict(container)
+
+
+def encode_array(value):
+    """``value`` as JSON-ready data: a typed array spec or a list."""
+    if not isinstance(value, np.ndarray):
+        return value
+    if value.dtype.kind in 'iuf' and value.size >= TYPED_ARRAY_MIN:
+        encoded = to_typed_array_spec(value)
+        if isinstance(encoded, dict):
+            return encoded
+    return value.tolist()
+
+
+class FigureTemplate:
+    """A figure built by ``build(sample)`` with named data paths to fill.
+
+    ``paths`` maps a field name to its location in the figure, e.g.
+    ``y=('data', 0, 'y')``. Every path must exist in the built figure. The
+    figure is built on first use; ``sample`` may be a function returning the
+    sample data, so that it too is only computed then.
+    """
+
+    def __init__(self, build, sample, **paths):
+        self.name = build.__name__
+        self.build = build
+        self.sample = sample
+        self.paths = paths
+        self.lock = threading.Lock()
+        self._skeleton = None
+
+    @property
+    def skeleton(self):
+        if self._skeleton is None:
+            with self.lock:
+                if self._skeleton is None:
+                    self._skeleton = self._build_skeleton()
+        return self._skeleton
+
+    def warm(self):
+        """Build the skeleton now rather than on first use."""
+        return self.skeleton
+
+    def _build_skeleton(self):
+        sample = self.sample() if callable(self.sample) else self.sample
+        # Through JSON, so no NumPy or pandas values are left in the skeleton.
+        skeleton = json.loads(to_json_plotly(self.build(sample)))
+        for name, path in self.paths.items():
+            node = skeleton
+            for step in path:
+                try:
+                    node = node[step]
+                except (KeyError, IndexError, TypeError):
+                    raise KeyError('{} has no {} at {}'.format(self.name, name, path)) from None
+        return skeleton
+
+    def figure(self, **values):
+        """The full figure with ``values`` in place, as dicts and lists."""
+        with stage('figure', self.name):
+            figure = _copy(self.skeleton)
+            copied = set()
+            for name, value in values.items():
+                path = self.paths[name]
+                node = figure
+                for depth, step in enumerate(path[:-1]):
+                    if path[:depth + 1] not in copied:
+                        node[step] = _copy(node[step])
+                        copied.add(path[:depth + 1])
+                    node = node[step]
+                node[path[-1]] = encode_array(value)
+            return figure
+
+    def patch(self, **values):
+        """A Dash ``Patch`` assigning ``values`` to an already drawn figure."""
+        patch = Patch()
+        for name, value in values.items():
+            node = patch
+            for step in self.paths[name][:-1]:
+                node = node[step]
+            node[self.paths[name][-1]] = encode_array(value)
+        return patch
+
+    def render(self, initial, **values):
+        return self.figure(**values) if initial else self.patch(**values)
+
@@ -0,0 +1,140 @@
+"""Pre-built indexes for the dashboard's year range and dropdown filters.
+
+Snapshot rows are stored in year order, so a year range resolves to a
+contiguous ``[start, stop)`` row range through a small offset table. Each
+dropdown column keeps one packed bitmap per category code; a multi-select is
+an OR of the chosen bitmaps and the filters are combined with AND, all on
+packed bytes restricted to the year range.
+"""
+
+import numpy as np
+
+FILTER_COLUMNS = ('weather', 'surface_condition', 'lga')
+# Columns of the charts whose slices and bars, when clicked, filter the other
+# charts (see nswcrash.crossfilter)
+CHART_FILTER_COLUMNS = ('degree_of_crash_detailed', 'conurbation_1', 'speed_limit', 'type_of_location')
+
+
+def active_values(selected):
+    """Return the selected dropdown values, or None when the filter is off.
+
+    The dropdowns return a list; an empty list or one containing 'All'
+    means no filtering.
+    """
+    if not selected or 'All' in selected:
+        return None
+    return tuple(sorted(set(selected)))
+
+
+class FilterIndex:
+
+    def __init__(self, store, columns=FILTER_COLUMNS):
+        years = np.asarray(store['year_of_crash'])
+        if len(years) and np.any(years[1:] < years[:-1]):
+            raise ValueError('Crash rows must be sorted by year_of_crash')
+        self.n_rows = len(years)
+        self.years = np.unique(years)
+        # Row offset of the first crash of each year, plus the end sentinel.
+        self.year_offsets = np.append(np.searchsorted(years, self.years), self.n_rows)
+
+        self.codes = {}
+        self.bitmaps = {}
+        for name in columns:
+            labels = store.labels(name)
+            codes = np.asarray(store[name])
+            self.codes[name] = {label: code for code, label in enumerate(labels)}
+            bitmaps = np.zeros((len(labels), (self.n_rows + 7) // 8), dtype=np.uint8)
+            for code in range(len(labels)):
+                bitmaps[code] = np.packbits(codes == code)
+            self.bitmaps[name] = bitmaps
+
+    def year_rows(self, start_year, end_year):
+        start = np.searchsorted(self.years, start_year, side='left')
+        stop = np.searchsorted(self.years, end_year, side='right')
+        if stop <= start:
+            return 0, 0
+        return int(self.year_offsets[start]), int(self.year_offsets[stop])
+
+    def value_bitmap(self, name, values, byte_start, byte_stop):
+        # Values missing from the column (e.g. stale URLs) simply match nothing.
+        codes = [self.codes[name][value] for value in values if value in self.codes[name]]
+        if not codes:
+            return np.zeros(byte_stop - byte_start, dtype=np.uint8)
+        return np.bitwise_or.reduce(self.bitmaps[name][codes, byte_start:byte_stop], axis=0)
+
+    def select(self, year_range, selections):
+        """Return the sorted row ids matching ``year_range`` and ``selections``.
+
+        ``selections`` maps a filter column to its dropdown value list.
+        """
+        return self.select_rows(*self.year_rows(*year_range), selections)
+
+    def select_rows(self, start, stop, selections):
+        """Return the sorted row ids in ``[start, stop)`` matching ``selections``."""
+        active = {name: active_values(selected) for name, selected in selections.items()}
+        active = {name: values for name, values in active.items() if values is not None}
+        if not active or start == stop:
+            return np.arange(start, stop)
+
+        byte_start, byte_stop = start // 8, (stop + 7) // 8
+        bits = None
+        for name, values in active.items():
+            column_bits = self.value_bitmap(name, values, byte_start, byte_stop)
+            bits = column_bits if bits is None else bits & column_bits
+        rows = np.flatnonzero(np.unpackbits(bits)) + byte_start * 8
+        return rows[(rows >= start) & (rows < stop)]
+
+    def contains(self, rows, year_range, selections):
+        """Boolean mask of the given ``rows`` that match the filter state.
+
+        Reads single bits of the bitmaps, so the cost follows ``len(rows)``
+        rather than the table size.
+        """
+        start, stop = self.year_rows(*year_range)
+        mask = (rows >= start) & (rows < stop)
+        byte, bit = rows >> 3, (7 - (rows & 7)).astype(np.uint8)
+        for name, selected in selections.items():
+            values = active_values(selected)
+            if values is None:
+                continue
+            hit = np.zeros(len(rows), dtype=bool)
+            for value in values:
+                if value in self.codes[name]:
+                    hit |= ((self.bitmaps[name][self.codes[name][value], byte] >> bit) & 1).astype(bool)
+            mask &= hit
+        return mask
+
+
+def filter_key(year_range, selections, area=None, charts=None):
+    """Hashable form of a filter state for caching.
+
+    Value order is ignored and 'All' (or an empty selection) becomes None,
+    so equivalent dropdown states share one key. ``area`` is a map selection
+    (see ``nswcrash.spatial``) or None; ``charts`` maps chart filter columns
+    to the categories clicked on their charts.
+    """
+    start_year, end_year = year_range
+    charts = tuple(active_values((charts or {}).get(name)) for name in CHART_FILTER_COLUMNS)
+    return ((int(start_year), int(end_year)) + tuple(active_values(selections.get(name)) for name in FILTER_COLUMNS)
+            + (area, charts if any(charts) else None))
+
+
+def key_filters(key):
+    """Inverse of ``filter_key``: the ``(year_range, selections)`` it stands for."""
+    return list(key[:2]), dict(zip(FILTER_COLUMNS, key[2:2 + len(FILTER_COLUMNS)]))
+
+
+def key_area(key):
+    """The map selection of a ``filter_key``, or None."""
+    return key[2 + len(FILTER_COLUMNS)]
+
+
+def key_charts(key):
+    """The chart filters of a ``filter_key`` as ``{column: values or None}``, or None without any."""
+    charts = key[3 + len(FILTER_COLUMNS)]
+    return None if charts is None else dict(zip(CHART_FILTER_COLUMNS, charts))
+
+
+def base_key(key):
+    """``key`` without its chart filters."""
+    return key[:3 + len(FILTER_COLUMNS)] + (None,)
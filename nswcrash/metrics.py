@@ -0,0 +1,282 @@
+"""Low-overhead Prometheus-text metrics and sampled request profiling.
+
+Recording a value costs a lock and a bisect, so the instrumentation stays on
+in production. Metrics are per worker process; Prometheus should scrape each
+worker (or aggregate them) rather than rely on one load-balanced response.
+"""
+
+import bisect
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+ROWS_BUCKETS = (0, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in sorted(items):
+            yield self.name, _format_labels(self.labels, key), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend('{}{} {}'.format(name, labels, value) for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def mirror(self, total, **labels):
+        """Set the counter to a running total kept elsewhere."""
+        with self.lock:
+            self.values[self._key(labels)] = total
+
+    def merge(self, values):
+        with self.lock:
+            for key, amount in values.items():
+                self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def merge(self, values):
+        with self.lock:
+            for key, (counts, total, count) in values.items():
+                state = self.values.get(key)
+                if state is None:
+                    state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                state[0] = [mine + theirs for mine, theirs in zip(state[0], counts)]
+                state[1] += total
+                state[2] += count
+
+    def samples(self):
+        with self.lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+        for key, (counts, total, count) in sorted(items):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', _format_labels(self.labels + ('le',), key + (bound,)), cumulative
+            yield self.name + '_sum', _format_labels(self.labels, key), total
+            yield self.name + '_count', _format_labels(self.labels, key), count
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        # Another thread may hold a metric's lock when the process forks.
+        os.register_at_fork(after_in_child=self._reset_locks)
+
+    def _reset_locks(self):
+        for metric in self.metrics:
+            metric.lock = threading.Lock()
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def collector(self, fn):
+        """Register ``fn`` to refresh gauges just before each scrape."""
+        self.collectors.append(fn)
+        return fn
+
+    def take(self):
+        """The counter and histogram values recorded since the last call, which are reset.
+
+        Another process (e.g. a render process) sends these to the one that
+        is scraped, which adds them to its own with ``merge``.
+        """
+        deltas = {}
+        for metric in self.metrics:
+            if isinstance(metric, (Counter, Histogram)):
+                with metric.lock:
+                    values, metric.values = metric.values, {}
+                if values:
+                    deltas[metric.name] = values
+        return deltas
+
+    def merge(self, deltas):
+        """Add values from another process's ``take()`` to these metrics."""
+        for metric in self.metrics:
+            if metric.name in deltas:
+                metric.merge(deltas[metric.name])
+
+    def render(self):
+        for collect in self.collectors:
+            collect()
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'crash_stage_seconds', 'Time spent in each stage of a dashboard callback.', ('stage', 'name'))
+callback_seconds = registry.histogram(
+    'crash_callback_seconds', 'Wall time of Dash callback requests, including serialization.', ('output',))
+output_bytes = registry.histogram(
+    'crash_output_bytes', 'Serialized size of each rendered callback output.', ('output',), BYTES_BUCKETS)
+rows_selected = registry.histogram(
+    'crash_rows_selected', 'Number of crash rows selected by a filter state.', ('kind',), ROWS_BUCKETS)
+dataset_load_seconds = registry.gauge(
+    'crash_dataset_load_seconds', 'Time to load the crash snapshot and build its indexes.', ('dataset',))
+dataset_rows = registry.gauge('crash_dataset_rows', 'Crash rows in the loaded snapshot (0 when not loaded).', ('dataset',))
+dataset_bytes = registry.gauge(
+    'crash_dataset_bytes', 'Bytes of the loaded snapshot columns and indexes (0 when not loaded).', ('dataset',))
+dataset_reloads = registry.counter(
+    'crash_dataset_reloads_total', 'New crash extracts swapped in without a restart.', ('dataset',))
+dataset_evictions = registry.counter(
+    'crash_dataset_evictions_total', 'Idle datasets unloaded to keep within the memory budget.', ('dataset',))
+result_cache_lookups = registry.counter(
+    'crash_result_cache_lookups_total', 'Result cache lookups by outcome.', ('result',))
+result_cache_evictions = registry.counter('crash_result_cache_evictions_total', 'Entries evicted from the result cache.')
+result_cache_entries = registry.gauge('crash_result_cache_entries', 'Entries held by the result cache.')
+result_cache_bytes = registry.gauge('crash_result_cache_bytes', 'Bytes held by the result cache.')
+result_cache_hit_ratio = registry.gauge('crash_result_cache_hit_ratio', 'Result cache hits over lookups since start-up.')
+
+
+@contextmanager
+def stage(stage_name, name=''):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage_name, name=name)
+
+
+def timed(stage_name):
+    """Decorator recording a function's run time as ``stage_name``."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name, fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def track_result_cache(cache):
+    """Export ``cache.stats()`` at every scrape."""
+    @registry.collector
+    def collect_result_cache_stats():
+        stats = cache.stats()
+        result_cache_lookups.mirror(stats['hits'], result='hit')
+        result_cache_lookups.mirror(stats['misses'], result='miss')
+        result_cache_evictions.mirror(stats['evictions'])
+        result_cache_entries.set(stats['entries'])
+        result_cache_bytes.set(stats['bytes'])
+        result_cache_hit_ratio.set(stats['hit_rate'])
+
+
+def instrument_callbacks(server, path='/_dash-update-component'):
+    """Time Dash callback requests and profile a sampled fraction of them.
+
+    ``CRASH_PROFILE_SAMPLE`` (0 to 1, default 0) sets the fraction of
+    callback requests run under cProfile; their stats are dumped as
+    ``.prof`` files into ``CRASH_PROFILE_DIR`` (default ``profiles``).
+    """
+    sample_rate = float(os.environ.get('CRASH_PROFILE_SAMPLE', 0))
+    profile_dir = os.environ.get('CRASH_PROFILE_DIR', 'profiles')
+
+    @server.before_request
+    def start_callback_timer():
+        if request.path != path:
+            return
+        g.callback_started = time.perf_counter()
+        if sample_rate and random.random() < sample_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already active on this thread.
+                return
+            g.callback_profiler = profiler
+
+    @server.after_request
+    def record_callback(response):
+        started = g.pop('callback_started', None)
+        if started is None:
+            return response
+        body = request.get_json(silent=True) or {}
+        output = body.get('output', '')
+        callback_seconds.observe(time.perf_counter() - started, output=output)
+        profiler = g.pop('callback_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            name = '{}-{}-{}.prof'.format(int(time.time() * 1000), os.getpid(), ''.join(c if c.isalnum() else '_' for c in output)[:80])
+            profiler.dump_stats(os.path.join(profile_dir, name))
+        return response
@@ -0,0 +1,158 @@
+"""Figure builds in forked worker processes, fed from a local queue.
+
+Building a Plotly figure is CPU-bound Python that holds the GIL, so in the
+request thread one slow build stalls every other request of the worker.
+``RenderQueue`` hands builds to a small ``ProcessPoolExecutor`` instead. Its
+processes are forked once, before the server starts its threads, as a fork
+from a threaded process can copy a lock some other thread holds. They are
+never forked again, so a job must load any data its process lacks. If the
+pool breaks, or a job is not done within ``timeout`` seconds, the caller is
+left to build in its own thread.
+
+Jobs wait in an in-process queue, not an external broker, and are handed to
+the pool only when a process is free. Each job has a slot, such as one chart
+of one browser tab. Queuing a job into a slot that already holds a waiting
+job drops the older one and raises ``Superseded`` in its caller. Rapid
+slider drags therefore build only the newest state. A job already running
+is left to finish, and its result is still cached.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+
+class Superseded(Exception):
+    """A newer job took this job's slot before it started."""
+
+
+class _Job:
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def finish(self, result=None, error=None):
+        self.result, self.error = result, error
+        self.done.set()
+
+
+def _ready():
+    return os.getpid()
+
+
+class RenderQueue:
+    """Run jobs in ``processes`` forked processes, newest job per slot first.
+
+    ``initializer()`` runs once in each new process, e.g. to warm it up.
+    ``run`` raises ``TimeoutError`` for a job not done within ``timeout``
+    seconds (None waits for ever).
+    """
+
+    def __init__(self, processes, initializer=None, timeout=None):
+        self.processes = processes
+        self.initializer = initializer
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.pending = OrderedDict()
+        self.anonymous = itertools.count()
+        self.executor = None
+        self.pid = None
+
+    def start(self):
+        """Fork the processes, once per process using the queue.
+
+        Call this before other threads start, so that no lock is held
+        mid-update when the fork happens.
+        """
+        with self.cond:
+            if not self.processes or self.pid == os.getpid():
+                return
+            # A queue inherited through a fork has no dispatcher threads.
+            self.pid = os.getpid()
+            self.pending.clear()
+            self.executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('fork'),
+                                                initializer=self.initializer)
+            # The first submit forks every process; the initializer then runs
+            # in them without holding up the caller.
+            self.executor.submit(_ready)
+            for number in range(self.processes):
+                threading.Thread(target=self._dispatch, name='render-dispatch-{}'.format(number), daemon=True).start()
+
+    @property
+    def running(self):
+        """Whether this process's render processes are up to take jobs."""
+        return self.executor is not None and self.pid == os.getpid()
+
+    def run(self, slot, fn, *args):
+        """Run ``fn(*args)`` in a process and return its result.
+
+        ``fn`` and its arguments are pickled, so ``fn`` must be a module-level
+        function. With ``slot=None`` the job never replaces another job.
+        Raises ``BrokenProcessPool`` when the processes are not running.
+        """
+        job = _Job(fn, args)
+        with self.cond:
+            if not self.running:
+                raise BrokenProcessPool('the render processes are not running')
+            if slot is None:
+                slot = ('anonymous', next(self.anonymous))
+            previous = self.pending.pop(slot, None)
+            if previous is not None:
+                previous.finish(error=Superseded())
+            self.pending[slot] = job
+            self.cond.notify()
+        if not job.done.wait(self.timeout):
+            with self.cond:
+                # Still waiting for a process: take it back. A running job is
+                # left to finish, and its result is dropped.
+                if self.pending.get(slot) is job:
+                    del self.pending[slot]
+            raise TimeoutError('render job not done within {}s'.format(self.timeout))
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _dispatch(self):
+        # One dispatcher per process, so the executor never queues work of
+        # its own that could no longer be superseded.
+        while True:
+            with self.cond:
+                while not self.pending and self.executor is not None:
+                    self.cond.wait()
+                executor = self.executor
+                if executor is None:
+                    return
+                _, job = self.pending.popitem(last=False)
+            try:
+                job.finish(result=executor.submit(job.fn, *job.args).result())
+            except BrokenProcessPool as error:
+                job.finish(error=error)
+                self._stop(executor, error)
+            except BaseException as error:
+                job.finish(error=error)
+
+    def _stop(self, broken, error):
+        # A process died. Forking new ones from this threaded process could
+        # copy a held lock into them, so build in the callers' threads from
+        # now on instead.
+        with self.cond:
+            if self.executor is not broken:
+                return
+            logger.error('Render process died; building figures in the request threads from now on')
+            self.executor = None
+            broken.shutdown(wait=False)
+            for job in self.pending.values():
+                job.finish(error=error)
+            self.pending.clear()
+            self.cond.notify_all()
@@ -0,0 +1,202 @@
+"""Several crash datasets served by one process, each loaded when first used.
+
+A ``DatasetRegistry`` names a ``DatasetReloader`` per source CSV: other
+extract vintages, or another jurisdiction's crashes in the same schema. Each
+dataset has its own snapshot directory, memory maps and indexes, and its own
+namespace in the result cache, so clearing one never touches another's
+renders. The first dataset is the default one.
+
+A dataset is loaded the first time its data is asked for. With a byte
+budget, loading one unloads the least recently used datasets, idle for at
+least ``min_idle`` seconds, until the loaded ones fit the budget again (the
+budget may be overrun while all others are busy). A dataset's size is that of
+its column arrays and indexes (``CrashData.nbytes``). As after a reload, an
+unloaded dataset's memory maps stay valid for callbacks still using it, and
+it is loaded again on its next use.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from nswcrash.dataset import DatasetReloader
+
+logger = logging.getLogger(__name__)
+
+
+def parse_sources(spec):
+    """``{name: csv_path}`` from ``'name=path,name=path'``, in order."""
+    sources = {}
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        name, separator, path = entry.partition('=')
+        if not separator or not name.strip() or not path.strip():
+            raise ValueError('expected name=path, got {!r}'.format(entry))
+        sources[name.strip()] = path.strip()
+    if not sources:
+        raise ValueError('no datasets in {!r}'.format(spec))
+    return sources
+
+
+class DatasetRegistry:
+    """Datasets by name, loaded on use and unloaded to stay under ``max_bytes``.
+
+    ``sources`` maps each name to its CSV path; the first is the default.
+    ``max_bytes=0`` never unloads. Given a ``ResultCache``, each dataset gets
+    a namespace of its own in it (``cache(name)``).
+    """
+
+    def __init__(self, sources, max_bytes=0, min_idle=60.0, cache=None):
+        self.reloaders = {name: DatasetReloader(path, load=False) for name, path in sources.items()}
+        self.default = next(iter(self.reloaders))
+        self.max_bytes = max_bytes
+        self.min_idle = min_idle
+        self.caches = {name: cache.namespaced(name) for name in self.reloaders} if cache is not None else {}
+        self.lock = threading.Lock()
+        self.last_used = {}
+        self.load_listeners = []
+        self.evict_listeners = []
+        self.swap_listeners = []
+        for name, reloader in self.reloaders.items():
+            reloader.on_swap(lambda new, old, name=name: self._swapped(name, new, old))
+
+    def __contains__(self, name):
+        return name in self.reloaders
+
+    def __getitem__(self, name):
+        """The ``DatasetReloader`` of ``name`` (None for the default)."""
+        return self.reloaders[name or self.default]
+
+    @property
+    def names(self):
+        return list(self.reloaders)
+
+    def cache(self, name=None):
+        return self.caches[name or self.default]
+
+    def data(self, name=None):
+        """The ``CrashData`` of ``name`` (None for the default), loading it if need be."""
+        name = name or self.default
+        reloader = self.reloaders[name]
+        while True:
+            self.last_used[name] = time.monotonic()
+            data = reloader.loaded_data()
+            if data is not None:
+                return data
+            self.load(name)
+
+    def loaded(self, name=None):
+        """The ``CrashData`` of ``name`` if it is loaded, else None; never loads."""
+        return self.reloaders[name or self.default].loaded_data()
+
+    def metadata(self, name=None):
+        """The manifest of ``name``, read from disk without loading the data if the snapshot is fresh."""
+        reloader = self.reloaders[name or self.default]
+        if not reloader.ready and reloader.snapshot_manifest() is None:
+            self.data(name)
+        return reloader.metadata()
+
+    def load(self, name=None):
+        """Load ``name`` unless it is loaded; True if this call loaded it."""
+        name = name or self.default
+        self.last_used[name] = time.monotonic()
+        if not self.reloaders[name].load():
+            return False
+        data = self.reloaders[name].loaded_data()
+        logger.info('Loaded crash dataset %s (%d rows, %.0f MB)', name, len(data), data.nbytes / 1e6)
+        for listener in self.load_listeners:
+            listener(name, data)
+        self.evict(keep=name)
+        return True
+
+    def load_in_background(self, name=None, then=None):
+        """Run ``load(name)`` and then ``then()`` in a daemon thread."""
+        def run():
+            try:
+                self.load(name)
+                if then is not None:
+                    then()
+            except Exception:
+                logger.exception('Loading crash dataset %s failed', name or self.default)
+
+        thread = threading.Thread(target=run, name='dataset-load', daemon=True)
+        thread.start()
+        return thread
+
+    def evict(self, keep=None):
+        """Unload idle datasets, least recently used first, until the loaded ones fit ``max_bytes``.
+
+        ``keep`` is never unloaded. Returns the names unloaded.
+        """
+        if not self.max_bytes:
+            return []
+        evicted = []
+        with self.lock:
+            loaded = {name: reloader.loaded_data() for name, reloader in self.reloaders.items()}
+            loaded = {name: data for name, data in loaded.items() if data is not None}
+            total = sum(data.nbytes for data in loaded.values())
+            now = time.monotonic()
+            for name in sorted(loaded, key=lambda name: self.last_used.get(name, 0)):
+                if total <= self.max_bytes:
+                    break
+                if name == keep or now - self.last_used.get(name, 0) < self.min_idle:
+                    continue
+                self.reloaders[name].unload()
+                total -= loaded[name].nbytes
+                evicted.append((name, loaded[name]))
+        for name, old in evicted:
+            logger.info('Unloaded idle crash dataset %s (%.0f MB)', name, old.nbytes / 1e6)
+            for listener in self.evict_listeners:
+                listener(name, old)
+        return [name for name, _ in evicted]
+
+    def on_load(self, fn):
+        """Register ``fn(name, data)`` to run after a dataset is loaded."""
+        self.load_listeners.append(fn)
+        return fn
+
+    def on_evict(self, fn):
+        """Register ``fn(name, old)`` to run after an idle dataset is unloaded."""
+        self.evict_listeners.append(fn)
+        return fn
+
+    def on_swap(self, fn):
+        """Register ``fn(name, new, old)`` to run after a dataset's new extract becomes current."""
+        self.swap_listeners.append(fn)
+        return fn
+
+    def _swapped(self, name, new, old):
+        for listener in self.swap_listeners:
+            listener(name, new, old)
+
+    def watch(self, interval):
+        """Every ``interval`` seconds, reload the loaded datasets whose CSV changed and unload idle ones."""
+        def poll():
+            while True:
+                time.sleep(interval)
+                for reloader in self.reloaders.values():
+                    reloader.reload_if_stale()
+                self.evict()
+
+        thread = threading.Thread(target=poll, name='dataset-watch', daemon=True)
+        thread.start()
+        return thread
+
+
+def registry_from_env(cache=None):
+    """Build the registry from ``CRASH_DATASETS``, ``CRASH_DATASET_MAX_BYTES`` and ``CRASH_DATASET_MIN_IDLE``.
+
+    ``CRASH_DATASETS`` is ``name=path,name=path`` (default
+    ``nsw=transport_nsw.csv``), the first being the default dataset.
+    ``CRASH_DATASET_MAX_BYTES`` is the budget of the loaded datasets (0, the
+    default, keeps every dataset once loaded); ``CRASH_DATASET_MIN_IDLE`` is
+    how many seconds a dataset must go unused before it may be unloaded.
+    """
+    return DatasetRegistry(
+        parse_sources(os.environ.get('CRASH_DATASETS', 'nsw=transport_nsw.csv')),
+        max_bytes=int(os.environ.get('CRASH_DATASET_MAX_BYTES', 0)),
+        min_idle=float(os.environ.get('CRASH_DATASET_MIN_IDLE', 60)),
+        cache=cache,
+    )
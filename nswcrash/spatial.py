@@ -0,0 +1,210 @@
+"""Crashes inside a bounding box, a radius or a polygon.
+
+The map's ``TileIndex`` keeps crash positions sorted by quadkey, which makes
+it a spatial index too: the crashes of any tile at or above ``INDEX_ZOOM``
+are one contiguous slice. A query covers its bounding box with at most
+``COVER_TILES`` tiles a side, at the deepest zoom that allows, and finds
+all their slices with one vectorised binary search. Crashes of tiles that
+lie wholly inside the area are taken as they are; only those of tiles on its
+edge are tested, first against the box in fixed-point positions, then
+against their own coordinates. No structure is built beyond the tile index,
+and the work follows the crashes near the area rather than the size of the
+table.
+
+An area is a hashable tuple, so it can be part of a filter key:
+``('bbox', west, south, east, north)``, ``('radius', longitude, latitude,
+metres)`` or ``('polygon', ((longitude, latitude), ...))``.
+"""
+
+import math
+
+import numpy as np
+
+from nswcrash.tiles import INDEX_ZOOM, MAX_LATITUDE, _fixed_positions, quadkey
+
+COVER_TILES = 16
+EARTH_RADIUS_M = 6371008.8
+# Margin, in degrees (about 10 m) and metres, between an area's edge and
+# the tiles or fixed-point positions tested against it, which covers the
+# rounding of the stored float32 coordinates.
+BOX_SLACK = 1e-4
+BOX_SLACK_M = 10.0
+# Vertices kept of a polygon; longer lasso paths are thinned evenly.
+MAX_POLYGON_POINTS = 256
+# Decimal places of area coordinates (about 0.1 m), so keys of the same
+# selection compare equal.
+AREA_DECIMALS = 6
+
+
+def _ranges(starts, stops):
+    # Concatenation of arange(start, stop) for each pair, without a loop.
+    lengths = stops - starts
+    total = int(lengths.sum())
+    if not total:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(total)
+
+
+def bbox_area(west, south, east, north):
+    west, east = sorted((float(west), float(east)))
+    south, north = sorted((float(south), float(north)))
+    return ('bbox',) + tuple(round(value, AREA_DECIMALS) for value in (west, south, east, north))
+
+
+def radius_area(longitude, latitude, metres):
+    if not metres > 0:
+        raise ValueError('radius must be positive')
+    return ('radius', round(float(longitude), AREA_DECIMALS), round(float(latitude), AREA_DECIMALS), float(metres))
+
+
+def polygon_area(points):
+    points = [(round(float(lon), AREA_DECIMALS), round(float(lat), AREA_DECIMALS)) for lon, lat in points]
+    if len(points) > 1 and points[0] == points[-1]:
+        points = points[:-1]
+    if len(points) < 3:
+        raise ValueError('a polygon needs at least 3 points')
+    if len(points) > MAX_POLYGON_POINTS:
+        points = [points[i] for i in np.linspace(0, len(points) - 1, MAX_POLYGON_POINTS).astype(int)]
+    return ('polygon', tuple(points))
+
+
+def _inside_polygon(lon, lat, points):
+    # Even-odd rule: count the polygon edges a ray from each point crosses.
+    # With the points sorted by latitude, an edge is only tested against the
+    # points in its latitude band.
+    order = np.argsort(lat)
+    lon, lat = lon[order], lat[order]
+    inside = np.zeros(len(lon), dtype=bool)
+    previous_lon, previous_lat = points[-1]
+    for point_lon, point_lat in points:
+        if point_lat != previous_lat:
+            start, stop = np.searchsorted(lat, sorted((point_lat, previous_lat)))
+            band = slice(start, stop)
+            edge_lon = point_lon + (lat[band] - point_lat) * (previous_lon - point_lon) / (previous_lat - point_lat)
+            inside[band] ^= lon[band] < edge_lon
+        previous_lon, previous_lat = point_lon, point_lat
+    result = np.empty(len(lon), dtype=bool)
+    result[order] = inside
+    return result
+
+
+def _haversine(lon, lat, longitude, latitude):
+    # Great-circle metres from (longitude, latitude) to each point.
+    lat, lon = np.radians(lat), np.radians(lon)
+    lat0, lon0 = math.radians(latitude), math.radians(longitude)
+    h = np.sin((lat - lat0) / 2) ** 2 + math.cos(lat0) * np.cos(lat) * np.sin((lon - lon0) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def _tile_longitude(x, zoom):
+    return x / 2.0 ** zoom * 360.0 - 180.0
+
+
+def _tile_latitude(y, zoom):
+    return np.degrees(np.arctan(np.sinh(math.pi * (1.0 - 2.0 * y / 2.0 ** zoom))))
+
+
+class SpatialIndex:
+
+    def __init__(self, tiles, store):
+        self.tiles = tiles
+        self.latitude = store['latitude']
+        self.longitude = store['longitude']
+
+    def select(self, west, south, east, north, interior, exact, cover=COVER_TILES):
+        """Rows of the crashes in the box that lie inside an area, in quadkey order.
+
+        ``interior(west, south, east, north)`` flags the cover tiles (at most
+        ``cover`` a side), given as arrays of their bounds, that lie wholly
+        inside the area: their crashes are taken untested. The crashes of the
+        other tiles are kept where ``exact(longitude, latitude)`` is true.
+        """
+        tiles = self.tiles
+        # Widened by BOX_SLACK, as the stored coordinates are float32 and the
+        # positions are rounded; exact() has the last word.
+        (x0, x1), (y1, y0) = _fixed_positions([south - BOX_SLACK, north + BOX_SLACK],
+                                              [west - BOX_SLACK, east + BOX_SLACK])
+        x0, x1, y0, y1 = int(x0), int(x1), int(y0), int(y1)
+        zoom = INDEX_ZOOM
+        while zoom > 0 and max((x1 >> (32 - zoom)) - (x0 >> (32 - zoom)),
+                               (y1 >> (32 - zoom)) - (y0 >> (32 - zoom))) >= cover:
+            zoom -= 1
+        shift = 32 - zoom
+        tile_x, tile_y = np.meshgrid(np.arange(x0 >> shift, (x1 >> shift) + 1), np.arange(y0 >> shift, (y1 >> shift) + 1))
+        tile_x, tile_y = tile_x.ravel(), tile_y.ravel()
+        span = 2 * (INDEX_ZOOM - zoom)
+        # In the index's own dtype, or searchsorted would convert the index.
+        first = quadkey(tile_x, tile_y).astype(np.int64) << span
+        starts = np.searchsorted(tiles.quadkeys, first.astype(tiles.quadkeys.dtype))
+        stops = np.searchsorted(tiles.quadkeys, (first + (1 << span)).astype(tiles.quadkeys.dtype))
+        inner = interior(_tile_longitude(tile_x, zoom), _tile_latitude(tile_y + 1, zoom),
+                         _tile_longitude(tile_x + 1, zoom), _tile_latitude(tile_y, zoom))
+
+        positions = _ranges(starts[~inner], stops[~inner])
+        x, y = tiles.x[positions], tiles.y[positions]
+        edge_rows = tiles.rows[positions[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]]
+        edge_rows = edge_rows[exact(self.longitude[edge_rows].astype(np.float64),
+                                    self.latitude[edge_rows].astype(np.float64))]
+        return np.concatenate([tiles.rows[_ranges(starts[inner], stops[inner])], edge_rows])
+
+    def bbox(self, west, south, east, north):
+        """Rows of the crashes inside the box, in quadkey order."""
+        return self.select(
+            west, south, east, north,
+            lambda w, s, e, n: ((w >= west + BOX_SLACK) & (e <= east - BOX_SLACK)
+                                & (s >= south + BOX_SLACK) & (n <= north - BOX_SLACK)),
+            lambda lon, lat: (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north),
+        )
+
+    def radius(self, longitude, latitude, metres):
+        """Rows of the crashes within ``metres`` (great-circle) of the point, in quadkey order."""
+        degrees = math.degrees(metres / EARTH_RADIUS_M)
+        cos_latitude = math.cos(math.radians(latitude))
+        longitude_degrees = 180.0 if cos_latitude < 1e-6 else min(degrees / cos_latitude, 180.0)
+
+        def interior(w, s, e, n):
+            # A tile is inside the circle when all four corners are.
+            inside = np.ones(len(w), dtype=bool)
+            for lon, lat in ((w, s), (w, n), (e, s), (e, n)):
+                inside &= _haversine(lon, lat, longitude, latitude) <= metres - BOX_SLACK_M
+            return inside
+        return self.select(
+            longitude - longitude_degrees, max(latitude - degrees, -MAX_LATITUDE),
+            longitude + longitude_degrees, min(latitude + degrees, MAX_LATITUDE),
+            interior,
+            lambda lon, lat: _haversine(lon, lat, longitude, latitude) <= metres,
+        )
+
+    def polygon(self, points):
+        """Rows of the crashes inside the polygon of (longitude, latitude) points, in quadkey order."""
+        lons = np.array([lon for lon, _ in points])
+        lats = np.array([lat for _, lat in points])
+        # Bounds of each edge, from each point to the next
+        edge_west, edge_east = np.minimum(lons, np.roll(lons, -1)), np.maximum(lons, np.roll(lons, -1))
+        edge_south, edge_north = np.minimum(lats, np.roll(lats, -1)), np.maximum(lats, np.roll(lats, -1))
+
+        def interior(w, s, e, n):
+            # A tile is inside when its centre is and no edge comes near it.
+            near = ((edge_west[None, :] <= e[:, None] + BOX_SLACK) & (edge_east[None, :] >= w[:, None] - BOX_SLACK)
+                    & (edge_south[None, :] <= n[:, None] + BOX_SLACK) & (edge_north[None, :] >= s[:, None] - BOX_SLACK))
+            return ~near.any(axis=1) & _inside_polygon((w + e) / 2, (s + n) / 2, points)
+        # Finer tiles than for a box follow a lasso's outline more closely.
+        return self.select(lons.min(), lats.min(), lons.max(), lats.max(), interior,
+                           lambda lon, lat: _inside_polygon(lon, lat, points), cover=4 * COVER_TILES)
+
+    def distances(self, rows, longitude, latitude):
+        """Great-circle metres from the point to each of ``rows`` (haversine)."""
+        return _haversine(self.longitude[rows].astype(np.float64), self.latitude[rows].astype(np.float64),
+                          longitude, latitude)
+
+    def query(self, area):
+        """Rows of the crashes inside an area tuple, in quadkey order."""
+        kind = area[0]
+        if kind == 'bbox':
+            return self.bbox(*area[1:])
+        if kind == 'radius':
+            return self.radius(*area[1:])
+        if kind == 'polygon':
+            return self.polygon(area[1])
+        raise ValueError('unknown area {!r}'.format(kind))
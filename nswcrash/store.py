@@ -0,0 +1,389 @@
+"""Typed, memory-mapped columnar snapshot of the TfNSW crash extract.
+
+The CSV is parsed once by ``build_snapshot`` into one ``.npy`` file per column
+the dashboard reads (categorical codes, small unsigned counts, float32
+coordinates) plus a ``manifest.json`` holding the category labels, the years
+present and a fingerprint of the source CSV. Workers then map the columns with
+``np.load(..., mmap_mode='r')`` instead of re-parsing the CSV, and the snapshot
+is rebuilt only when the CSV changes. When the new CSV is the old one with rows
+appended, only the appended rows are parsed and merged into the existing
+columns.
+
+The manifest alone is enough to lay out the filter controls, so a page can be
+served before any column is mapped. pandas is imported only where rows are
+parsed or decoded into frames, not to open a snapshot.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the on-disk layout changes so stale snapshots are rebuilt.
+SNAPSHOT_VERSION = 7
+
+CATEGORICAL_COLUMNS = (
+    'weather',
+    'surface_condition',
+    'lga',
+    'speed_limit',
+    'type_of_location',
+    'conurbation_1',
+    'degree_of_crash_detailed',
+)
+COUNT_COLUMNS = (
+    'no_killed',
+    'no_seriously_injured',
+    'no_moderately_injured',
+    'no_minor_other_injured',
+    'no_of_traffic_units_involved',
+)
+# Each row's position among the extract's data rows. The rows are stored in
+# year order; this keeps the file's order, in which pandas' value_counts
+# breaks ties. It is not exported.
+SOURCE_ROW = 'source_row'
+# The time of a crash, binned at ingest into small integer codes in calendar
+# order: stored column -> (extract column, bin labels). The labels are kept
+# with the category labels, so the codes decode like a category's.
+MONTHS = ('January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December')
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+TWO_HOUR_INTERVALS = tuple('{:02d}:00 - {:02d}:59'.format(hour, hour + 1) for hour in range(0, 24, 2))
+TIME_COLUMNS = {
+    'month': ('month_of_crash', MONTHS),
+    'weekday': ('day_of_week_of_crash', WEEKDAYS),
+    'hour': ('two_hour_intervals', TWO_HOUR_INTERVALS),
+}
+INJURY_COLUMNS = ('no_seriously_injured', 'no_moderately_injured', 'no_minor_other_injured')
+# Columns computed from stored ones only for the rows that need them.
+DERIVED_COLUMNS = {'no_total_injured': INJURY_COLUMNS}
+
+
+def snapshot_dir(csv_path):
+    return os.path.splitext(csv_path)[0] + '.snapshot'
+
+
+def _file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _fingerprint(csv_path):
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _uint_dtype(max_value):
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def _code_dtype(n_categories):
+    # Codes are signed so that -1 can mark a missing value, as in pandas.
+    for dtype in (np.int8, np.int16):
+        if n_categories <= np.iinfo(dtype).max:
+            return dtype
+    return np.int32
+
+
+@contextmanager
+def _build_lock(out_dir):
+    # Serialise snapshot builds across gunicorn workers starting together.
+    if fcntl is None:
+        yield
+        return
+    with open(out_dir + '.lock', 'w') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, 'manifest.json')) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(out_dir, manifest):
+    tmp_path = os.path.join(out_dir, 'manifest.json.tmp')
+    with open(tmp_path, 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    os.replace(tmp_path, os.path.join(out_dir, 'manifest.json'))
+
+
+def _is_fresh(manifest, csv_path, out_dir):
+    if manifest is None or manifest.get('version') != SNAPSHOT_VERSION:
+        return False
+    if not os.path.exists(csv_path):
+        # Deployments may ship the snapshot without the CSV it came from.
+        return True
+    source = manifest['source']
+    fingerprint = _fingerprint(csv_path)
+    if fingerprint['size'] == source['size'] and fingerprint['mtime_ns'] == source['mtime_ns']:
+        return True
+    # The mtime moved (e.g. a fresh checkout); only rebuild if the bytes changed.
+    if fingerprint['size'] != source['size'] or _file_hash(csv_path) != source['sha1']:
+        return False
+    manifest['source'].update(fingerprint)
+    _write_manifest(out_dir, manifest)
+    return True
+
+
+def _read_extract(source):
+    import pandas as pd # type: ignore
+    # Category columns are read as text, so a slice of the file (an appended
+    # tail) gets exactly the labels a read of the whole file would.
+    df = pd.read_csv(source, low_memory=False, dtype={name: str for name in CATEGORICAL_COLUMNS})
+
+    # Ensure numeric lat/lon and drop rows with missing coordinates
+    df['latitude'] = pd.to_numeric(df['latitude'], errors='coerce')
+    df['longitude'] = pd.to_numeric(df['longitude'], errors='coerce')
+    df = df.dropna(subset=['latitude', 'longitude'])
+    # Rows are stored in year order so a year range is a contiguous slice.
+    return df.sort_values('year_of_crash', kind='stable')
+
+
+def _typed_columns(df):
+    import pandas as pd # type: ignore
+    # _read_extract keeps read_csv's row numbers through the sort.
+    source_rows = df.index.to_numpy(np.int64)
+    columns = {
+        'crash_id': pd.to_numeric(df['crash_id'], errors='coerce').fillna(-1).to_numpy(np.int64),
+        'year_of_crash': df['year_of_crash'].to_numpy(np.int16),
+        'latitude': df['latitude'].to_numpy(np.float32),
+        'longitude': df['longitude'].to_numpy(np.float32),
+        SOURCE_ROW: source_rows.astype(_uint_dtype(int(source_rows.max(initial=0)))),
+    }
+
+    # Categories are the sorted string labels, matching the dropdown options.
+    categories = {}
+    for name in CATEGORICAL_COLUMNS:
+        series = df[name]
+        labels = pd.Categorical(series.where(series.isna(), series.astype(str)))
+        categories[name] = [str(label) for label in labels.categories]
+        columns[name] = labels.codes.astype(_code_dtype(len(labels.categories)))
+
+    for name, (source, labels) in TIME_COLUMNS.items():
+        categories[name] = list(labels)
+        columns[name] = _time_codes(df, source, labels)
+
+    for name in COUNT_COLUMNS:
+        values = pd.to_numeric(df[name], errors='coerce').fillna(0).to_numpy(np.int64)
+        columns[name] = values.astype(_uint_dtype(int(values.max(initial=0))))
+    return columns, categories
+
+
+def _time_codes(df, source, labels):
+    # Values are matched to a bin on their first three characters ('Jan',
+    # 'Mon', '08:'), so abbreviated names bin too. Anything else, or an
+    # extract without the column, is -1 (unknown).
+    if source not in df:
+        return np.full(len(df), -1, dtype=np.int8)
+    lookup = {label[:3].lower(): code for code, label in enumerate(labels)}
+    prefixes = df[source].astype(str).str.strip().str[:3].str.lower()
+    return prefixes.map(lookup).fillna(-1).to_numpy(np.int8)
+
+
+def _write_snapshot(csv_path, out_dir, columns, categories, sha1):
+    manifest = {
+        'version': SNAPSHOT_VERSION,
+        'rows': int(len(columns['year_of_crash'])),
+        'years': np.unique(columns['year_of_crash']).tolist(),
+        'source': dict(_fingerprint(csv_path), path=os.path.basename(csv_path), sha1=sha1),
+        'columns': {name: str(values.dtype) for name, values in columns.items()},
+        'categories': categories,
+    }
+
+    # Write into a scratch directory and swap it in so readers never see a partial snapshot.
+    tmp_dir = '{}.tmp-{}'.format(out_dir, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), np.ascontiguousarray(values))
+    _write_manifest(tmp_dir, manifest)
+
+    old_dir = '{}.old-{}'.format(out_dir, os.getpid())
+    if os.path.exists(out_dir):
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return manifest
+
+
+def build_snapshot(csv_path, out_dir=None):
+    out_dir = out_dir or snapshot_dir(csv_path)
+    started = time.perf_counter()
+    columns, categories = _typed_columns(_read_extract(csv_path))
+    manifest = _write_snapshot(csv_path, out_dir, columns, categories, _file_hash(csv_path))
+    logger.info('Built crash snapshot %s (%d rows) in %.2fs', out_dir, manifest['rows'], time.perf_counter() - started)
+    return manifest
+
+
+def _appended_tail(csv_path, source):
+    # Return (header + appended bytes, sha1 of the whole file) when the CSV
+    # is the snapshot's source with whole rows added at the end, else None.
+    if os.path.getsize(csv_path) <= source['size']:
+        return None
+    digest = hashlib.sha1()
+    with open(csv_path, 'rb') as fh:
+        header = fh.readline()
+        fh.seek(0)
+        remaining, chunk = source['size'], b''
+        while remaining:
+            chunk = fh.read(min(remaining, 1 << 20))
+            if not chunk:
+                return None
+            digest.update(chunk)
+            remaining -= len(chunk)
+        if digest.hexdigest() != source['sha1'] or not chunk.endswith(b'\n'):
+            return None
+        tail = fh.read()
+    digest.update(tail)
+    return header + tail, digest.hexdigest()
+
+
+def append_snapshot(csv_path, out_dir=None, manifest=None):
+    """Merge rows appended to ``csv_path`` into its snapshot.
+
+    Only the appended rows are parsed. Returns the new manifest, or None when
+    the CSV is not an append to the snapshot's source and needs a full build.
+    """
+    out_dir = out_dir or snapshot_dir(csv_path)
+    manifest = manifest or _read_manifest(out_dir)
+    if manifest is None or manifest.get('version') != SNAPSHOT_VERSION:
+        return None
+    appended = _appended_tail(csv_path, manifest['source'])
+    if appended is None:
+        return None
+    started = time.perf_counter()
+    tail_bytes, sha1 = appended
+    tail, tail_categories = _typed_columns(_read_extract(io.BytesIO(tail_bytes)))
+    old = CrashStore.open(out_dir, manifest)
+    # The appended rows follow the old ones in the file.
+    old_rows = np.asarray(old[SOURCE_ROW])
+    tail[SOURCE_ROW] = tail[SOURCE_ROW].astype(np.int64) + (int(old_rows.max()) + 1 if len(old_rows) else 0)
+
+    columns, categories = {}, {}
+    for name in CATEGORICAL_COLUMNS:
+        # Merge the label sets, keeping them sorted, and re-code both parts.
+        labels = sorted(set(old.labels(name)) | set(tail_categories[name]))
+        parts = []
+        for codes, own_labels in ((old[name], old.labels(name)), (tail[name], tail_categories[name])):
+            lookup = np.append(np.searchsorted(labels, own_labels).astype(np.int64), -1)
+            parts.append(lookup[codes])
+        categories[name] = labels
+        columns[name] = np.concatenate(parts).astype(_code_dtype(len(labels)))
+    # Time bins have fixed codes, so both parts are simply joined below.
+    for name, (_, labels) in TIME_COLUMNS.items():
+        categories[name] = list(labels)
+    for name in tail:
+        if name not in columns:
+            values = np.concatenate([np.asarray(old[name]), tail[name]])
+            if name in COUNT_COLUMNS or name == SOURCE_ROW:
+                values = values.astype(_uint_dtype(int(values.max(initial=0))))
+            columns[name] = values
+
+    # Old rows come first within each year, as they do in the file.
+    order = np.argsort(columns['year_of_crash'], kind='stable')
+    columns = {name: values[order] for name, values in columns.items()}
+    manifest = _write_snapshot(csv_path, out_dir, columns, categories, sha1)
+    logger.info('Appended %d rows to crash snapshot %s in %.2fs', len(tail['year_of_crash']), out_dir,
+                time.perf_counter() - started)
+    return manifest
+
+
+class CrashStore:
+    """Read-only column arrays for the crash table plus their category labels."""
+
+    def __init__(self, columns, categories, manifest=None):
+        self.columns = columns
+        self.categories = categories
+        self.manifest = manifest or {}
+
+    @classmethod
+    def open(cls, out_dir, manifest=None, mmap=True):
+        manifest = manifest or _read_manifest(out_dir)
+        if manifest is None:
+            raise FileNotFoundError('No crash snapshot in {}'.format(out_dir))
+        mmap_mode = 'r' if mmap else None
+        columns = {
+            name: np.load(os.path.join(out_dir, name + '.npy'), mmap_mode=mmap_mode)
+            for name in manifest['columns']
+        }
+        return cls(columns, manifest['categories'], manifest)
+
+    def __len__(self):
+        return len(self.columns['year_of_crash'])
+
+    def __getitem__(self, name):
+        if name in DERIVED_COLUMNS:
+            return self.derive(name)
+        return self.columns[name]
+
+    def derive(self, name, rows=slice(None)):
+        """Compute the derived column ``name`` for ``rows`` (all rows by default)."""
+        total = sum(self.columns[part][rows].astype(np.int64) for part in DERIVED_COLUMNS[name])
+        return total.astype(_uint_dtype(int(total.max(initial=0))))
+
+    def labels(self, name):
+        return self.categories[name]
+
+    def take(self, rows, names):
+        """DataFrame of columns ``names`` for ``rows``, with categories decoded."""
+        import pandas as pd # type: ignore
+        data = {}
+        for name in names:
+            values = self.derive(name, rows) if name in DERIVED_COLUMNS else self.columns[name][rows]
+            if name in self.categories:
+                values = pd.Categorical.from_codes(values, categories=self.categories[name])
+            data[name] = values
+        return pd.DataFrame(data)
+
+    def to_frame(self):
+        import pandas as pd # type: ignore
+        data = {}
+        for name, values in self.columns.items():
+            if name in self.categories:
+                data[name] = pd.Categorical.from_codes(values, categories=self.categories[name])
+            else:
+                data[name] = values
+        for name in DERIVED_COLUMNS:
+            data[name] = self.derive(name)
+        return pd.DataFrame(data, copy=False)
+
+
+def load_crashes(csv_path, out_dir=None):
+    """Open the snapshot for ``csv_path``, (re)building it first if it is stale."""
+    out_dir = out_dir or snapshot_dir(csv_path)
+    started = time.perf_counter()
+    with _build_lock(out_dir):
+        manifest = _read_manifest(out_dir)
+        if not _is_fresh(manifest, csv_path, out_dir):
+            manifest = append_snapshot(csv_path, out_dir, manifest) or build_snapshot(csv_path, out_dir)
+        # Map the columns before another worker can swap in a rebuilt
+        # snapshot; the maps then stay valid after it does.
+        store = CrashStore.open(out_dir, manifest)
+    logger.info('Loaded crash snapshot %s in %.3fs', out_dir, time.perf_counter() - started)
+    return store
@@ -0,0 +1,181 @@
+"""Mapbox vector tiles of crash points, filtered like the rest of the dashboard.
+
+Crash coordinates are kept as 32-bit fixed-point web-mercator positions sorted
+by their quadkey at ``INDEX_ZOOM``, so the crashes inside any tile at or above
+that zoom are one contiguous slice found with two binary searches (deeper
+tiles narrow their parent's slice by position). The slice is filtered, then
+written as one point feature per occupied cell of the tile, carrying the
+crash, killed and injured counts of its crashes: low zooms send a bounded
+number of cells, and from ``INDEX_ZOOM`` on a cell is one tile pixel.
+"""
+
+import math
+
+import numpy as np
+
+from nswcrash.store import INJURY_COLUMNS
+
+EXTENT = 4096
+EXTENT_BITS = 12
+INDEX_ZOOM = 14
+# Deepest zoom whose pixels the fixed-point positions still resolve.
+MAX_ZOOM = 32 - EXTENT_BITS
+LAYER = 'crashes'
+MAX_LATITUDE = 85.0511287798
+
+
+def cell_bits(zoom):
+    """log2 of the cells per tile side at ``zoom``."""
+    if zoom < 11:
+        return 6
+    if zoom < INDEX_ZOOM:
+        return 7
+    return EXTENT_BITS
+
+
+def _fixed_positions(latitude, longitude):
+    # Web-mercator x/y in [0, 1) scaled to unsigned 32-bit integers.
+    lat = np.radians(np.clip(np.asarray(latitude, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(longitude, dtype=np.float64) + 180.0) / 360.0
+    y = (1.0 - np.arcsinh(np.tan(lat)) / math.pi) / 2.0
+    scale = float(2 ** 32)
+    return (np.clip(x * scale, 0, scale - 1).astype(np.uint32),
+            np.clip(y * scale, 0, scale - 1).astype(np.uint32))
+
+
+def _spread_bits(v):
+    # Interleave zeros between the low 16 bits of v.
+    v = v.astype(np.uint32) & 0xFFFF
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    return (v | (v << 1)) & 0x55555555
+
+
+def quadkey(x, y):
+    """Morton code of tile coordinates (``x`` bits even, ``y`` bits odd)."""
+    return _spread_bits(np.asarray(x)) | (_spread_bits(np.asarray(y)) << 1)
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def _varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 31)
+
+
+def _message(out, field, payload):
+    _varint(out, (field << 3) | 2)
+    _varint(out, len(payload))
+    out += payload
+
+
+def encode_points(layer, px, py, properties):
+    """Encode one MVT layer of point features.
+
+    ``px``/``py`` are tile pixel coordinates in ``[0, EXTENT)`` and
+    ``properties`` maps a property name to one unsigned integer per point.
+    """
+    names = list(properties)
+    columns = [np.asarray(properties[name]).tolist() for name in names]
+    values = {}
+    layer_bytes = bytearray()
+    _varint(layer_bytes, (15 << 3) | 0)
+    _varint(layer_bytes, 2)
+    _message(layer_bytes, 1, layer.encode())
+    for point_x, point_y, *point_values in zip(np.asarray(px).tolist(), np.asarray(py).tolist(), *columns):
+        tags = bytearray()
+        for key_index, value in enumerate(point_values):
+            _varint(tags, key_index)
+            _varint(tags, values.setdefault(value, len(values)))
+        geometry = bytearray()
+        _varint(geometry, 9)  # MoveTo, one point
+        _varint(geometry, _zigzag(point_x))
+        _varint(geometry, _zigzag(point_y))
+        feature = bytearray()
+        _message(feature, 2, tags)
+        _varint(feature, (3 << 3) | 0)
+        _varint(feature, 1)  # POINT
+        _message(feature, 4, geometry)
+        _message(layer_bytes, 2, feature)
+    for name in names:
+        _message(layer_bytes, 3, name.encode())
+    for value in values:
+        encoded = bytearray()
+        _varint(encoded, (5 << 3) | 0)
+        _varint(encoded, value)
+        _message(layer_bytes, 4, encoded)
+    _varint(layer_bytes, (5 << 3) | 0)
+    _varint(layer_bytes, EXTENT)
+
+    tile = bytearray()
+    _message(tile, 3, layer_bytes)
+    return bytes(tile)
+
+
+class TileIndex:
+
+    def __init__(self, store):
+        x, y = _fixed_positions(store['latitude'], store['longitude'])
+        shift = 32 - INDEX_ZOOM
+        keys = quadkey(x >> shift, y >> shift)
+        order = np.argsort(keys, kind='stable')
+        self.quadkeys = keys[order]
+        self.x = x[order]
+        self.y = y[order]
+        self.rows = order.astype(np.int32 if len(order) < 2 ** 31 else np.int64)
+        self.killed = store['no_killed']
+        self.injured = [store[name] for name in INJURY_COLUMNS]
+
+    def tile_positions(self, z, x, y):
+        """Positions (into the quadkey order) of the crashes inside tile z/x/y."""
+        depth = max(z - INDEX_ZOOM, 0)
+        parent_x, parent_y = x >> depth, y >> depth
+        span = 2 * (INDEX_ZOOM - min(z, INDEX_ZOOM))
+        first = int(quadkey(parent_x, parent_y)) << span
+        start = np.searchsorted(self.quadkeys, first, side='left')
+        stop = np.searchsorted(self.quadkeys, first + (1 << span), side='left')
+        positions = np.arange(start, stop)
+        if depth:
+            shift = 32 - z
+            inside = ((self.x[start:stop] >> shift) == x) & ((self.y[start:stop] >> shift) == y)
+            positions = positions[inside]
+        return positions
+
+    def render(self, z, x, y, match=None):
+        """Encode tile z/x/y; ``match(rows)`` keeps only the rows it flags."""
+        positions = self.tile_positions(z, x, y)
+        rows = self.rows[positions]
+        if match is not None and len(rows):
+            keep = match(rows)
+            positions, rows = positions[keep], rows[keep]
+        if not len(rows):
+            return b''
+
+        shift = 32 - z - EXTENT_BITS
+        px = (self.x[positions] >> shift).astype(np.int64) & (EXTENT - 1)
+        py = (self.y[positions] >> shift).astype(np.int64) & (EXTENT - 1)
+        bits = cell_bits(z)
+        cell_shift = EXTENT_BITS - bits
+        cells, cell = np.unique(((py >> cell_shift) << bits) | (px >> cell_shift), return_inverse=True)
+        crashes = np.bincount(cell, minlength=len(cells))
+        # Each cell is drawn at the centroid of its crashes.
+        return encode_points(
+            LAYER,
+            np.rint(np.bincount(cell, weights=px, minlength=len(cells)) / crashes).astype(np.int64),
+            np.rint(np.bincount(cell, weights=py, minlength=len(cells)) / crashes).astype(np.int64),
+            {
+                'crashes': crashes,
+                'killed': np.bincount(cell, weights=self.killed[rows], minlength=len(cells)).astype(np.int64),
+                'injured': sum(np.bincount(cell, weights=column[rows], minlength=len(cells))
+                               for column in self.injured).astype(np.int64),
+            },
+        )